@@ -1,20 +1,285 @@
-from flask import Flask, render_template, request, jsonify, session
+from flask import Flask, render_template, request, jsonify, session, Response, g
+import click
+from werkzeug.wsgi import ClosingIterator
+from werkzeug.middleware.proxy_fix import ProxyFix
 import os
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 import uuid
 import json
 import re
 import random
 from typing import Dict, List, Tuple
 import math
+import heapq
+import unicodedata
+import threading
+import mmap
+import time
+import sys
+import zlib
+import struct
+import array
+import sqlite3
+import queue
+import multiprocessing
+import atexit
+import hashlib
+import hmac
+import csv
+import bisect
+import io
+import cProfile
+import pstats
+from contextlib import contextmanager
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from collections.abc import Mapping
+
+try:
+    import numpy as np
+except ImportError:  # NumPy es opcional: BM25 cae a Python puro y 'dense' a palabras clave
+    np = None
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'dev-secret-key-change-in-production')
 
+# Cantidad de proxies de confianza delante de la app (0: se usa la dirección de la conexión).
+# Sin esto, detrás de un proxy todos los alumnos comparten la misma cubeta por IP
+TRUSTED_PROXIES = int(os.getenv('TRUSTED_PROXIES', '0'))
+if TRUSTED_PROXIES > 0:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES)
+
+def forwarded_client(remote_addr: str, forwarded_for: str) -> str:
+    # Igual que ProxyFix: la dirección que agregó el proxy de confianza más lejano en X-Forwarded-For
+    if TRUSTED_PROXIES <= 0 or not forwarded_for:
+        return remote_addr
+    values = [value.strip() for value in forwarded_for.split(',')]
+    return values[-TRUSTED_PROXIES] if len(values) >= TRUSTED_PROXIES else remote_addr
+
+SESSION_IDLE_TIMEOUT = float(os.getenv('SESSION_IDLE_TIMEOUT', '7200'))
+SESSION_MAX_ENTRIES = int(os.getenv('SESSION_MAX_ENTRIES', '10000'))
+SESSION_MAX_BYTES = int(os.getenv('SESSION_MAX_BYTES', str(64 * 1024 * 1024)))
+SESSION_CLEANUP_INTERVAL = float(os.getenv('SESSION_CLEANUP_INTERVAL', '30'))
+FUZZY_MAX_DISTANCE = int(os.getenv('FUZZY_MAX_DISTANCE', '2'))
+# Palabras más cortas no se corrigen: casas/casos o color/calor son palabras válidas
+SPELLING_MIN_LENGTH = int(os.getenv('SPELLING_MIN_LENGTH', '6'))
+
 # Simulación de módulos de IA sin dependencias externas
+def fold_accents(text: str) -> str:
+    decomposed = unicodedata.normalize('NFKD', text)
+    return ''.join(char for char in decomposed if not unicodedata.combining(char))
+
+def tokenize(text: str) -> List[str]:
+    return [token for token in re.findall(r'[a-z0-9]+', fold_accents(text.lower())) if len(token) > 2]
+
+def normalize_text(text: str) -> str:
+    # Minúsculas, sin acentos ni puntuación, un espacio entre palabras
+    return ' '.join(re.findall(r'[a-z0-9]+', fold_accents(text.lower())))
+
+# Palabras que nunca se corrigen: artículos, preposiciones, verbos comunes y palabras interrogativas
+SPELLING_STOPWORDS = frozenset('''
+    el la lo los las un una unos unas al del de en con sin por para sobre entre desde hasta hacia
+    segun tras ante bajo y e o u ni pero sino que se si no ya mas menos muy tan tambien
+    es son era eran fue fueron ser estar esta estan este esto estos estas ese esa eso esos esas
+    aquel aquella hay habia tiene tienen hace hacen puede pueden mi mis tu tus su sus me te le les
+    nos yo ella ellos ellas usted cual cuales quien quienes cuando cuanto cuanta cuantos cuantas
+    donde adonde como porque cuyo cuya otro otra otros otras todo toda todos todas algo nada
+'''.split())
+
+def edit_distance(a: str, b: str, max_distance: int) -> int:
+    # Damerau-Levenshtein (alineación óptima) con corte: devuelve max_distance + 1 si lo supera
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    previous2 = None
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] * (len(b) + 1)
+        row_min = i
+        char_a = a[i - 1]
+        for j in range(1, len(b) + 1):
+            value = previous[j - 1] + (char_a != b[j - 1])
+            if previous[j] + 1 < value:
+                value = previous[j] + 1
+            if current[j - 1] + 1 < value:
+                value = current[j - 1] + 1
+            if i > 1 and j > 1 and char_a == b[j - 2] and a[i - 2] == b[j - 1] and previous2[j - 2] + 1 < value:
+                value = previous2[j - 2] + 1
+            current[j] = value
+            if value < row_min:
+                row_min = value
+        if row_min > max_distance:
+            return max_distance + 1
+        previous2, previous = previous, current
+    return min(previous[-1], max_distance + 1)
+
+class SymSpellIndex:
+    # Corrección ortográfica por borrados simétricos (SymSpell): se precalculan las variantes
+    # con hasta max_distance letras borradas de cada término; una consulta genera las suyas
+    # y solo se compara contra los términos que comparten alguna variante.
+    # El diccionario de borrados es grande: lo construyen los índices antes de publicarse
+    # (build_deletes), se comparte entre índices con el mismo vocabulario (ver shared) y
+    # el snapshot lo trae precompilado (SnapshotDeletes).
+    cache = OrderedDict()  # (términos, max_distance, min_length) -> SymSpellIndex
+    cache_lock = threading.Lock()
+    cache_size = 4
+    
+    def __init__(self, terms, max_distance: int = 2, min_length: int = SPELLING_MIN_LENGTH, deletes=None):
+        self.max_distance = max_distance
+        self.min_length = min_length
+        self.terms = frozenset(terms)
+        self.deletes = deletes
+        self.build_lock = threading.Lock()
+    
+    @classmethod
+    def shared(cls, terms, max_distance: int = 2, min_length: int = SPELLING_MIN_LENGTH) -> 'SymSpellIndex':
+        # Recargas y snapshots con el mismo vocabulario reutilizan el índice ya construido
+        terms = frozenset(terms)
+        key = (terms, max_distance, min_length)
+        with cls.cache_lock:
+            index = cls.cache.get(key)
+            if index is None:
+                index = cls.cache[key] = cls(terms, max_distance, min_length)
+                while len(cls.cache) > cls.cache_size:
+                    cls.cache.popitem(last=False)
+            cls.cache.move_to_end(key)
+            return index
+    
+    def build_deletes(self) -> Dict:
+        with self.build_lock:
+            if self.deletes is None:
+                deletes = {}
+                for term in self.terms:
+                    if len(term) >= self.min_length - self.max_distance:
+                        for variant in self.variants(term, self.max_distance):
+                            # La mayoría de las variantes tiene un solo término: se guarda sin lista
+                            found = deletes.get(variant)
+                            if found is None:
+                                deletes[variant] = term
+                            elif isinstance(found, str):
+                                deletes[variant] = [found, term]
+                            else:
+                                found.append(term)
+                self.deletes = deletes
+            return self.deletes
+    
+    @staticmethod
+    def variants(word: str, distance: int) -> set:
+        variants = {word}
+        frontier = {word}
+        for _ in range(distance):
+            frontier = {item[:i] + item[i + 1:] for item in frontier if len(item) > 1 for i in range(len(item))}
+            variants |= frontier
+        return variants
+    
+    def allowed_distance(self, word: str) -> int:
+        # Palabras cortas: demasiados falsos positivos, solo coincidencia exacta o una edición
+        if len(word) < self.min_length:
+            return 0
+        return 1 if len(word) < 8 else self.max_distance
+    
+    def lookup(self, word: str):
+        if word in self.terms:
+            return word
+        allowed = min(self.allowed_distance(word), self.max_distance)
+        if allowed == 0:
+            return None
+        deletes = self.deletes if self.deletes is not None else self.build_deletes()
+        candidates = set()
+        for variant in self.variants(word, allowed):
+            found = deletes.get(variant)
+            if found is None:
+                continue
+            if isinstance(found, str):
+                candidates.add(found)
+            else:
+                candidates.update(found)
+        best = None
+        for term in candidates:
+            distance = edit_distance(word, term, allowed)
+            if distance <= allowed and (best is None or (distance, term) < best):
+                best = (distance, term)
+        return best[1] if best else None
+
+class KeywordAutomaton:
+    # Autómata Aho-Corasick: encuentra todos los patrones registrados en una sola pasada
+    def __init__(self, patterns: Dict[str, List[str]] = None):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [set()]
+        self.labels = {}  # patrón -> etiquetas (con repeticiones, como en las listas originales)
+        self.whole_words = set()  # patrones que solo cuentan como palabra completa (o su plural)
+        for label, words in (patterns or {}).items():
+            for word in words:
+                self.add(word, label)
+        self.build()
+    
+    def add(self, pattern: str, label: str, whole_word: bool = False):
+        if not pattern:
+            return
+        self.labels.setdefault(pattern, []).append(label)
+        if whole_word:
+            self.whole_words.add(pattern)
+        state = 0
+        for char in pattern:
+            if char not in self.goto[state]:
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append(set())
+                self.goto[state][char] = len(self.goto) - 1
+            state = self.goto[state][char]
+        self.output[state].add(pattern)
+    
+    def build(self):
+        # Enlaces de fallo por recorrido en anchura; cada estado hereda las salidas de su enlace
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[next_state] = self.goto[fallback].get(char, 0)
+                self.output[next_state] |= self.output[self.fail[next_state]]
+        self.output = [frozenset(patterns) for patterns in self.output]
+    
+    def find(self, text: str) -> set:
+        goto, fail, output, whole_words = self.goto, self.fail, self.output, self.whole_words
+        found = set()
+        state = 0
+        for position, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            matched = output[state]
+            if matched:
+                if whole_words and not whole_words.isdisjoint(matched):
+                    end = position + 1
+                    for pattern in matched:
+                        if pattern not in whole_words or self.is_word(text, end - len(pattern), end):
+                            found.add(pattern)
+                else:
+                    found |= matched
+        return found
+    
+    @staticmethod
+    def is_word(text: str, start: int, end: int) -> bool:
+        # Palabra completa o su plural: 'ion' vale en 'iones' y no en 'reaccion',
+        # 'evolucion' no vale dentro de 'revolucion' ni 'funcion' dentro de 'funciona'
+        if start > 0 and text[start - 1].isalnum():
+            return False
+        for suffix in ('', 's', 'es'):
+            stop = end + len(suffix)
+            if text.startswith(suffix, end) and (stop == len(text) or not text[stop].isalnum()):
+                return True
+        return False
+
 class SimpleNLPProcessor:
-    def __init__(self):
-        self.subject_keywords = {
+    def __init__(self, subject_keywords: Dict[str, List[str]] = None,
+                 question_type_keywords: Dict[str, List[str]] = None):
+        # Función que devuelve las palabras del corpus (se asigna junto con la base de conocimiento)
+        self.vocabulary_source = None
+        self.subject_keywords = subject_keywords if subject_keywords is not None else {
             'matematicas': [
                 'ecuacion', 'algebra', 'geometria', 'calculo', 'trigonometria',
                 'derivada', 'integral', 'funcion', 'grafica', 'numero', 'suma',
@@ -59,26 +324,88 @@ class SimpleNLPProcessor:
                 'predicado', 'complemento', 'literatura', 'texto', 'redaccion'
             ]
         }
+        # El orden define la prioridad al clasificar
+        self.question_type_keywords = question_type_keywords if question_type_keywords is not None else {
+            'definition': ['que es', 'define', 'definicion', 'significa'],
+            'explanation': ['como', 'por que', 'explica', 'porque'],
+            'calculation': ['calcula', 'resuelve', 'resultado', 'cuanto'],
+            'comparison': ['diferencia', 'compara', 'versus'],
+            'example': ['ejemplo', 'casos', 'muestra']
+        }
+        self.build_automaton()
+    
+    def build_automaton(self):
+        # Un único autómata para materias y tipos de pregunta; se reemplaza de forma atómica
+        automaton = KeywordAutomaton()
+        for subject, keywords in self.subject_keywords.items():
+            for keyword in keywords:
+                # Las palabras clave de materia cuentan como palabra completa: como subcadena,
+                # 'ion' o 'sal' aparecen dentro de muchas otras palabras
+                automaton.add(keyword, ('subject', subject), whole_word=True)
+        for question_type, keywords in self.question_type_keywords.items():
+            for keyword in keywords:
+                automaton.add(keyword, ('question_type', question_type))
+        automaton.build()
+        self.automaton = automaton
+        # Vocabulario para corregir errores de tipeo antes de buscar los patrones. Las palabras
+        # de los tipos de pregunta (cuando, como...) y las vacías no se corrigen nunca
+        tables = list(self.subject_keywords.values()) + list(self.question_type_keywords.values())
+        self.spelling = SymSpellIndex(
+            {word for keywords in tables for keyword in keywords for word in keyword.split()}, FUZZY_MAX_DISTANCE
+        )
+        self.spelling.build_deletes()
+        self.protected_words = SPELLING_STOPWORDS | {
+            word for keywords in self.question_type_keywords.values() for keyword in keywords for word in keyword.split()
+        }
+    
+    def add_subject_keywords(self, subject: str, keywords: List[str]):
+        self.subject_keywords.setdefault(subject, []).extend(keywords)
+        self.build_automaton()
+    
+    def add_question_type_keywords(self, question_type: str, keywords: List[str]):
+        self.question_type_keywords.setdefault(question_type, []).extend(keywords)
+        self.build_automaton()
     
     def process_question(self, question: str) -> Dict:
         cleaned = question.lower().strip()
-        subject = self.detect_subject(cleaned)
-        question_type = self.classify_question_type(cleaned)
-        keywords = self.extract_keywords(cleaned)
+        normalized = normalize_text(question)
+        corrected = self.correct_spelling(normalized)
+        matches = self.automaton.find(corrected)
+        subject = self.detect_subject(corrected, matches)
+        question_type = self.classify_question_type(corrected, matches)
+        keywords = self.extract_keywords(normalized)
         
         return {
             'original': question,
             'cleaned': cleaned,
+            'normalized': normalized,
             'subject': subject,
             'question_type': question_type,
             'keywords': keywords
         }
     
-    def detect_subject(self, text: str) -> str:
-        subject_scores = {}
-        for subject, keywords in self.subject_keywords.items():
-            score = sum(1 for keyword in keywords if keyword in text)
-            subject_scores[subject] = score
+    def correct_spelling(self, normalized: str) -> str:
+        # Solo para detectar materia y tipo: cada palabra desconocida se reemplaza por la
+        # palabra clave más cercana (hasta FUZZY_MAX_DISTANCE ediciones), si la hay. Las
+        # palabras del corpus, las interrogativas y las vacías se dejan como están.
+        spelling = self.spelling
+        protected = self.protected_words
+        vocabulary = self.vocabulary_source() if self.vocabulary_source is not None else ()
+        return ' '.join(
+            word if word in protected or word in vocabulary else spelling.lookup(word) or word
+            for word in normalized.split()
+        )
+    
+    def detect_subject(self, text: str, matches: set = None) -> str:
+        automaton = self.automaton
+        if matches is None:
+            matches = automaton.find(text)
+        
+        subject_scores = {subject: 0 for subject in self.subject_keywords}
+        for pattern in matches:
+            for kind, label in automaton.labels[pattern]:
+                if kind == 'subject':
+                    subject_scores[label] += 1
         
         if subject_scores:
             best_subject = max(subject_scores, key=subject_scores.get)
@@ -86,26 +413,1130 @@ class SimpleNLPProcessor:
                 return best_subject
         return 'general'
     
-    def classify_question_type(self, text: str) -> str:
-        if any(word in text for word in ['que es', 'define', 'definicion', 'significa']):
-            return 'definition'
-        elif any(word in text for word in ['como', 'por que', 'explica', 'porque']):
-            return 'explanation'
-        elif any(word in text for word in ['calcula', 'resuelve', 'resultado', 'cuanto']):
-            return 'calculation'
-        elif any(word in text for word in ['diferencia', 'compara', 'versus']):
-            return 'comparison'
-        elif any(word in text for word in ['ejemplo', 'casos', 'muestra']):
-            return 'example'
+    def classify_question_type(self, text: str, matches: set = None) -> str:
+        automaton = self.automaton
+        if matches is None:
+            matches = automaton.find(text)
+        
+        matched_types = set()
+        for pattern in matches:
+            for kind, label in automaton.labels[pattern]:
+                if kind == 'question_type':
+                    matched_types.add(label)
+        
+        for question_type in self.question_type_keywords:
+            if question_type in matched_types:
+                return question_type
         return 'general'
     
     def extract_keywords(self, text: str) -> List[str]:
         words = text.split()
         return [word for word in words if len(word) > 3][:10]
 
+class BM25Ranker:
+    # Matriz dispersa término-documento (columnas comprimidas) con pesos BM25 precalculados;
+    # una consulta es la suma de las columnas de sus términos.
+    def __init__(self, k1: float = 1.5, b: float = 0.75, off_subject_penalty: float = 0.7):
+        self.k1 = k1
+        self.b = b
+        self.off_subject_penalty = off_subject_penalty
+        self.vocabulary = {}
+        self.doc_count = 0
+    
+    def fit(self, documents: List[str], subjects: List[str]):
+        postings = {}
+        doc_lengths = []
+        for position, text in enumerate(documents):
+            tokens = tokenize(text)
+            doc_lengths.append(len(tokens))
+            counts = {}
+            for token in tokens:
+                counts[token] = counts.get(token, 0) + 1
+            for token, tf in counts.items():
+                postings.setdefault(token, []).append((position, tf))
+        
+        self.doc_count = len(documents)
+        avg_length = (sum(doc_lengths) / self.doc_count) if self.doc_count else 0.0
+        self.subject_codes = {}
+        doc_subjects = [self.subject_codes.setdefault(subject, len(self.subject_codes)) for subject in subjects]
+        
+        self.vocabulary = {}
+        self.idf = []
+        indptr = [0]
+        indices = []
+        weights = []
+        for term, term_postings in postings.items():
+            self.vocabulary[term] = len(self.vocabulary)
+            df = len(term_postings)
+            idf = math.log(1 + (self.doc_count - df + 0.5) / (df + 0.5))
+            self.idf.append(idf)
+            for position, tf in term_postings:
+                norm = 1 - self.b + self.b * (doc_lengths[position] / avg_length if avg_length else 0)
+                indices.append(position)
+                weights.append(idf * tf * (self.k1 + 1) / (tf + self.k1 * norm))
+            indptr.append(len(indices))
+        
+        if np is not None:
+            self.indptr = np.asarray(indptr, dtype=np.int64)
+            self.indices = np.asarray(indices, dtype=np.int32)
+            self.weights = np.asarray(weights, dtype=np.float32)
+            self.doc_subjects = np.asarray(doc_subjects, dtype=np.int32)
+        else:
+            self.indptr = indptr
+            self.indices = indices
+            self.weights = weights
+            self.doc_subjects = doc_subjects
+    
+    def build_params(self) -> Dict:
+        return {'k1': self.k1, 'b': self.b}
+    
+    def snapshot_state(self) -> Tuple[Dict, Dict]:
+        # (metadatos JSON, arreglos: nombre -> (valores, código de tipo, forma))
+        vocabulary = sorted(self.vocabulary, key=self.vocabulary.get)
+        meta = {'doc_count': self.doc_count, 'vocabulary': vocabulary, 'subject_codes': self.subject_codes}
+        arrays = {
+            'indptr': (self.indptr, 'q', None),
+            'indices': (self.indices, 'i', None),
+            'weights': (self.weights, 'f', None),
+            'doc_subjects': (self.doc_subjects, 'i', None),
+            'idf': (self.idf, 'd', None)
+        }
+        return meta, arrays
+    
+    def restore_state(self, meta: Dict, arrays: Dict):
+        self.doc_count = meta['doc_count']
+        self.vocabulary = {term: term_id for term_id, term in enumerate(meta['vocabulary'])}
+        self.subject_codes = meta['subject_codes']
+        self.indptr = arrays['indptr']
+        self.indices = arrays['indices']
+        self.weights = arrays['weights']
+        self.doc_subjects = arrays['doc_subjects']
+        self.idf = arrays['idf']
+    
+    def query_terms(self, tokens: List[str]) -> List[int]:
+        return sorted({self.vocabulary[token] for token in tokens if token in self.vocabulary})
+    
+    def score_bound(self, tokens: List[str]) -> float:
+        # Los puntajes normalizados quedan en [0, 1); 0 si ningún término está en el vocabulario
+        return 1.0 if self.query_terms(tokens) else 0.0
+    
+    def upper_bound(self, term_ids: List[int]) -> float:
+        # Puntaje máximo alcanzable; normaliza la similitud al rango [0, 1)
+        return sum(self.idf[term_id] * (self.k1 + 1) for term_id in term_ids)
+    
+    def search_batch(self, queries: List[Tuple[str, List[str]]], top_k: int = 3) -> List[List[Tuple[float, int]]]:
+        if np is not None:
+            return self._search_batch_numpy(queries, top_k)
+        return [self._search_python(subject, tokens, top_k) for subject, tokens in queries]
+    
+    def _search_python(self, subject: str, tokens: List[str], top_k: int) -> List[Tuple[float, int]]:
+        term_ids = self.query_terms(tokens)
+        upper = self.upper_bound(term_ids)
+        if not upper:
+            return []
+        
+        scores = {}
+        for term_id in term_ids:
+            for i in range(self.indptr[term_id], self.indptr[term_id + 1]):
+                position = self.indices[i]
+                scores[position] = scores.get(position, 0.0) + self.weights[i]
+        
+        subject_code = self.subject_codes.get(subject, -1)
+        in_subject = [position for position in scores if self.doc_subjects[position] == subject_code]
+        # Igual que la búsqueda por palabras clave: otras materias solo si no alcanza top_k
+        if len(in_subject) >= top_k:
+            candidates = [(scores[position] / upper, position) for position in in_subject]
+        else:
+            candidates = [
+                (score / upper * (1 if self.doc_subjects[position] == subject_code else self.off_subject_penalty), position)
+                for position, score in scores.items()
+            ]
+        return heapq.nsmallest(top_k, candidates, key=lambda x: (-x[0], x[1]))
+    
+    def _search_batch_numpy(self, queries: List[Tuple[str, List[str]]], top_k: int) -> List[List[Tuple[float, int]]]:
+        results = []
+        # Bloques de consultas para acotar la matriz de puntajes (consultas x documentos)
+        chunk_size = max(1, 4_000_000 // max(self.doc_count, 1))
+        for start in range(0, len(queries), chunk_size):
+            chunk = queries[start:start + chunk_size]
+            rows, cols, vals = [], [], []
+            uppers = np.zeros(len(chunk), dtype=np.float32)
+            subject_codes = np.full(len(chunk), -1, dtype=np.int32)
+            for row, (subject, tokens) in enumerate(chunk):
+                term_ids = self.query_terms(tokens)
+                uppers[row] = self.upper_bound(term_ids)
+                subject_codes[row] = self.subject_codes.get(subject, -1)
+                for term_id in term_ids:
+                    begin, end = self.indptr[term_id], self.indptr[term_id + 1]
+                    rows.append(np.full(end - begin, row, dtype=np.int32))
+                    cols.append(self.indices[begin:end])
+                    vals.append(self.weights[begin:end])
+            
+            scores = np.zeros((len(chunk), self.doc_count), dtype=np.float32)
+            if rows:
+                np.add.at(scores, (np.concatenate(rows), np.concatenate(cols)), np.concatenate(vals))
+            scores /= np.where(uppers > 0, uppers, 1)[:, None]
+            
+            in_subject = self.doc_subjects[None, :] == subject_codes[:, None]
+            subject_hits = np.count_nonzero((scores > 0) & in_subject, axis=1)
+            penalties = np.where(in_subject, np.float32(1), np.float32(self.off_subject_penalty))
+            penalties[subject_hits >= top_k] = in_subject[subject_hits >= top_k]
+            scores *= penalties
+            
+            for row_scores in scores:
+                results.append(self._top_k(row_scores, top_k))
+        return results
+    
+    def _top_k(self, row_scores, top_k: int) -> List[Tuple[float, int]]:
+        hits = np.count_nonzero(row_scores > 0)
+        k = min(top_k, hits)
+        if k == 0:
+            return []
+        # Selección parcial en lugar de ordenar todo el corpus
+        if k < len(row_scores):
+            candidates = np.argpartition(-row_scores, k - 1)[:k]
+        else:
+            candidates = np.arange(len(row_scores))
+        order = np.lexsort((candidates, -row_scores[candidates]))
+        return [(float(row_scores[candidates[i]]), int(candidates[i])) for i in order]
+
+class HashedNgramEncoder:
+    # Vectores densos sin modelo: n-gramas de caracteres de cada palabra, proyectados
+    # con hashing (crc32 es estable entre procesos, a diferencia de hash()) y normalizados.
+    def __init__(self, dimensions: int = 256, ngram_sizes: Tuple[int, ...] = (3, 4)):
+        self.dimensions = dimensions
+        self.ngram_sizes = ngram_sizes
+        self.idf = None
+        self.token_features = {}
+    
+    def features(self, token: str) -> Tuple[List[int], List[float]]:
+        cached = self.token_features.get(token)
+        if cached is None:
+            padded = f' {token} '
+            buckets, signs = [], []
+            for size in self.ngram_sizes:
+                for i in range(max(1, len(padded) - size + 1)):
+                    h = zlib.crc32(padded[i:i + size].encode('utf-8'))
+                    buckets.append((h >> 1) % self.dimensions)
+                    signs.append(1.0 if h & 1 else -1.0)
+            cached = (buckets, signs)
+            if len(self.token_features) < 200_000:
+                self.token_features[token] = cached
+        return cached
+    
+    def encode(self, token_lists: List[List[str]]):
+        # Cada palabra distinta se proyecta una sola vez (tabla vocabulario x dimensiones);
+        # luego cada fila es la suma ponderada de las filas de sus palabras.
+        vocabulary = {}
+        pair_rows, pair_tokens, pair_weights = [], [], []
+        for row, tokens in enumerate(token_lists):
+            counts = {}
+            for token in tokens:
+                counts[token] = counts.get(token, 0) + 1
+            for token, tf in counts.items():
+                pair_rows.append(row)
+                pair_tokens.append(vocabulary.setdefault(token, len(vocabulary)))
+                pair_weights.append(1 + math.log(tf))
+        
+        cells, signs = [], []
+        for token, token_id in vocabulary.items():
+            token_buckets, token_signs = self.features(token)
+            offset = token_id * self.dimensions
+            cells.extend(offset + bucket for bucket in token_buckets)
+            signs.extend(token_signs)
+        table = np.bincount(
+            np.asarray(cells, dtype=np.int64), weights=np.asarray(signs),
+            minlength=len(vocabulary) * self.dimensions
+        ).astype(np.float32).reshape(len(vocabulary), self.dimensions)
+        
+        matrix = np.zeros((len(token_lists), self.dimensions), dtype=np.float32)
+        pair_rows = np.asarray(pair_rows, dtype=np.int64)
+        pair_tokens = np.asarray(pair_tokens, dtype=np.int64)
+        pair_weights = np.asarray(pair_weights, dtype=np.float32)
+        # Por bloques para acotar la memoria temporal (pares x dimensiones)
+        for start in range(0, len(pair_rows), 65536):
+            rows = pair_rows[start:start + 65536]
+            contributions = table[pair_tokens[start:start + 65536]] * pair_weights[start:start + 65536, None]
+            boundaries = np.flatnonzero(np.r_[True, rows[1:] != rows[:-1]])
+            matrix[rows[boundaries]] += np.add.reduceat(contributions, boundaries, axis=0)
+        if self.idf is None:
+            # Peso por dimensión: los n-gramas comunes ("cion", " la") aportan poco
+            df = np.count_nonzero(matrix, axis=0)
+            self.idf = np.log(1 + len(token_lists) / (1 + df)).astype(np.float32)
+        matrix *= self.idf
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        matrix /= np.where(norms > 0, norms, 1)
+        return matrix
+
+class DenseRanker:
+    # Similitud coseno sobre una matriz float32 contigua (documentos x dimensiones).
+    # Con pocos documentos se recorre toda la matriz; a partir de ivf_min_docs se agrupa
+    # con k-means (IVF) y cada consulta solo visita las `probes` listas más cercanas,
+    # así el costo crece con ~sqrt(n) en lugar de n.
+    def __init__(self, dimensions: int = 256, probes: int = 16, min_similarity: float = 0.2,
+                 off_subject_penalty: float = 0.7, ivf_min_docs: int = 2048):
+        self.encoder = HashedNgramEncoder(dimensions)
+        self.probes = probes
+        self.min_similarity = min_similarity
+        self.off_subject_penalty = off_subject_penalty
+        self.ivf_min_docs = ivf_min_docs
+        self.doc_count = 0
+        self.centroids = None
+    
+    def fit(self, documents: List[str], subjects: List[str]):
+        matrix = self.encoder.encode([tokenize(text) for text in documents])
+        self.doc_count = len(documents)
+        self.subject_codes = {}
+        doc_subjects = np.asarray(
+            [self.subject_codes.setdefault(subject, len(self.subject_codes)) for subject in subjects], dtype=np.int32
+        )
+        
+        if self.doc_count < self.ivf_min_docs:
+            self.matrix = matrix
+            self.positions = np.arange(self.doc_count, dtype=np.int64)
+            self.doc_subjects = doc_subjects
+            return
+        
+        centroids, assignments = self.train_kmeans(matrix, int(math.sqrt(self.doc_count)))
+        # Filas ordenadas por lista: cada lista es un bloque contiguo de la matriz
+        order = np.argsort(assignments, kind='stable')
+        self.matrix = np.ascontiguousarray(matrix[order])
+        self.positions = order.astype(np.int64)
+        self.doc_subjects = doc_subjects[order]
+        self.list_offsets = np.searchsorted(assignments[order], np.arange(len(centroids) + 1))
+        self.centroids = centroids
+    
+    def score_bound(self, tokens: List[str]) -> float:
+        return 1.0 if self.doc_count and tokens else 0.0
+    
+    def build_params(self) -> Dict:
+        return {
+            'dimensions': self.encoder.dimensions,
+            'ngram_sizes': list(self.encoder.ngram_sizes),
+            'ivf_min_docs': self.ivf_min_docs
+        }
+    
+    def snapshot_state(self) -> Tuple[Dict, Dict]:
+        meta = {'doc_count': self.doc_count, 'subject_codes': self.subject_codes}
+        arrays = {
+            'idf': (self.encoder.idf, 'f', None),
+            'matrix': (self.matrix, 'f', list(self.matrix.shape)),
+            'positions': (self.positions, 'q', None),
+            'doc_subjects': (self.doc_subjects, 'i', None)
+        }
+        if self.centroids is not None:
+            arrays['centroids'] = (self.centroids, 'f', list(self.centroids.shape))
+            arrays['list_offsets'] = (self.list_offsets, 'q', None)
+        return meta, arrays
+    
+    def restore_state(self, meta: Dict, arrays: Dict):
+        self.doc_count = meta['doc_count']
+        self.subject_codes = meta['subject_codes']
+        self.encoder.idf = arrays['idf']
+        self.matrix = arrays['matrix']
+        self.positions = arrays['positions']
+        self.doc_subjects = arrays['doc_subjects']
+        self.centroids = arrays.get('centroids')
+        self.list_offsets = arrays.get('list_offsets')
+    
+    def train_kmeans(self, matrix, lists: int, iterations: int = 10, sample_per_list: int = 64):
+        # k-means esférico sobre una muestra; semilla fija para que el índice sea reproducible
+        rng = np.random.default_rng(0)
+        sample_size = min(len(matrix), lists * sample_per_list)
+        sample = matrix[rng.choice(len(matrix), sample_size, replace=False)]
+        centroids = sample[rng.choice(sample_size, lists, replace=False)].copy()
+        for _ in range(iterations):
+            assignments = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, sample)
+            empty = ~np.any(sums, axis=1)
+            sums[empty] = sample[rng.choice(sample_size, int(empty.sum()))]
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            centroids = sums / np.where(norms > 0, norms, 1)
+        
+        assignments = np.empty(len(matrix), dtype=np.int64)
+        for start in range(0, len(matrix), 65536):
+            block = matrix[start:start + 65536]
+            assignments[start:start + 65536] = np.argmax(block @ centroids.T, axis=1)
+        return centroids.astype(np.float32), assignments
+    
+    def search_batch(self, queries: List[Tuple[str, List[str]]], top_k: int = 3) -> List[List[Tuple[float, int]]]:
+        # Los tokens se deduplican: el puntaje depende solo del conjunto (query_signature)
+        vectors = self.encoder.encode([sorted(set(tokens)) for _, tokens in queries])
+        if self.centroids is None:
+            scores = vectors @ self.matrix.T
+            return [self._rank(subject, scores[row], None, top_k) for row, (subject, _) in enumerate(queries)]
+        
+        probes = min(self.probes, len(self.centroids))
+        nearest = np.argpartition(-(vectors @ self.centroids.T), probes - 1, axis=1)[:, :probes]
+        results = []
+        for row, (subject, _) in enumerate(queries):
+            rows = np.concatenate([
+                np.arange(self.list_offsets[i], self.list_offsets[i + 1]) for i in nearest[row]
+            ])
+            results.append(self._rank(subject, self.matrix[rows] @ vectors[row], rows, top_k))
+        return results
+    
+    def _rank(self, subject: str, scores, rows, top_k: int) -> List[Tuple[float, int]]:
+        if rows is None:
+            rows = np.arange(len(scores))
+        hits = scores >= self.min_similarity
+        scores, rows = scores[hits], rows[hits]
+        if not len(scores):
+            return []
+        
+        # Mismo refuerzo de materia que los otros backends: las demás materias
+        # solo compiten (penalizadas) si la materia detectada no alcanza top_k
+        in_subject = self.doc_subjects[rows] == self.subject_codes.get(subject, -1)
+        if np.count_nonzero(in_subject) >= top_k:
+            scores, rows = scores[in_subject], rows[in_subject]
+        else:
+            scores = scores * np.where(in_subject, np.float32(1), np.float32(self.off_subject_penalty))
+        
+        positions = self.positions[rows]
+        k = min(top_k, len(scores))
+        if k < len(scores):
+            candidates = np.argpartition(-scores, k - 1)[:k]
+        else:
+            candidates = np.arange(len(scores))
+        order = np.lexsort((positions[candidates], -scores[candidates]))
+        return [(float(scores[candidates[i]]), int(positions[candidates[i]])) for i in order]
+
+def add_entry_words(words: set, entry: Mapping):
+    # Palabras válidas de una entrada (tema, contenido y palabras clave), ya normalizadas
+    words.update(entry.get('keywords', ()))
+    words.update(normalize_text(f"{entry.get('topic', '')} {entry.get('content', '')}").split())
+
+def corpus_vocabulary(knowledge_data: Dict[str, List[Mapping]]) -> frozenset:
+    words = set()
+    for entries in knowledge_data.values():
+        for entry in entries:
+            add_entry_words(words, entry)
+    return frozenset(words)
+
+class LazyEntry(Mapping):
+    # Entrada del corpus externo: id/topic/keywords quedan en memoria y 'content'
+    # se lee bajo demanda desde el archivo mapeado en memoria.
+    __slots__ = ('fields', 'segment', 'offset', 'length')
+    
+    def __init__(self, fields: Dict, segment: 'KnowledgeSegment', offset: int, length: int):
+        self.fields = fields
+        self.segment = segment
+        self.offset = offset
+        self.length = length
+    
+    def __getitem__(self, key):
+        if key == 'content':
+            return self.segment.read_content(self.offset, self.length)
+        return self.fields[key]
+    
+    def __iter__(self):
+        yield from self.fields
+        yield 'content'
+    
+    def __len__(self):
+        return len(self.fields) + 1
+    
+    def copy(self) -> Dict:
+        return dict(self)
+
+class KnowledgeSegment:
+    # Un archivo JSONL del corpus. Los archivos deben reemplazarse con un rename atómico:
+    # truncar un archivo mapeado invalida las lecturas pendientes.
+    def __init__(self, path: str, default_subject: str):
+        self.path = path
+        self.default_subject = default_subject
+        stat = os.stat(path)
+        self.signature = (stat.st_mtime_ns, stat.st_size)
+        self.entries = []  # (materia, LazyEntry)
+        self.vocabulary = frozenset()
+        self.mmap = None
+        if stat.st_size == 0:
+            return
+        
+        with open(path, 'rb') as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        
+        # Las palabras del archivo se reúnen al leerlo, así una recarga solo procesa los archivos modificados
+        words = set()
+        offset = 0
+        size = len(self.mmap)
+        while offset < size:
+            newline = self.mmap.find(b'\n', offset)
+            line_end = newline if newline != -1 else size
+            line = self.mmap[offset:line_end]
+            if line.strip():
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    app.logger.warning(f"Invalid line in {path} (byte {offset})")
+                else:
+                    add_entry_words(words, record)
+                    record.pop('content', None)
+                    subject = record.pop('subject', self.default_subject)
+                    self.entries.append((subject, LazyEntry(record, self, offset, line_end - offset)))
+            offset = line_end + 1
+        self.vocabulary = frozenset(words)
+    
+    def read_content(self, offset: int, length: int) -> str:
+        return json.loads(self.mmap[offset:offset + length]).get('content', '')
+
+class KnowledgeSource:
+    # Archivo JSONL o directorio de archivos *.jsonl (el nombre del archivo es la materia por defecto)
+    def __init__(self, path: str):
+        self.path = path
+        self.segments = {}
+    
+    def list_files(self) -> List[str]:
+        if os.path.isdir(self.path):
+            return sorted(
+                os.path.join(self.path, name) for name in os.listdir(self.path)
+                if name.endswith('.jsonl')
+            )
+        return [self.path]
+    
+    def signatures(self) -> Dict[str, Tuple[int, int]]:
+        signatures = {}
+        for path in self.list_files():
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            signatures[path] = (stat.st_mtime_ns, stat.st_size)
+        return signatures
+    
+    def refresh(self) -> bool:
+        # Vuelve a leer solo los archivos nuevos o modificados
+        changed = False
+        segments = {}
+        for path in self.list_files():
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            segment = self.segments.get(path)
+            if segment is None or segment.signature != (stat.st_mtime_ns, stat.st_size):
+                default_subject = os.path.splitext(os.path.basename(path))[0]
+                segment = KnowledgeSegment(path, default_subject)
+                changed = True
+            segments[path] = segment
+        if segments.keys() != self.segments.keys():
+            changed = True
+        self.segments = segments
+        return changed
+    
+    def vocabulary(self) -> frozenset:
+        return frozenset().union(*(segment.vocabulary for segment in self.segments.values()))
+    
+    def knowledge_data(self) -> Dict[str, List[Mapping]]:
+        knowledge_data = {}
+        for segment in self.segments.values():
+            for subject, entry in segment.entries:
+                knowledge_data.setdefault(subject, []).append(entry)
+        return knowledge_data
+
+def make_ranker(ranking_backend: str):
+    # Ranker sin entrenar para el backend pedido (None: Jaccard sobre palabras clave)
+    if ranking_backend == 'bm25':
+        return BM25Ranker()
+    if ranking_backend == 'dense':
+        if np is None:
+            app.logger.warning("The 'dense' backend requires NumPy; falling back to 'keyword'")
+            return None
+        return DenseRanker(
+            dimensions=int(os.getenv('DENSE_DIMENSIONS', '256')),
+            probes=int(os.getenv('DENSE_PROBES', '16')),
+            min_similarity=float(os.getenv('DENSE_MIN_SIMILARITY', '0.2'))
+        )
+    if ranking_backend != 'keyword':
+        raise ValueError(f"Backend de ranking desconocido: {ranking_backend}")
+    return None
+
+def correct_keywords(spelling: SymSpellIndex, keywords: List[str], vocabulary: frozenset) -> List[str]:
+    # Solo se corrigen las palabras que no están en el corpus ni son palabras vacías
+    return [
+        keyword if keyword in vocabulary or keyword in SPELLING_STOPWORDS else spelling.lookup(keyword) or keyword
+        for keyword in keywords
+    ]
+
+class KnowledgeIndex:
+    # Vista inmutable del corpus y sus índices. Se construye completa y luego se publica
+    # con una sola asignación, así ninguna búsqueda ve un índice a medio construir.
+    def __init__(self, knowledge_data: Dict[str, List[Mapping]], ranking_backend: str, version: int,
+                 snapshot: 'KnowledgeSnapshot' = None, spelling: bool = True, vocabulary: frozenset = None):
+        self.knowledge_data = knowledge_data
+        self.version = version
+        self.content_vocabulary = None
+        self.vocabulary_lock = threading.Lock()
+        
+        if snapshot is not None:
+            # Índices precompilados, respaldados por el archivo mapeado en memoria
+            self.entries = snapshot.entries
+            self.keyword_index = snapshot.keyword_index
+            self.ranker = snapshot.ranker
+            self.content_vocabulary = snapshot.vocabulary()
+            self.spelling = SymSpellIndex(
+                self.keyword_index, FUZZY_MAX_DISTANCE, deletes=snapshot.spelling_deletes()
+            )
+            return
+        
+        # Índice invertido: palabra clave -> posiciones de las entradas que la contienen.
+        # Las posiciones siguen el orden de knowledge_data para conservar el desempate original.
+        self.entries = []
+        self.keyword_index = {}
+        for subject, entries in knowledge_data.items():
+            for entry in entries:
+                position = len(self.entries)
+                keyword_set = frozenset(entry['keywords'])
+                self.entries.append((subject, entry, keyword_set))
+                for keyword in keyword_set:
+                    self.keyword_index.setdefault(keyword, []).append(position)
+        
+        # Sin corrector cuando las palabras ya llegan corregidas (materias de un índice particionado).
+        # El vocabulario y los borrados se preparan aquí, antes de publicar el índice, y no
+        # en la primera búsqueda
+        self.spelling = None
+        if spelling:
+            self.content_vocabulary = vocabulary if vocabulary is not None else corpus_vocabulary(knowledge_data)
+            self.spelling = SymSpellIndex.shared(self.keyword_index, FUZZY_MAX_DISTANCE)
+            self.spelling.build_deletes()
+        self.ranker = make_ranker(ranking_backend)
+        if self.ranker is not None:
+            self.ranker.fit(
+                [f"{entry['topic']} {entry['content']}" for _, entry, _ in self.entries],
+                [subject for subject, _, _ in self.entries]
+            )
+    
+    def search(self, processed_question: Dict, top_k: int = 3) -> List[Dict]:
+        if self.ranker is not None:
+            return self.search_batch([processed_question], top_k)[0]
+        
+        subject = processed_question.get('subject', 'general')
+        query = self.query_keywords(processed_question)
+        
+        if not query:
+            return []
+        
+        # Contar coincidencias solo en las entradas que comparten alguna palabra clave
+        common_counts = {}
+        for keyword in query:
+            for position in self.keyword_index.get(keyword, ()):
+                common_counts[position] = common_counts.get(position, 0) + 1
+        
+        main_results = []
+        other_results = []
+        for position in sorted(common_counts):
+            entry_subject, _, keyword_set = self.entries[position]
+            common = common_counts[position]
+            # Jaccard: |A ∩ B| / |A ∪ B|
+            score = common / (len(query) + len(keyword_set) - common)
+            if entry_subject == subject:
+                main_results.append((score, position))
+            else:
+                other_results.append((score * 0.7, position))  # Penalizar por no ser la materia principal
+        
+        # Las otras materias solo cuentan si la materia detectada no alcanza top_k
+        candidates = main_results
+        if len(main_results) < top_k:
+            candidates = main_results + other_results
+        
+        return [self.make_result(score, position)
+                for score, position in heapq.nlargest(top_k, candidates, key=lambda x: x[0])]
+    
+    def search_batch(self, processed_questions: List[Dict], top_k: int = 3) -> List[List[Dict]]:
+        if self.ranker is None:
+            return [self.search(processed_question, top_k) for processed_question in processed_questions]
+        
+        queries = [
+            (processed_question.get('subject', 'general'), self.query_tokens(processed_question))
+            for processed_question in processed_questions
+        ]
+        return [
+            [self.make_result(score, position) for score, position in ranked]
+            for ranked in self.ranker.search_batch(queries, top_k)
+        ]
+    
+    def vocabulary(self) -> frozenset:
+        # Palabras del corpus (tema, contenido y palabras clave) ya normalizadas; no se corrigen.
+        # Los índices sin corrector lo calculan recién si se pide
+        if self.content_vocabulary is None:
+            with self.vocabulary_lock:
+                if self.content_vocabulary is None:
+                    self.content_vocabulary = corpus_vocabulary(self.knowledge_data)
+        return self.content_vocabulary
+    
+    def query_keywords(self, processed_question: Dict) -> set:
+        # Palabras mal escritas se comparan con la palabra clave más cercana del corpus
+        keywords = processed_question.get('keywords', [])
+        if self.spelling is None:
+            return set(keywords)
+        return set(correct_keywords(self.spelling, keywords, self.vocabulary()))
+    
+    def score_bound(self, processed_question: Dict) -> float:
+        # Similitud máxima (sin penalizar) que puede alcanzar alguna entrada de este índice
+        if self.ranker is not None:
+            return self.ranker.score_bound(self.query_tokens(processed_question))
+        query = self.query_keywords(processed_question)
+        if not query:
+            return 0.0
+        # Jaccard ≤ |q ∩ vocabulario| / |q|, porque |q ∪ K| ≥ |q|
+        return sum(1 for keyword in query if keyword in self.keyword_index) / len(query)
+    
+    def query_tokens(self, processed_question: Dict) -> List[str]:
+        normalized = processed_question.get('normalized')
+        if normalized is not None:
+            return [token for token in normalized.split() if len(token) > 2]
+        return tokenize(processed_question.get('cleaned') or ' '.join(processed_question.get('keywords', [])))
+    
+    def query_signature(self, processed_question: Dict) -> frozenset:
+        # Términos de los que depende el ranking (sin orden ni repeticiones)
+        if self.ranker is None:
+            return frozenset(processed_question.get('keywords', []))
+        return frozenset(self.query_tokens(processed_question))
+    
+    def make_result(self, score: float, position: int) -> Dict:
+        entry_subject, entry, _ = self.entries[position]
+        result = entry.copy()
+        result['subject'] = entry_subject
+        result['similarity'] = score
+        return result
+
+# Índices de las materias atendidas en procesos aparte. Se registran justo antes del fork
+# para que el proceso hijo los herede sin serializarlos.
+FORKED_SHARDS = {}
+
+def search_forked_shard(key: Tuple, processed_questions: List[Dict], top_k: int) -> List[List[Dict]]:
+    return FORKED_SHARDS[key].search_batch(processed_questions, top_k)
+
+class KnowledgeShard:
+    # Una materia del corpus con su propio índice. Las materias muy grandes pueden
+    # atenderse en un proceso dedicado para buscar en paralelo sin el GIL.
+    def __init__(self, subject: str, entries: List[Mapping], ranking_backend: str, version: int,
+                 use_process: bool = False):
+        self.subject = subject
+        self.entries = entries
+        self.index = KnowledgeIndex({subject: entries}, ranking_backend, version, spelling=False)
+        self.process_key = None
+        self.process_pool = None
+        if use_process:
+            self.start_process()
+    
+    def start_process(self):
+        try:
+            context = multiprocessing.get_context('fork')
+        except ValueError:
+            app.logger.warning(f"fork is not available on this platform; searching subject {self.subject} in threads")
+            return
+        key = (self.subject, id(self))
+        FORKED_SHARDS[key] = self.index
+        try:
+            pool = ProcessPoolExecutor(max_workers=1, mp_context=context)
+            pool.submit(int).result()  # fuerza el fork mientras el índice está registrado
+        finally:
+            del FORKED_SHARDS[key]
+        self.process_key = key
+        self.process_pool = pool
+    
+    def same_entries(self, entries: List[Mapping]) -> bool:
+        # Los segmentos sin cambios conservan sus objetos, así que basta comparar identidades
+        return len(entries) == len(self.entries) and all(a is b for a, b in zip(entries, self.entries))
+    
+    def search_batch(self, processed_questions: List[Dict], top_k: int) -> List[List[Dict]]:
+        if self.process_pool is not None:
+            try:
+                return self.process_pool.submit(
+                    search_forked_shard, self.process_key, processed_questions, top_k
+                ).result()
+            except RuntimeError:
+                # Proceso caído o ya retirado por una recarga: se busca en este proceso
+                pass
+        return self.index.search_batch(processed_questions, top_k)
+    
+    def close(self):
+        if self.process_pool is not None:
+            self.process_pool.shutdown(wait=False)
+            self.process_pool = None
+
+class ShardedKnowledgeIndex:
+    # Corpus particionado por materia. Primero se busca en la materia detectada; las demás
+    # solo si no alcanza top_k, en tandas paralelas ordenadas por su cota y con corte
+    # temprano cuando el k-ésimo puntaje ya supera la mejor cota restante.
+    def __init__(self, knowledge_data: Dict[str, List[Mapping]], ranking_backend: str, version: int,
+                 previous: 'ShardedKnowledgeIndex' = None, executor: ThreadPoolExecutor = None,
+                 fanout: int = 1, process_min_entries: int = 0, off_subject_penalty: float = 0.7,
+                 vocabulary: frozenset = None):
+        self.knowledge_data = knowledge_data
+        self.version = version
+        self.executor = executor
+        self.fanout = max(1, fanout)
+        self.off_subject_penalty = off_subject_penalty
+        
+        # Las materias sin cambios reutilizan el índice de la versión anterior
+        previous_shards = previous.shards if previous is not None else {}
+        self.shards = {}
+        self.rebuilt = []
+        for subject, entries in knowledge_data.items():
+            shard = previous_shards.get(subject)
+            if shard is None or not shard.same_entries(entries):
+                use_process = 0 < process_min_entries <= len(entries)
+                shard = KnowledgeShard(subject, entries, ranking_backend, version, use_process)
+                self.rebuilt.append(subject)
+            self.shards[subject] = shard
+        # El orden de las materias reproduce el desempate del índice único
+        self.order = {subject: order for order, subject in enumerate(self.shards)}
+        # La corrección ortográfica usa el vocabulario de todas las materias, como el índice único
+        self.spelling = SymSpellIndex.shared(
+            {keyword for shard in self.shards.values() for keyword in shard.index.keyword_index}, FUZZY_MAX_DISTANCE
+        )
+        self.spelling.build_deletes()
+        self.empty_index = KnowledgeIndex({}, ranking_backend, version) if not self.shards else None
+        self.content_vocabulary = vocabulary if vocabulary is not None else corpus_vocabulary(knowledge_data)
+    
+    def vocabulary(self) -> frozenset:
+        return self.content_vocabulary
+    
+    def retire(self, replacement: 'ShardedKnowledgeIndex'):
+        # Libera los procesos de las materias que la nueva versión ya no usa
+        for subject, shard in self.shards.items():
+            if replacement.shards.get(subject) is not shard:
+                shard.close()
+    
+    def search(self, processed_question: Dict, top_k: int = 3) -> List[Dict]:
+        return self.search_batch([processed_question], top_k)[0]
+    
+    def search_batch(self, processed_questions: List[Dict], top_k: int = 3) -> List[List[Dict]]:
+        spelling = self.spelling
+        vocabulary = self.vocabulary()
+        processed_questions = [
+            dict(processed_question, keywords=correct_keywords(
+                spelling, processed_question.get('keywords', []), vocabulary
+            ))
+            for processed_question in processed_questions
+        ]
+        # Candidatos por consulta: ((-similitud, rango de materia, rango en la materia), resultado)
+        candidates = [[] for _ in processed_questions]
+        
+        groups = {}
+        for i, processed_question in enumerate(processed_questions):
+            subject = processed_question.get('subject', 'general')
+            if subject in self.shards:
+                groups.setdefault(subject, []).append(i)
+        self.search_groups(groups, processed_questions, top_k, candidates, penalized=False)
+        
+        # Otras materias, por cota decreciente, solo para las consultas que no llegaron a top_k
+        penalty = self.off_subject_penalty
+        pending = {}
+        for i, processed_question in enumerate(processed_questions):
+            if len(candidates[i]) >= top_k:
+                continue
+            subject = processed_question.get('subject', 'general')
+            bounds = []
+            for other, shard in self.shards.items():
+                if other != subject:
+                    bound = shard.index.score_bound(processed_question) * penalty
+                    if bound > 0:
+                        bounds.append((bound, self.order[other], other))
+            bounds.sort(key=lambda item: (-item[0], item[1]))
+            pending[i] = bounds
+        
+        while pending:
+            groups = {}
+            for i, bounds in pending.items():
+                for _, _, other in bounds[:self.fanout]:
+                    groups.setdefault(other, []).append(i)
+                del bounds[:self.fanout]
+            self.search_groups(groups, processed_questions, top_k, candidates, penalized=True)
+            
+            for i in list(pending):
+                bounds = pending[i]
+                ranked = candidates[i]
+                ranked.sort(key=lambda item: item[0])
+                # Estrictamente mayor: con empate podría ganar una materia anterior aún no consultada
+                if not bounds or (len(ranked) >= top_k and -ranked[top_k - 1][0][0] > bounds[0][0]):
+                    del pending[i]
+        
+        results = []
+        for ranked in candidates:
+            ranked.sort(key=lambda item: item[0])
+            results.append([result for _, result in ranked[:top_k]])
+        return results
+    
+    def search_groups(self, groups: Dict[str, List[int]], processed_questions: List[Dict], top_k: int,
+                      candidates: List[List], penalized: bool):
+        def run(item):
+            subject, positions = item
+            # Dentro de su materia todas las entradas cuentan como materia principal
+            shard_questions = [dict(processed_questions[i], subject=subject) for i in positions]
+            return subject, positions, self.shards[subject].search_batch(shard_questions, top_k)
+        
+        if self.executor is not None and len(groups) > 1:
+            found = list(self.executor.map(run, groups.items()))
+        else:
+            found = [run(item) for item in groups.items()]
+        
+        for subject, positions, relevant in found:
+            shard_rank = 1 + self.order[subject] if penalized else 0
+            for i, results in zip(positions, relevant):
+                for rank, result in enumerate(results):
+                    if penalized:
+                        result['similarity'] = result['similarity'] * self.off_subject_penalty
+                    candidates[i].append(((-result['similarity'], shard_rank, rank), result))
+    
+    def query_signature(self, processed_question: Dict) -> frozenset:
+        for shard in self.shards.values():
+            return shard.index.query_signature(processed_question)
+        return self.empty_index.query_signature(processed_question)
+
+SNAPSHOT_MAGIC = b'EDUKBSNP'
+SNAPSHOT_FORMAT_VERSION = 3
+SNAPSHOT_ALIGNMENT = 64
+SNAPSHOT_DTYPES = {'B': 'u1', 'i': '<i4', 'q': '<i8', 'Q': '<u8', 'f': '<f4', 'd': '<f8'}
+
+class PostingsIndex(Mapping):
+    # Índice invertido de palabras clave sobre el snapshot: las posiciones de cada
+    # palabra son un tramo de un arreglo mapeado en memoria (sin copiar).
+    def __init__(self, keywords: List[str], indptr, positions):
+        self.keyword_ids = {keyword: keyword_id for keyword_id, keyword in enumerate(keywords)}
+        self.indptr = indptr
+        self.positions = positions
+    
+    def __getitem__(self, keyword):
+        keyword_id = self.keyword_ids[keyword]
+        return self.positions[self.indptr[keyword_id]:self.indptr[keyword_id + 1]]
+    
+    def __iter__(self):
+        return iter(self.keyword_ids)
+    
+    def __len__(self):
+        return len(self.keyword_ids)
+
+def variant_hash(variant: str) -> int:
+    return int.from_bytes(hashlib.blake2b(variant.encode('utf-8'), digest_size=8).digest(), 'little')
+
+class SnapshotDeletes:
+    # Diccionario de borrados de SymSpell sobre el snapshot: hashes de 64 bits de las
+    # variantes (ordenados) y, por hash, un tramo de ids de palabras clave. No se copia a
+    # memoria; una colisión solo agrega candidatos que lookup descarta por distancia.
+    def __init__(self, terms: List[str], hashes, indptr, term_ids):
+        self.terms = terms
+        self.hashes = hashes
+        self.indptr = indptr
+        self.term_ids = term_ids
+    
+    def get(self, variant: str):
+        key = variant_hash(variant)
+        position = bisect.bisect_left(self.hashes, key)
+        if position == len(self.hashes) or self.hashes[position] != key:
+            return None
+        return [self.terms[term_id] for term_id in self.term_ids[self.indptr[position]:self.indptr[position + 1]]]
+
+class KnowledgeSnapshot:
+    # Archivo binario versionado con el corpus procesado y sus índices. Los arreglos se
+    # leen directamente del mmap, así varios procesos comparten las mismas páginas.
+    # Formato: MAGIC, versión y largo de la cabecera (<II), cabecera JSON y secciones
+    # alineadas a SNAPSHOT_ALIGNMENT bytes.
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mmap[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+            raise ValueError('not a knowledge base snapshot')
+        format_version, header_length = struct.unpack_from('<II', self.mmap, len(SNAPSHOT_MAGIC))
+        if format_version != SNAPSHOT_FORMAT_VERSION:
+            raise ValueError(f'format version {format_version}, expected {SNAPSHOT_FORMAT_VERSION}')
+        header_start = len(SNAPSHOT_MAGIC) + 8
+        self.header = json.loads(self.mmap[header_start:header_start + header_length])
+        self.data_start = snapshot_align(header_start + header_length)
+        self.ranker = None
+        
+        self.entries = []
+        self.knowledge_data = {}
+        for subject, fields, offset, length in json.loads(self.section_bytes('entries')):
+            entry = LazyEntry(fields, self, offset, length)
+            self.entries.append((subject, entry, frozenset(fields['keywords'])))
+            self.knowledge_data.setdefault(subject, []).append(entry)
+        self.keywords = json.loads(self.section_bytes('keywords'))
+        self.keyword_index = PostingsIndex(self.keywords, self.array('postings_indptr'), self.array('postings'))
+    
+    def vocabulary(self) -> frozenset:
+        return frozenset(json.loads(self.section_bytes('vocabulary')))
+    
+    def spelling_deletes(self) -> SnapshotDeletes:
+        return SnapshotDeletes(
+            self.keywords, self.array('deletes_hashes'), self.array('deletes_indptr'), self.array('deletes_terms')
+        )
+    
+    def section_bytes(self, name: str) -> bytes:
+        offset, length, _, _ = self.header['sections'][name]
+        start = self.data_start + offset
+        return self.mmap[start:start + length]
+    
+    def array(self, name: str):
+        offset, length, typecode, shape = self.header['sections'][name]
+        start = self.data_start + offset
+        if np is not None:
+            dtype = np.dtype(SNAPSHOT_DTYPES[typecode])
+            values = np.frombuffer(self.mmap, dtype=dtype, count=length // dtype.itemsize, offset=start)
+            return values.reshape(shape) if shape else values
+        return memoryview(self.mmap)[start:start + length].cast(typecode)
+    
+    def read_content(self, offset: int, length: int) -> str:
+        start = self.data_start + self.header['sections']['content'][0] + offset
+        return self.mmap[start:start + length].decode('utf-8')
+    
+    def stale_reason(self, fingerprint: str, ranker) -> str:
+        # Motivo por el que el snapshot no sirve para esta configuración ('' si sirve).
+        # Va a los logs, así que se redacta en inglés como el resto de mensajes de log
+        if self.header['fingerprint'] != fingerprint:
+            return 'corpus changed'
+        ranker_name = type(ranker).__name__ if ranker is not None else None
+        if self.header['ranker'] != ranker_name:
+            return f"ranker {self.header['ranker'] or 'keyword'}, expected {ranker_name or 'keyword'}"
+        if ranker is not None and self.header['ranker_params'] != json.loads(json.dumps(ranker.build_params())):
+            return 'ranker parameters differ'
+        if self.header['ranker'] == 'DenseRanker' and np is None:
+            return 'the dense backend requires NumPy'
+        if self.header['spelling'] != [FUZZY_MAX_DISTANCE, SPELLING_MIN_LENGTH]:
+            return 'spelling parameters differ'
+        return ''
+    
+    def restore_ranker(self, ranker):
+        if ranker is not None:
+            arrays = {
+                name[len('ranker.'):]: self.array(name)
+                for name in self.header['sections'] if name.startswith('ranker.')
+            }
+            ranker.restore_state(self.header['ranker_meta'], arrays)
+        self.ranker = ranker
+
+def snapshot_align(offset: int) -> int:
+    return (offset + SNAPSHOT_ALIGNMENT - 1) // SNAPSHOT_ALIGNMENT * SNAPSHOT_ALIGNMENT
+
+def snapshot_array_bytes(values, typecode: str) -> bytes:
+    if np is not None:
+        return np.ascontiguousarray(values, dtype=SNAPSHOT_DTYPES[typecode]).tobytes()
+    data = array.array(typecode, values)
+    if sys.byteorder != 'little':
+        data.byteswap()
+    return data.tobytes()
+
+def write_knowledge_snapshot(path: str, index: KnowledgeIndex, fingerprint: str) -> Dict:
+    entries = []
+    contents = []
+    content_offset = 0
+    for subject, entry, _ in index.entries:
+        fields = {key: entry[key] for key in entry if key != 'content'}
+        content = str(entry.get('content', '')).encode('utf-8')
+        entries.append([subject, fields, content_offset, len(content)])
+        contents.append(content)
+        content_offset += len(content)
+    
+    keywords = list(index.keyword_index)
+    indptr = [0]
+    postings = []
+    for keyword in keywords:
+        postings.extend(index.keyword_index[keyword])
+        indptr.append(len(postings))
+    
+    # Borrados de SymSpell agrupados por hash de la variante, con ids de palabra clave
+    keyword_ids = {keyword: keyword_id for keyword_id, keyword in enumerate(keywords)}
+    spelling = SymSpellIndex.shared(keywords, FUZZY_MAX_DISTANCE)
+    pairs = []
+    for variant, found in spelling.build_deletes().items():
+        key = variant_hash(variant)
+        for term in ((found,) if isinstance(found, str) else found):
+            pairs.append((key, keyword_ids[term]))
+    pairs.sort()
+    delete_hashes = []
+    delete_indptr = [0]
+    delete_terms = []
+    for key, term_id in pairs:
+        if not delete_hashes or delete_hashes[-1] != key:
+            if delete_hashes:
+                delete_indptr.append(len(delete_terms))
+            delete_hashes.append(key)
+        delete_terms.append(term_id)
+    delete_indptr.append(len(delete_terms))
+    
+    sections = {
+        'entries': (json.dumps(entries, ensure_ascii=False).encode('utf-8'), 'B', None),
+        'content': (b''.join(contents), 'B', None),
+        'keywords': (json.dumps(keywords, ensure_ascii=False).encode('utf-8'), 'B', None),
+        'postings_indptr': (snapshot_array_bytes(indptr, 'q'), 'q', None),
+        'postings': (snapshot_array_bytes(postings, 'i'), 'i', None),
+        'vocabulary': (json.dumps(sorted(index.vocabulary()), ensure_ascii=False).encode('utf-8'), 'B', None),
+        'deletes_hashes': (snapshot_array_bytes(delete_hashes, 'Q'), 'Q', None),
+        'deletes_indptr': (snapshot_array_bytes(delete_indptr, 'q'), 'q', None),
+        'deletes_terms': (snapshot_array_bytes(delete_terms, 'i'), 'i', None)
+    }
+    header = {
+        'format_version': SNAPSHOT_FORMAT_VERSION,
+        'fingerprint': fingerprint,
+        'created': datetime.now().isoformat(),
+        'entry_count': len(entries),
+        'ranker': type(index.ranker).__name__ if index.ranker is not None else None,
+        'ranker_params': None,
+        'ranker_meta': None,
+        'spelling': [FUZZY_MAX_DISTANCE, SPELLING_MIN_LENGTH]
+    }
+    if index.ranker is not None:
+        meta, arrays = index.ranker.snapshot_state()
+        header['ranker_params'] = index.ranker.build_params()
+        header['ranker_meta'] = meta
+        for name, (values, typecode, shape) in arrays.items():
+            sections[f'ranker.{name}'] = (snapshot_array_bytes(values, typecode), typecode, shape)
+    
+    layout = {}
+    offset = 0
+    for name, (data, typecode, shape) in sections.items():
+        layout[name] = [offset, len(data), typecode, shape]
+        offset = snapshot_align(offset + len(data))
+    header['sections'] = layout
+    header_bytes = json.dumps(header, ensure_ascii=False).encode('utf-8')
+    
+    # Archivo temporal + rename atómico: los procesos con el snapshot anterior mapeado no se ven afectados
+    prefix = SNAPSHOT_MAGIC + struct.pack('<II', SNAPSHOT_FORMAT_VERSION, len(header_bytes)) + header_bytes
+    with open(path + '.tmp', 'wb') as f:
+        f.write(prefix)
+        f.write(b'\0' * (snapshot_align(len(prefix)) - len(prefix)))
+        for name, (data, _, _) in sections.items():
+            f.write(data)
+            f.write(b'\0' * (snapshot_align(len(data)) - len(data)))
+    os.replace(path + '.tmp', path)
+    return header
+
 class SimpleKnowledgeBase:
-    def __init__(self):
-        self.knowledge_data = {
+    def __init__(self, ranking_backend: str = None, source_path: str = None, snapshot_path: str = None,
+                 shard_workers: int = None):
+        # 'keyword' (Jaccard sobre palabras clave), 'bm25' o 'dense' (vectores de n-gramas; topic + content)
+        self.ranking_backend = ranking_backend or os.getenv('KB_RANKING_BACKEND', 'keyword')
+        source_path = source_path or os.getenv('KNOWLEDGE_PATH')
+        self.source = KnowledgeSource(source_path) if source_path else None
+        # Snapshot precompilado (flask build-snapshot); si está desactualizado se reconstruye aquí
+        self.snapshot_path = snapshot_path or os.getenv('KNOWLEDGE_SNAPSHOT')
+        self.snapshot_signatures = None
+        # Con KB_SHARD_WORKERS > 0 el corpus se parte por materia y se busca en paralelo;
+        # las materias con al menos KB_SHARD_PROCESS_MIN_ENTRIES entradas usan su propio proceso
+        self.shard_workers = shard_workers if shard_workers is not None else int(os.getenv('KB_SHARD_WORKERS', '0'))
+        self.shard_process_min_entries = int(os.getenv('KB_SHARD_PROCESS_MIN_ENTRIES', '0'))
+        if self.shard_workers > 0 and self.ranking_backend != 'keyword':
+            # BM25 (IDF, longitud media) y dense (centroides IVF) se calculan por shard y sus
+            # puntajes no serían comparables entre materias: se usa el índice único
+            app.logger.warning(
+                f"Sharding is only supported with the 'keyword' backend; "
+                f"using a single index for '{self.ranking_backend}'"
+            )
+            self.shard_workers = 0
+        self.shard_executor = None
+        if self.shard_workers > 1:
+            self.shard_executor = ThreadPoolExecutor(max_workers=self.shard_workers, thread_name_prefix='kb-shard')
+        self.version = 0
+        self.reload_lock = threading.Lock()
+        self.index = None
+        self.reload(force=True)
+    
+    def load_default_data(self) -> Dict[str, List[Dict]]:
+        return {
             'matematicas': [
                 {
                     'id': 1,
@@ -165,46 +1596,253 @@ class SimpleKnowledgeBase:
             ]
         }
     
-    def search(self, processed_question: Dict, top_k: int = 3) -> List[Dict]:
-        subject = processed_question.get('subject', 'general')
-        keywords = processed_question.get('keywords', [])
-        
-        results = []
+    def reload(self, force: bool = False) -> bool:
+        # Reindexa si cambió alguna fuente; las búsquedas en curso siguen usando el índice anterior
+        with self.reload_lock:
+            if self.index is None and self.snapshot_path and self.shard_workers <= 0 and self.load_snapshot():
+                return True
+            if self.source is not None:
+                if self.snapshot_signatures is not None:
+                    # Índice tomado del snapshot: los archivos todavía no se leyeron
+                    if not force and self.source.signatures() == self.snapshot_signatures:
+                        return False
+                    self.snapshot_signatures = None
+                changed = self.source.refresh()
+                if not changed and not force:
+                    return False
+                knowledge_data = self.source.knowledge_data()
+                vocabulary = self.source.vocabulary()
+            elif force:
+                knowledge_data = self.load_default_data()
+                vocabulary = None
+            else:
+                return False
+            
+            # El índice queda completo (vocabulario y corrector incluidos) antes de publicarse
+            previous = self.index
+            index = self.build_index(knowledge_data, vocabulary)
+            self.index = index
+            self.version = index.version
+            if isinstance(previous, ShardedKnowledgeIndex):
+                previous.retire(index)
+            return True
+    
+    def build_index(self, knowledge_data: Dict[str, List[Mapping]], vocabulary: frozenset = None):
+        if self.shard_workers <= 0:
+            return KnowledgeIndex(knowledge_data, self.ranking_backend, self.version + 1, vocabulary=vocabulary)
+        previous = self.index if isinstance(self.index, ShardedKnowledgeIndex) else None
+        return ShardedKnowledgeIndex(
+            knowledge_data, self.ranking_backend, self.version + 1, previous,
+            executor=self.shard_executor, fanout=self.shard_workers,
+            process_min_entries=self.shard_process_min_entries, vocabulary=vocabulary
+        )
+    
+    def load_snapshot(self) -> bool:
+        signatures = self.source.signatures() if self.source is not None else None
+        try:
+            snapshot = KnowledgeSnapshot(self.snapshot_path)
+        except FileNotFoundError:
+            app.logger.info(f"Snapshot {self.snapshot_path} not found; building the index")
+            return False
+        except (OSError, ValueError, KeyError) as e:
+            app.logger.warning(f"Could not open snapshot {self.snapshot_path}: {e}")
+            return False
         
-        # Buscar en la materia detectada primero
-        if subject in self.knowledge_data:
-            for entry in self.knowledge_data[subject]:
-                score = self.calculate_similarity(keywords, entry['keywords'])
-                if score > 0:
-                    result = entry.copy()
-                    result['subject'] = subject
-                    result['similarity'] = score
-                    results.append(result)
-        
-        # Buscar en otras materias si no hay suficientes resultados
-        if len(results) < top_k:
-            for other_subject, entries in self.knowledge_data.items():
-                if other_subject != subject:
-                    for entry in entries:
-                        score = self.calculate_similarity(keywords, entry['keywords'])
-                        if score > 0:
-                            result = entry.copy()
-                            result['subject'] = other_subject
-                            result['similarity'] = score * 0.7  # Penalizar por no ser la materia principal
-                            results.append(result)
-        
-        # Ordenar por similitud y retornar top_k
-        results.sort(key=lambda x: x['similarity'], reverse=True)
-        return results[:top_k]
-    
-    def calculate_similarity(self, keywords1: List[str], keywords2: List[str]) -> float:
-        if not keywords1 or not keywords2:
-            return 0.0
+        ranker = make_ranker(self.ranking_backend)
+        reason = snapshot.stale_reason(self.fingerprint(signatures), ranker)
+        if reason:
+            app.logger.warning(f"Snapshot {self.snapshot_path} is stale ({reason}); rebuilding the index")
+            return False
+        snapshot.restore_ranker(ranker)
+        index = KnowledgeIndex(snapshot.knowledge_data, self.ranking_backend, self.version + 1, snapshot=snapshot)
+        self.index = index
+        self.version = index.version
+        self.snapshot_signatures = signatures
+        return True
+    
+    def fingerprint(self, signatures: Dict[str, Tuple[int, int]] = None) -> str:
+        # Identifica el corpus de origen: nombre, tamaño y mtime de cada archivo,
+        # o el contenido de la base por defecto
+        digest = hashlib.sha256()
+        if self.source is not None:
+            for path, (mtime_ns, size) in sorted(signatures.items()):
+                digest.update(f'{os.path.basename(path)}\0{size}\0{mtime_ns}\n'.encode('utf-8'))
+        else:
+            digest.update(json.dumps(self.load_default_data(), sort_keys=True, ensure_ascii=False).encode('utf-8'))
+        return digest.hexdigest()
+    
+    @property
+    def knowledge_data(self) -> Dict[str, List[Mapping]]:
+        return self.index.knowledge_data
+    
+    def search(self, processed_question: Dict, top_k: int = 3) -> List[Dict]:
+        return self.index.search(processed_question, top_k)
+    
+    def search_batch(self, processed_questions: List[Dict], top_k: int = 3) -> List[List[Dict]]:
+        return self.index.search_batch(processed_questions, top_k)
+
+class AnswerCache:
+    # Caché LRU con expiración (TTL) delante de la búsqueda. Guarda solo los resultados:
+    # la plantilla, la frase de aliento y el consejo se eligen en cada respuesta.
+    def __init__(self, knowledge_base: SimpleKnowledgeBase, max_entries: int = 1024, ttl_seconds: float = 300):
+        self.knowledge_base = knowledge_base
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()  # clave -> (expira, resultados)
+        self.index_version = None
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+    
+    def make_key(self, index: KnowledgeIndex, processed_question: Dict, top_k: int) -> Tuple:
+        return (
+            processed_question.get('subject', 'general'),
+            processed_question.get('question_type', 'general'),
+            index.query_signature(processed_question),
+            top_k
+        )
+    
+    def get(self, index: KnowledgeIndex, key: Tuple):
+        with self.lock:
+            if self.index_version != index.version:
+                # La base de conocimiento cambió: todo lo guardado quedó obsoleto
+                if self.entries:
+                    self.invalidations += 1
+                self.entries.clear()
+                self.index_version = index.version
+            
+            cached = self.entries.get(key)
+            if cached is None:
+                self.misses += 1
+                return None
+            if cached[0] < time.monotonic():
+                del self.entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return cached[1]
+    
+    def put(self, index: KnowledgeIndex, key: Tuple, results: List[Dict]):
+        with self.lock:
+            if self.index_version != index.version:
+                return
+            self.entries[key] = (time.monotonic() + self.ttl_seconds, results)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+    
+    def search(self, processed_question: Dict, top_k: int = 3) -> List[Dict]:
+        return self.search_batch([processed_question], top_k)[0]
+    
+    def search_batch(self, processed_questions: List[Dict], top_k: int = 3) -> List[List[Dict]]:
+        # Se toma el índice una sola vez para que clave y resultados correspondan a la misma versión
+        index = self.knowledge_base.index
+        if self.max_entries <= 0:
+            return index.search_batch(processed_questions, top_k)
         
-        common = set(keywords1) & set(keywords2)
-        total = set(keywords1) | set(keywords2)
+        results = [None] * len(processed_questions)
+        keys = [self.make_key(index, processed_question, top_k) for processed_question in processed_questions]
+        missing = []
+        for i, key in enumerate(keys):
+            results[i] = self.get(index, key)
+            if results[i] is None:
+                missing.append(i)
         
-        return len(common) / len(total) if total else 0.0
+        if missing:
+            found = index.search_batch([processed_questions[i] for i in missing], top_k)
+            for i, relevant_content in zip(missing, found):
+                results[i] = relevant_content
+                self.put(index, keys[i], relevant_content)
+        return results
+    
+    def stats(self) -> Dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self.entries),
+                'max_entries': self.max_entries,
+                'ttl_seconds': self.ttl_seconds,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+                'knowledge_version': self.index_version
+            }
+
+class RenderCache:
+    # Páginas ya renderizadas, compartidas entre usuarios (no dependen de la sesión).
+    # Cada página guarda su clave de validez (p. ej. la versión de la base) y un vencimiento
+    # opcional; el ETag y Last-Modified resultantes permiten responder 304 sin cuerpo.
+    def __init__(self):
+        self.pages = {}  # nombre -> (clave, vence, cuerpo, etag, modificada)
+        self.lock = threading.Lock()
+        self.render_locks = {}
+        self.hits = 0
+        self.misses = 0
+    
+    def lookup(self, name: str, key, now: float):
+        cached = self.pages.get(name)
+        if cached is not None and cached[0] == key and (cached[1] is None or cached[1] > now):
+            return cached
+        return None
+    
+    def get(self, name: str, key, render, max_age: float = None) -> Tuple[str, str, datetime]:
+        cached = self.lookup(name, key, time.monotonic())
+        if cached is None:
+            with self.lock:
+                render_lock = self.render_locks.setdefault(name, threading.Lock())
+            # Un solo render por página; los demás esperan y reutilizan el resultado
+            with render_lock:
+                cached = self.lookup(name, key, time.monotonic())
+                if cached is None:
+                    previous = self.pages.get(name)
+                    body = render()
+                    etag = hashlib.sha1(body.encode('utf-8')).hexdigest()
+                    # Si el contenido no cambió se conserva la fecha, así If-Modified-Since sigue valiendo
+                    if previous is not None and previous[3] == etag:
+                        modified = previous[4]
+                    else:
+                        modified = datetime.now(timezone.utc).replace(microsecond=0)
+                    expires = time.monotonic() + max_age if max_age is not None else None
+                    self.pages[name] = (key, expires, body, etag, modified)
+                    with self.lock:
+                        self.misses += 1
+                    return body, etag, modified
+        with self.lock:
+            self.hits += 1
+        return cached[2], cached[3], cached[4]
+    
+    def stats(self) -> Dict:
+        with self.lock:
+            return {'pages': len(self.pages), 'hits': self.hits, 'misses': self.misses}
+
+class KnowledgeReloader(threading.Thread):
+    # Sondea periódicamente las fuentes del corpus y reindexa los archivos modificados
+    def __init__(self, knowledge_base: SimpleKnowledgeBase, interval: float):
+        super().__init__(name='knowledge-reloader', daemon=True)
+        self.knowledge_base = knowledge_base
+        self.interval = interval
+    
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                if self.knowledge_base.reload():
+                    index = self.knowledge_base.index
+                    detail = ''
+                    if isinstance(index, ShardedKnowledgeIndex):
+                        detail = f"; rebuilt subjects: {', '.join(index.rebuilt) or 'none'}"
+                    app.logger.info(f"Knowledge base reloaded (version {self.knowledge_base.version}{detail})")
+            except Exception as e:
+                app.logger.error(f"Error reloading knowledge base: {str(e)}")
 
 class SimpleResponseGenerator:
     def __init__(self):
@@ -238,36 +1876,54 @@ class SimpleResponseGenerator:
     
     def generate_response(self, original_question: str, processed_question: Dict, 
                          relevant_content: List[Dict]) -> Dict:
+        response_data = {}
+        texts = []
+        for part, payload in self.generate_response_parts(original_question, processed_question, relevant_content):
+            if part == 'meta':
+                response_data.update(payload)
+            elif part == 'suggestions':
+                response_data['suggestions'] = payload
+            else:
+                texts.append(payload)
+        
+        response_data['response'] = '\n\n'.join(texts)
+        return response_data
+    
+    def generate_response_parts(self, original_question: str, processed_question: Dict,
+                                relevant_content: List[Dict]):
+        # Produce la respuesta por partes (parte, contenido) para poder enviarla en streaming
         if not relevant_content:
-            return self.generate_fallback_response(processed_question)
+            fallback = self.generate_fallback_response(processed_question)
+            yield 'meta', {key: fallback[key] for key in ('subject', 'topic', 'confidence', 'question_type')}
+            yield 'answer', fallback['response']
+            yield 'suggestions', fallback['suggestions']
+            return
         
         best_match = relevant_content[0]
         subject = best_match['subject']
         topic = best_match['topic']
-        content = best_match['content']
         confidence = best_match['similarity']
         
         question_type = processed_question.get('question_type', 'general')
         templates = self.response_templates.get(question_type, self.response_templates['general'])
         template = random.choice(templates)
         
-        main_response = template.format(topic=topic, content=content)
-        
-        encouragement = random.choice(self.encouragement_phrases)
-        learning_tip = random.choice(self.learning_tips)
-        
-        full_response = f"{encouragement}\n\n{main_response}\n\n{learning_tip}\n\n¿Te gustaría que profundice en algún aspecto específico?"
-        
-        suggestions = self.generate_suggestions(subject, topic)
-        
-        return {
-            'response': full_response,
+        yield 'meta', {
             'subject': subject,
             'topic': topic,
             'confidence': confidence,
-            'suggestions': suggestions,
             'question_type': question_type
         }
+        
+        yield 'encouragement', random.choice(self.encouragement_phrases)
+        
+        yield 'answer', template.format(topic=topic, content=best_match['content'])
+        
+        yield 'tip', random.choice(self.learning_tips)
+        
+        yield 'closing', "¿Te gustaría que profundice en algún aspecto específico?"
+        
+        yield 'suggestions', self.generate_suggestions(subject, topic)
     
     def generate_fallback_response(self, processed_question: Dict) -> Dict:
         subject = processed_question.get('subject', 'general')
@@ -320,93 +1976,1464 @@ class SimpleResponseGenerator:
     def get_general_suggestions(self, subject: str) -> List[str]:
         return self.generate_suggestions(subject, '')
 
-class SimpleAnalytics:
+class ConversationRecord:
+    # Registro compacto: la respuesta se guarda comprimida y la materia internada
+    __slots__ = ('id', 'question', 'compressed_response', 'subject', 'confidence', 'timestamp', 'feedback_rating')
+    
+    def __init__(self, conversation_id: int, question: str, response: str, subject: str,
+                 confidence: float, timestamp: float):
+        self.id = conversation_id
+        self.question = question
+        self.compressed_response = zlib.compress(response.encode('utf-8'))
+        self.subject = sys.intern(subject) if subject else subject
+        self.confidence = confidence
+        self.timestamp = timestamp
+        self.feedback_rating = None
+    
+    @property
+    def response(self) -> str:
+        return zlib.decompress(self.compressed_response).decode('utf-8')
+    
+    def preview(self, length: int = 200) -> str:
+        # Descomprime solo el principio de la respuesta
+        head = zlib.decompressobj().decompress(self.compressed_response, length * 4)
+        return head.decode('utf-8', errors='ignore')[:length]
+    
+    @property
+    def size(self) -> int:
+        # Estimación de memoria ocupada (bytes)
+        return 120 + len(self.question) + len(self.compressed_response)
+    
+    def to_dict(self, summary: bool = False) -> Dict:
+        data = {
+            'id': self.id,
+            'question': self.question,
+            'subject': self.subject,
+            'confidence': self.confidence,
+            'timestamp': datetime.fromtimestamp(self.timestamp).isoformat(),
+            'feedback_rating': self.feedback_rating
+        }
+        if summary:
+            data['response_preview'] = self.preview()
+        else:
+            data['response'] = self.response
+        return data
+
+class SessionRecord:
+    __slots__ = ('start_time', 'last_activity', 'questions_count', 'subjects_covered',
+                 'conversations', 'next_conversation_id', 'revision', 'size')
+    
+    BASE_SIZE = 300
+    
     def __init__(self):
-        self.session_stats = {}
+        now = time.time()
+        self.start_time = now
+        self.last_activity = now
+        self.questions_count = 0
+        self.subjects_covered = ()
+        self.conversations = {}  # id -> ConversationRecord, en orden de creación
+        self.next_conversation_id = 1
+        self.revision = 0  # cambia con cada conversación o evaluación nueva (ETag del historial)
+        self.size = self.BASE_SIZE
+    
+    def add_subject(self, subject: str):
+        if subject not in self.subjects_covered:
+            self.subjects_covered += (sys.intern(subject),)
+    
+    def history_page(self, cursor: int, limit: int) -> Tuple[List[ConversationRecord], int]:
+        if len(self.conversations) != self.next_conversation_id - 1:
+            # Ids reservados por bloques (con persistencia): hay huecos, se recorren en orden
+            following = [conv for conv in self.conversations.values() if conv.id > cursor][:limit + 1]
+            page = following[:limit]
+            return page, (page[-1].id if len(following) > limit else None)
+        # Los ids son consecutivos: se recorre desde el cursor sin escanear las anteriores
+        page = []
+        conversation_id = cursor + 1
+        while len(page) < limit and conversation_id < self.next_conversation_id:
+            conv = self.conversations.get(conversation_id)
+            if conv is not None:
+                page.append(conv)
+            conversation_id += 1
+        next_cursor = page[-1].id if page and page[-1].id < self.next_conversation_id - 1 else None
+        return page, next_cursor
+
+class SessionStore:
+    # Sesiones con expiración por inactividad y límite global de entradas y memoria.
+    # El OrderedDict se mantiene en orden de última actividad: las sesiones vencidas
+    # y las candidatas a desalojo (LRU) están siempre al principio.
+    def __init__(self, idle_timeout: float, max_entries: int, max_bytes: int = 0, factory=SessionRecord):
+        self.idle_timeout = idle_timeout
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.factory = factory
+        self.sessions = OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.RLock()
+        self.expired = 0
+        self.evicted = 0
+    
+    def __len__(self):
+        return len(self.sessions)
+    
+    def __contains__(self, session_id):
+        return self.get(session_id, touch=False) is not None
+    
+    def get(self, session_id: str, touch: bool = True):
+        with self.lock:
+            record = self.sessions.get(session_id)
+            if record is None:
+                return None
+            now = time.time()
+            if now - record.last_activity > self.idle_timeout:
+                self.remove(session_id)
+                self.expired += 1
+                return None
+            if touch:
+                record.last_activity = now
+                self.sessions.move_to_end(session_id)
+            return record
+    
+    def get_or_create(self, session_id: str):
+        with self.lock:
+            record = self.get(session_id)
+            if record is None:
+                record = self.factory()
+                self.sessions[session_id] = record
+                self.total_bytes += record.size
+                self.enforce_limits(keep=session_id)
+            return record
+    
+    def resize(self, session_id: str, delta: int):
+        with self.lock:
+            record = self.sessions.get(session_id)
+            if record is not None:
+                record.size += delta
+                self.total_bytes += delta
+                self.enforce_limits(keep=session_id)
+    
+    def remove(self, session_id: str):
+        with self.lock:
+            record = self.sessions.pop(session_id, None)
+            if record is not None:
+                self.total_bytes -= record.size
+    
+    def enforce_limits(self, keep: str = None):
+        # Desaloja las sesiones menos usadas, nunca la que se está actualizando
+        while self.sessions and (
+            len(self.sessions) > self.max_entries
+            or (self.max_bytes and self.total_bytes > self.max_bytes)
+        ):
+            oldest = next(iter(self.sessions))
+            if oldest == keep:
+                break
+            self.remove(oldest)
+            self.evicted += 1
+    
+    def cleanup(self, batch_size: int = 500) -> int:
+        # Elimina sesiones vencidas en tandas cortas para no retener el lock
+        removed = 0
+        while True:
+            with self.lock:
+                cutoff = time.time() - self.idle_timeout
+                batch = 0
+                while self.sessions and batch < batch_size:
+                    session_id, record = next(iter(self.sessions.items()))
+                    if record.last_activity >= cutoff:
+                        return removed + batch
+                    self.remove(session_id)
+                    self.expired += 1
+                    batch += 1
+                removed += batch
+                if not self.sessions:
+                    return removed
+    
+    def stats(self) -> Dict:
+        with self.lock:
+            return {
+                'sessions': len(self.sessions),
+                'max_entries': self.max_entries,
+                'bytes': self.total_bytes,
+                'max_bytes': self.max_bytes,
+                'idle_timeout_seconds': self.idle_timeout,
+                'expired': self.expired,
+                'evicted': self.evicted
+            }
+
+class SessionJanitor(threading.Thread):
+    # Limpieza periódica en segundo plano; las solicitudes nunca esperan por ella
+    def __init__(self, stores: List[SessionStore], interval: float):
+        super().__init__(name='session-janitor', daemon=True)
+        self.stores = stores
+        self.interval = interval
+    
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            for store in self.stores:
+                try:
+                    store.cleanup()
+                except Exception as e:
+                    app.logger.error(f"Error cleaning sessions: {str(e)}")
+
+class SessionStats:
+    __slots__ = ('questions_count', 'subjects_covered', 'start_time', 'last_activity', 'last_question', 'size')
+    
+    def __init__(self):
+        now = time.time()
+        self.questions_count = 0
+        self.subjects_covered = ()
+        self.start_time = now
+        self.last_activity = now
+        self.last_question = now
+        self.size = 200
+
+class TimeBuckets:
+    # Contadores por intervalo (día u hora) con retención fija. Las claves llegan en orden
+    # cronológico, así que las más antiguas siempre están al principio.
+    def __init__(self, retention: int):
+        self.retention = retention
+        self.buckets = OrderedDict()
+    
+    def add(self, key: str, amount: int = 1):
+        if key in self.buckets:
+            self.buckets[key] += amount
+            return
+        self.buckets[key] = amount
+        while len(self.buckets) > self.retention:
+            self.buckets.popitem(last=False)
+    
+    def get(self, key: str, default: int = 0) -> int:
+        return self.buckets.get(key, default)
+    
+    def items(self):
+        return self.buckets.items()
+
+class SimpleAnalytics:
+    # Todas las métricas se mantienen como agregados incrementales: get_general_stats
+    # no depende del tamaño del historial.
+    def __init__(self, idle_timeout: float = SESSION_IDLE_TIMEOUT, max_sessions: int = SESSION_MAX_ENTRIES):
+        self.session_stats = SessionStore(idle_timeout, max_sessions, factory=SessionStats)
+        self.lock = threading.Lock()
         self.global_stats = {
             'total_questions': 0,
             'subjects_distribution': {},
-            'feedback_ratings': [],
-            'daily_usage': {}
+            'feedback_ratings': deque(maxlen=int(os.getenv('ANALYTICS_FEEDBACK_BUFFER', '1000'))),
+            'feedback_sum': 0,
+            'feedback_count': 0,
+            'confidence_sum': 0.0,
+            'confidence_count': 0,
+            'sessions_count': 0,
+            'session_seconds': 0.0,
+            'daily_usage': TimeBuckets(int(os.getenv('ANALYTICS_DAILY_RETENTION', '90'))),
+            'hourly_usage': TimeBuckets(int(os.getenv('ANALYTICS_HOURLY_RETENTION', '48')))
         }
     
-    def update_session_stats(self, session_id: str, subject: str):
-        if session_id not in self.session_stats:
-            self.session_stats[session_id] = {
-                'questions_count': 0,
-                'subjects_covered': set(),
-                'start_time': datetime.now(),
-                'confidence_scores': []
+    def update_session_stats(self, session_id: str, subject: str, confidence: float = None):
+        self.update_session_stats_bulk(session_id, [subject], None if confidence is None else [confidence])
+    
+    def update_session_stats_bulk(self, session_id: str, subjects: List[str], confidences: List[float] = None):
+        now = datetime.now()
+        with self.lock:
+            stats = self.session_stats.get_or_create(session_id)
+            if stats.questions_count == 0:
+                self.global_stats['sessions_count'] += 1
+            # La duración de la sesión (inicio -> última pregunta) crece en el tiempo transcurrido
+            self.global_stats['session_seconds'] += now.timestamp() - stats.last_question
+            stats.last_question = now.timestamp()
+            
+            stats.questions_count += len(subjects)
+            for subject in subjects:
+                if subject not in stats.subjects_covered:
+                    stats.subjects_covered += (sys.intern(subject) if subject else subject,)
+            
+            self.global_stats['total_questions'] += len(subjects)
+            
+            for subject in subjects:
+                if subject not in self.global_stats['subjects_distribution']:
+                    self.global_stats['subjects_distribution'][subject] = 0
+                self.global_stats['subjects_distribution'][subject] += 1
+            
+            if confidences:
+                self.global_stats['confidence_sum'] += sum(confidences)
+                self.global_stats['confidence_count'] += len(confidences)
+            
+            self.global_stats['daily_usage'].add(now.date().isoformat(), len(subjects))
+            self.global_stats['hourly_usage'].add(now.strftime('%Y-%m-%dT%H:00'), len(subjects))
+    
+    def record_feedback(self, session_id: str, rating: int):
+        with self.lock:
+            self.global_stats['feedback_ratings'].append({
+                'rating': rating,
+                'timestamp': datetime.now().isoformat(),
+                'session_id': session_id
+            })
+            self.global_stats['feedback_sum'] += rating
+            self.global_stats['feedback_count'] += 1
+    
+    def get_general_stats(self) -> Dict:
+        with self.lock:
+            active_sessions = len(self.session_stats)
+            stats = self.global_stats
+            
+            avg_feedback = 0
+            if stats['feedback_count']:
+                avg_feedback = round(stats['feedback_sum'] / stats['feedback_count'], 2)
+            
+            avg_confidence = 0.0
+            if stats['confidence_count']:
+                avg_confidence = stats['confidence_sum'] / stats['confidence_count']
+            
+            avg_session_minutes = 0
+            if stats['sessions_count']:
+                avg_session_minutes = round(stats['session_seconds'] / stats['sessions_count'] / 60, 1)
+            
+            sorted_subjects = sorted(
+                stats['subjects_distribution'].items(),
+                key=lambda x: x[1],
+                reverse=True
+            )
+            
+            return {
+                'total_questions': stats['total_questions'],
+                'active_sessions': active_sessions,
+                'average_session_time_minutes': avg_session_minutes,
+                'average_confidence': avg_confidence,
+                'average_feedback': avg_feedback,
+                'subjects_distribution': dict(sorted_subjects),
+                'top_subject': sorted_subjects[0][0] if sorted_subjects else 'N/A',
+                'last_week_usage': self.get_last_week_usage(),
+                'last_day_hourly_usage': self.get_last_day_hourly_usage(),
+                'total_feedback_count': stats['feedback_count']
             }
+    
+    def get_last_week_usage(self) -> Dict:
+        last_week = {}
+        today = datetime.now().date()
         
-        self.session_stats[session_id]['questions_count'] += 1
-        self.session_stats[session_id]['subjects_covered'].add(subject)
+        for i in range(7):
+            date = (today - timedelta(days=i)).isoformat()
+            last_week[date] = self.global_stats['daily_usage'].get(date, 0)
         
-        self.global_stats['total_questions'] += 1
+        return last_week
+    
+    def get_last_day_hourly_usage(self) -> Dict:
+        last_day = {}
+        now = datetime.now().replace(minute=0, second=0, microsecond=0)
         
-        if subject not in self.global_stats['subjects_distribution']:
-            self.global_stats['subjects_distribution'][subject] = 0
-        self.global_stats['subjects_distribution'][subject] += 1
+        for i in range(24):
+            hour = (now - timedelta(hours=i)).strftime('%Y-%m-%dT%H:00')
+            last_day[hour] = self.global_stats['hourly_usage'].get(hour, 0)
         
-        today = datetime.now().date().isoformat()
-        if today not in self.global_stats['daily_usage']:
-            self.global_stats['daily_usage'][today] = 0
-        self.global_stats['daily_usage'][today] += 1
+        return last_day
+
+class PersistentStore:
+    # Persistencia en SQLite (modo WAL) con escritura diferida: las solicitudes solo encolan
+    # y un hilo escritor confirma las operaciones por lotes. Los agregados del dashboard
+    # se mantienen en tablas de resumen, así todos los workers leen los mismos datos.
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS conversations (
+            session_id TEXT NOT NULL,
+            conversation_id INTEGER NOT NULL,
+            question TEXT NOT NULL,
+            response TEXT NOT NULL,
+            subject TEXT,
+            confidence REAL,
+            timestamp TEXT NOT NULL,
+            feedback_rating INTEGER,
+            PRIMARY KEY (session_id, conversation_id)
+        );
+        CREATE TABLE IF NOT EXISTS sessions (
+            session_id TEXT PRIMARY KEY,
+            start_time REAL NOT NULL,
+            last_activity REAL NOT NULL,
+            questions_count INTEGER NOT NULL,
+            revision INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS sessions_last_activity ON sessions (last_activity);
+        CREATE TABLE IF NOT EXISTS session_subjects (
+            session_id TEXT NOT NULL,
+            subject TEXT NOT NULL,
+            PRIMARY KEY (session_id, subject)
+        );
+        CREATE TABLE IF NOT EXISTS feedback (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_id TEXT NOT NULL,
+            conversation_id INTEGER NOT NULL,
+            rating INTEGER NOT NULL,
+            timestamp TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS analytics_totals (name TEXT PRIMARY KEY, value REAL NOT NULL);
+        CREATE TABLE IF NOT EXISTS analytics_subjects (subject TEXT PRIMARY KEY, questions INTEGER NOT NULL);
+        CREATE TABLE IF NOT EXISTS analytics_daily (day TEXT PRIMARY KEY, questions INTEGER NOT NULL);
+        CREATE TABLE IF NOT EXISTS analytics_hourly (hour TEXT PRIMARY KEY, questions INTEGER NOT NULL);
+        CREATE TABLE IF NOT EXISTS id_blocks (name TEXT PRIMARY KEY, next_id INTEGER NOT NULL);
+    """
     
-    def record_feedback(self, session_id: str, rating: int):
-        self.global_stats['feedback_ratings'].append({
-            'rating': rating,
-            'timestamp': datetime.now().isoformat(),
-            'session_id': session_id
-        })
+    def __init__(self, path: str, flush_interval: float = 0.5, batch_size: int = 500,
+                 queue_size: int = 10000, hourly_retention: int = 48, id_block_size: int = 1000):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.hourly_retention = hourly_retention
+        self.id_block_size = id_block_size
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.local = threading.local()
+        self.dropped = 0
+        self.written = 0
+        self.pending = 0
+        self.pending_lock = threading.Lock()
+        
+        connection = self.connect()
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.executescript(self.SCHEMA)
+        columns = [row[1] for row in connection.execute('PRAGMA table_info(sessions)')]
+        if 'revision' not in columns:
+            connection.execute('ALTER TABLE sessions ADD COLUMN revision INTEGER NOT NULL DEFAULT 0')
+        connection.commit()
+        
+        # Ids de conversación: cada worker reserva bloques en la base y los entrega desde memoria.
+        # El siguiente bloque lo reserva el hilo escritor antes de que se agote el actual
+        self.id_lock = threading.Lock()
+        self.id_next, self.id_end = self.reserve_id_block(id_block_size)
+        self.id_spare = None
+        self.id_prefetching = False
+        self.id_blocks_blocking = 0
+        
+        self.writer = threading.Thread(target=self.run_writer, name='persistent-store-writer', daemon=True)
+        self.writer.start()
     
-    def get_general_stats(self) -> Dict:
-        active_sessions = len(self.session_stats)
+    def connect(self) -> sqlite3.Connection:
+        # Una conexión por hilo; en WAL los lectores no bloquean al escritor
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self.local.connection = connection
+        return connection
+    
+    # --- Escritura diferida ---
+    
+    def enqueue(self, operation: Tuple):
+        with self.pending_lock:
+            self.pending += 1
+        try:
+            self.queue.put(operation, timeout=1)
+        except queue.Full:
+            with self.pending_lock:
+                self.pending -= 1
+            self.dropped += 1
+            app.logger.error(f"Persistence queue full, dropping {operation[0]} operation")
+    
+    def enqueue_conversations(self, session_id: str, entries: List[ConversationRecord], timestamp: float):
+        self.enqueue(('conversations', session_id, entries, timestamp))
+    
+    def enqueue_feedback(self, session_id: str, conversation_id: int, rating: int, timestamp: float):
+        self.enqueue(('feedback', session_id, conversation_id, rating, timestamp))
+    
+    def flush(self, timeout: float = None) -> bool:
+        # Espera a que se confirme todo lo encolado hasta ahora
+        if not self.pending:
+            return True
+        done = threading.Event()
+        self.enqueue(('flush', done))
+        return done.wait(timeout)
+    
+    def run_writer(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            # Una espera (flush) o una reserva de ids no aguardan a que se llene el lote
+            while len(batch) < self.batch_size and batch[-1][0] not in ('flush', 'reserve_ids'):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            if any(operation[0] == 'reserve_ids' for operation in batch):
+                # Fuera de la transacción del lote: un lote revertido no debe devolver el bloque
+                self.prefetch_id_block()
+            try:
+                self.write_batch(batch)
+            except Exception as e:
+                app.logger.error(f"Error writing to persistent store: {str(e)}")
+                if len(batch) > 1:
+                    # El lote se revirtió completo: se reintenta de a una operación
+                    # para perder solo la que falla
+                    for operation in batch:
+                        try:
+                            self.write_batch([operation])
+                        except Exception as e:
+                            app.logger.error(f"Dropping {operation[0]} operation: {str(e)}")
+            with self.pending_lock:
+                self.pending -= len(batch)
+            for operation in batch:
+                if operation[0] == 'flush':
+                    operation[1].set()
+    
+    def write_batch(self, batch: List[Tuple]):
+        connection = self.connect()
+        totals = {}
         
-        avg_feedback = 0
-        if self.global_stats['feedback_ratings']:
-            ratings = [f['rating'] for f in self.global_stats['feedback_ratings']]
-            avg_feedback = sum(ratings) / len(ratings)
+        def add_total(name, value):
+            totals[name] = totals.get(name, 0) + value
         
-        sorted_subjects = sorted(
-            self.global_stats['subjects_distribution'].items(),
-            key=lambda x: x[1],
-            reverse=True
+        with connection:
+            for operation in batch:
+                if operation[0] == 'conversations':
+                    self.write_conversations(connection, operation, add_total)
+                elif operation[0] == 'feedback':
+                    self.write_feedback(connection, operation, add_total)
+            
+            connection.executemany(
+                'INSERT INTO analytics_totals (name, value) VALUES (?, ?) '
+                'ON CONFLICT (name) DO UPDATE SET value = value + excluded.value',
+                totals.items()
+            )
+            cutoff = (datetime.now() - timedelta(hours=self.hourly_retention)).strftime('%Y-%m-%dT%H:00')
+            connection.execute('DELETE FROM analytics_hourly WHERE hour < ?', (cutoff,))
+        self.written += sum(1 for operation in batch if operation[0] not in ('flush', 'reserve_ids'))
+    
+    def write_conversations(self, connection: sqlite3.Connection, operation: Tuple, add_total):
+        _, session_id, entries, timestamp = operation
+        connection.executemany(
+            # Sin OR IGNORE: un id repetido debe fallar, no descartar la conversación en silencio
+            'INSERT INTO conversations VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            [
+                (session_id, conv.id, conv.question, conv.response, conv.subject, conv.confidence,
+                 datetime.fromtimestamp(conv.timestamp).isoformat(), conv.feedback_rating)
+                for conv in entries
+            ]
+        )
+        
+        row = connection.execute(
+            'SELECT last_activity FROM sessions WHERE session_id = ?', (session_id,)
+        ).fetchone()
+        if row is None:
+            connection.execute(
+                'INSERT INTO sessions VALUES (?, ?, ?, ?, 1)', (session_id, timestamp, timestamp, len(entries))
+            )
+            add_total('sessions_count', 1)
+        else:
+            connection.execute(
+                'UPDATE sessions SET last_activity = MAX(last_activity, ?), questions_count = questions_count + ?, '
+                'revision = revision + 1 WHERE session_id = ?',
+                (timestamp, len(entries), session_id)
+            )
+            add_total('session_seconds', max(0.0, timestamp - row[0]))
+        
+        subjects = [conv.subject for conv in entries]
+        connection.executemany(
+            'INSERT OR IGNORE INTO session_subjects VALUES (?, ?)',
+            [(session_id, subject or 'general') for subject in set(subjects)]
+        )
+        connection.executemany(
+            'INSERT INTO analytics_subjects VALUES (?, 1) '
+            'ON CONFLICT (subject) DO UPDATE SET questions = questions + 1',
+            [(subject,) for subject in subjects]
         )
         
+        moment = datetime.fromtimestamp(timestamp)
+        connection.execute(
+            'INSERT INTO analytics_daily VALUES (?, ?) ON CONFLICT (day) DO UPDATE SET questions = questions + excluded.questions',
+            (moment.date().isoformat(), len(entries))
+        )
+        connection.execute(
+            'INSERT INTO analytics_hourly VALUES (?, ?) ON CONFLICT (hour) DO UPDATE SET questions = questions + excluded.questions',
+            (moment.strftime('%Y-%m-%dT%H:00'), len(entries))
+        )
+        add_total('total_questions', len(entries))
+        add_total('confidence_sum', sum(conv.confidence or 0.0 for conv in entries))
+        add_total('confidence_count', len(entries))
+    
+    def write_feedback(self, connection: sqlite3.Connection, operation: Tuple, add_total):
+        _, session_id, conversation_id, rating, timestamp = operation
+        connection.execute(
+            'UPDATE conversations SET feedback_rating = ? WHERE session_id = ? AND conversation_id = ?',
+            (rating, session_id, conversation_id)
+        )
+        connection.execute('UPDATE sessions SET revision = revision + 1 WHERE session_id = ?', (session_id,))
+        connection.execute(
+            'INSERT INTO feedback (session_id, conversation_id, rating, timestamp) VALUES (?, ?, ?, ?)',
+            (session_id, conversation_id, rating, datetime.fromtimestamp(timestamp).isoformat())
+        )
+        add_total('feedback_sum', rating)
+        add_total('feedback_count', 1)
+    
+    # --- Lecturas (consistentes entre workers) ---
+    
+    def conversation_exists(self, session_id: str, conversation_id: int) -> bool:
+        row = self.connect().execute(
+            'SELECT 1 FROM conversations WHERE session_id = ? AND conversation_id = ?',
+            (session_id, conversation_id)
+        ).fetchone()
+        return row is not None
+    
+    # --- Ids de conversación ---
+    
+    def reserve_id_block(self, size: int) -> Tuple[int, int]:
+        # Reserva de forma atómica un tramo [inicio, fin) de ids únicos entre todos los workers.
+        # Una base anterior a esta tabla continúa desde su mayor id ya guardado.
+        connection = self.connect()
+        with connection:
+            connection.execute(
+                "INSERT OR IGNORE INTO id_blocks (name, next_id) "
+                "SELECT 'conversations', COALESCE(MAX(conversation_id), 0) + 1 FROM conversations"
+            )
+            connection.execute("UPDATE id_blocks SET next_id = next_id + ? WHERE name = 'conversations'", (size,))
+            end = connection.execute("SELECT next_id FROM id_blocks WHERE name = 'conversations'").fetchone()[0]
+        return end - size, end
+    
+    def prefetch_id_block(self):
+        try:
+            block = self.reserve_id_block(self.id_block_size)
+        except sqlite3.Error as e:
+            app.logger.error(f"Could not reserve conversation ids: {e}")
+            block = None
+        with self.id_lock:
+            self.id_spare = block
+            self.id_prefetching = False
+    
+    def allocate_conversation_ids(self, count: int) -> int:
+        # Devuelve el primero de count ids consecutivos sin tocar la base. Solo si el bloque
+        # siguiente no llegó a tiempo (o el lote no cabe en uno) se reserva aquí mismo.
+        with self.id_lock:
+            if self.id_next + count > self.id_end:
+                if self.id_spare is not None and self.id_spare[1] - self.id_spare[0] >= count:
+                    self.id_next, self.id_end = self.id_spare
+                else:
+                    self.id_blocks_blocking += 1
+                    self.id_next, self.id_end = self.reserve_id_block(max(count, self.id_block_size))
+                self.id_spare = None
+            first_id = self.id_next
+            self.id_next += count
+            prefetch = (
+                self.id_spare is None and not self.id_prefetching
+                and self.id_end - self.id_next < self.id_block_size // 2
+            )
+            if prefetch:
+                self.id_prefetching = True
+        if prefetch:
+            self.enqueue(('reserve_ids',))
+        return first_id
+    
+    def get_revision(self, session_id: str) -> int:
+        row = self.connect().execute(
+            'SELECT revision FROM sessions WHERE session_id = ?', (session_id,)
+        ).fetchone()
+        return row[0] if row else None
+    
+    def get_history(self, session_id: str, cursor: int = 0, limit: int = 200, summary: bool = False) -> Dict:
+        connection = self.connect()
+        session_row = connection.execute(
+            'SELECT start_time, questions_count FROM sessions WHERE session_id = ?', (session_id,)
+        ).fetchone()
+        if session_row is None:
+            return None
+        
+        response_column = 'substr(response, 1, 200)' if summary else 'response'
+        rows = connection.execute(
+            f'SELECT conversation_id, question, {response_column}, subject, confidence, timestamp, feedback_rating '
+            'FROM conversations WHERE session_id = ? AND conversation_id > ? ORDER BY conversation_id LIMIT ?',
+            (session_id, cursor, limit + 1)
+        ).fetchall()
+        subjects = connection.execute(
+            'SELECT subject FROM session_subjects WHERE session_id = ?', (session_id,)
+        ).fetchall()
         return {
-            'total_questions': self.global_stats['total_questions'],
+            'conversations': [
+                {
+                    'id': row[0],
+                    'question': row[1],
+                    'response_preview' if summary else 'response': row[2],
+                    'subject': row[3],
+                    'confidence': row[4],
+                    'timestamp': row[5],
+                    'feedback_rating': row[6]
+                }
+                for row in rows[:limit]
+            ],
+            'next_cursor': rows[limit - 1][0] if len(rows) > limit else None,
+            'session_stats': {
+                'questions_count': session_row[1],
+                'subjects_covered': [row[0] for row in subjects],
+                'session_duration': str(timedelta(seconds=max(0.0, time.time() - session_row[0])))
+            }
+        }
+    
+    def get_general_stats(self) -> Dict:
+        connection = self.connect()
+        totals = dict(connection.execute('SELECT name, value FROM analytics_totals').fetchall())
+        active_sessions = connection.execute(
+            'SELECT COUNT(*) FROM sessions WHERE last_activity > ?', (time.time() - SESSION_IDLE_TIMEOUT,)
+        ).fetchone()[0]
+        sorted_subjects = connection.execute(
+            'SELECT subject, questions FROM analytics_subjects ORDER BY questions DESC'
+        ).fetchall()
+        
+        today = datetime.now().date()
+        days = [(today - timedelta(days=i)).isoformat() for i in range(7)]
+        daily = dict(connection.execute(
+            'SELECT day, questions FROM analytics_daily WHERE day >= ?', (days[-1],)
+        ).fetchall())
+        
+        now = datetime.now().replace(minute=0, second=0, microsecond=0)
+        hours = [(now - timedelta(hours=i)).strftime('%Y-%m-%dT%H:00') for i in range(24)]
+        hourly = dict(connection.execute(
+            'SELECT hour, questions FROM analytics_hourly WHERE hour >= ?', (hours[-1],)
+        ).fetchall())
+        
+        feedback_count = int(totals.get('feedback_count', 0))
+        confidence_count = totals.get('confidence_count', 0)
+        sessions_count = totals.get('sessions_count', 0)
+        return {
+            'total_questions': int(totals.get('total_questions', 0)),
             'active_sessions': active_sessions,
-            'average_session_time_minutes': 15,  # Simulado
-            'average_confidence': 0.75,  # Simulado
-            'average_feedback': avg_feedback,
+            'average_session_time_minutes': round(totals.get('session_seconds', 0) / sessions_count / 60, 1) if sessions_count else 0,
+            'average_confidence': totals.get('confidence_sum', 0) / confidence_count if confidence_count else 0.0,
+            'average_feedback': round(totals.get('feedback_sum', 0) / feedback_count, 2) if feedback_count else 0,
             'subjects_distribution': dict(sorted_subjects),
             'top_subject': sorted_subjects[0][0] if sorted_subjects else 'N/A',
-            'last_week_usage': self.get_last_week_usage(),
-            'total_feedback_count': len(self.global_stats['feedback_ratings'])
+            'last_week_usage': {day: daily.get(day, 0) for day in days},
+            'last_day_hourly_usage': {hour: hourly.get(hour, 0) for hour in hours},
+            'total_feedback_count': feedback_count
         }
     
-    def get_last_week_usage(self) -> Dict:
-        # Simulación de datos de la última semana
-        from datetime import timedelta
-        last_week = {}
-        today = datetime.now().date()
+    def export_rows(self, dataset: str, start: datetime, end: datetime, subject: str, cursor: str,
+                    page_size: int = 500):
+        # Filas para exportar (tuplas en el orden de EXPORT_COLUMNS). El cursor se valida aquí,
+        # antes de empezar a transmitir; la lectura se hace luego por páginas.
+        if dataset == 'daily_usage':
+            sql = 'SELECT day, day, questions FROM analytics_daily WHERE day > ?'
+            after = cursor or ''
+            conditions = []
+            if start:
+                conditions.append(('day >= ?', start.date().isoformat()))
+            if end:
+                conditions.append(('day <= ?', (end - timedelta(microseconds=1)).date().isoformat()))
+            key = 'day'
+        else:
+            try:
+                after = int(cursor or 0)
+            except ValueError:
+                raise ValueError('Cursor inválido')
+            if dataset == 'conversations':
+                sql = ('SELECT rowid, session_id, conversation_id, timestamp, subject, confidence, feedback_rating, '
+                       'question, response FROM conversations c WHERE rowid > ?')
+                key = 'rowid'
+            else:
+                sql = ('SELECT f.id, f.session_id, f.conversation_id, f.timestamp, f.rating, c.subject FROM feedback f '
+                       'LEFT JOIN conversations c ON c.session_id = f.session_id AND c.conversation_id = f.conversation_id '
+                       'WHERE f.id > ?')
+                key = 'f.id'
+            prefix = 'c.' if dataset == 'conversations' else 'f.'
+            conditions = []
+            if start:
+                conditions.append((f'{prefix}timestamp >= ?', start.isoformat()))
+            if end:
+                conditions.append((f'{prefix}timestamp < ?', end.isoformat()))
+            if subject:
+                conditions.append(('c.subject = ?', subject))
         
-        for i in range(7):
-            date = (today - timedelta(days=i)).isoformat()
-            last_week[date] = self.global_stats['daily_usage'].get(date, 0)
+        sql += ''.join(f' AND {condition}' for condition, _ in conditions) + f' ORDER BY {key} LIMIT ?'
+        return self.export_pages(sql, after, [value for _, value in conditions], page_size)
+    
+    def export_pages(self, sql: str, after, params: List, page_size: int):
+        # Paginación por clave (keyset): memoria constante y sin transacciones largas. Cada
+        # página usa la conexión del hilo que la pide (el servidor ASGI cambia de hilo).
+        while True:
+            rows = self.connect().execute(sql, [after] + params + [page_size]).fetchall()
+            yield from rows
+            if len(rows) < page_size:
+                return
+            after = rows[-1][0]
+    
+    def stats(self) -> Dict:
+        return {
+            'queued': self.queue.qsize(),
+            'written': self.written,
+            'dropped': self.dropped,
+            'id_blocks_blocking': self.id_blocks_blocking
+        }
+
+class Histogram:
+    # Buckets acumulativos al estilo Prometheus (le = límite superior)
+    DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+    
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+    
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class MetricsRegistry:
+    def __init__(self, prefix: str = 'edu_assistant'):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.counters = {}  # (nombre, etiquetas) -> valor
+        self.histograms = {}  # (nombre, etiquetas) -> Histogram
+        self.descriptions = {}
+    
+    def describe(self, name: str, description: str):
+        self.descriptions[name] = description
+    
+    def inc(self, name: str, amount: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+    
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+    
+    @contextmanager
+    def timer(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe('stage_duration_seconds', time.perf_counter() - start, stage=stage)
+    
+    @staticmethod
+    def format_labels(labels) -> str:
+        if not labels:
+            return ''
+        escaped = []
+        for key, value in labels:
+            value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            escaped.append(f'{key}="{value}"')
+        return '{' + ','.join(escaped) + '}'
+    
+    def render(self, gauges: Dict[Tuple[str, Tuple], float]) -> str:
+        # Formato de texto de Prometheus (versión 0.0.4)
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(
+                ((key, (list(h.counts), h.sum, h.count, h.buckets)) for key, h in self.histograms.items()),
+                key=lambda item: item[0]
+            )
         
-        return last_week
+        seen = set()
+        
+        def header(name, metric_type):
+            if name in seen:
+                return
+            seen.add(name)
+            if name in self.descriptions:
+                lines.append(f'# HELP {self.prefix}_{name} {self.descriptions[name]}')
+            lines.append(f'# TYPE {self.prefix}_{name} {metric_type}')
+        
+        for (name, labels), value in counters:
+            header(name, 'counter')
+            lines.append(f'{self.prefix}_{name}{self.format_labels(labels)} {value}')
+        
+        for (name, labels), (counts, total, count, buckets) in histograms:
+            header(name, 'histogram')
+            cumulative = 0
+            for bound, bucket_count in zip(list(buckets) + ['+Inf'], counts):
+                cumulative += bucket_count
+                bucket_labels = labels + (('le', bound),)
+                lines.append(f'{self.prefix}_{name}_bucket{self.format_labels(bucket_labels)} {cumulative}')
+            lines.append(f'{self.prefix}_{name}_sum{self.format_labels(labels)} {total}')
+            lines.append(f'{self.prefix}_{name}_count{self.format_labels(labels)} {count}')
+        
+        for (name, labels), value in sorted(gauges.items()):
+            header(name, 'gauge')
+            lines.append(f'{self.prefix}_{name}{self.format_labels(labels)} {value}')
+        
+        return '\n'.join(lines) + '\n'
+
+class RequestProfiler:
+    # Perfilador por muestreo: activa cProfile en una fracción de las solicitudes
+    # y acumula las estadísticas para consultarlas en /metrics/profile.
+    # Se perfila una solicitud a la vez: desde Python 3.12 solo puede haber un perfilador
+    # activo por proceso, y si ya hay una muestra en curso la solicitud no se muestrea.
+    def __init__(self, sample_rate: float):
+        self.sample_rate = sample_rate
+        self.lock = threading.Lock()
+        self.active = threading.Lock()
+        self.stats = None
+        self.sampled = 0
+    
+    def start(self):
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            return None
+        if not self.active.acquire(blocking=False):
+            return None
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Otro perfilador (ajeno a la app) ya está activo
+            self.active.release()
+            return None
+        return profiler
+    
+    def profile_chunks(self, chunks, profiler: cProfile.Profile):
+        # Cuerpo en streaming: se perfila la generación de cada parte en el hilo que la pide
+        profiler.disable()
+        iterator = iter(chunks)
+        try:
+            while True:
+                profiler.enable()
+                try:
+                    chunk = next(iterator, None)
+                finally:
+                    profiler.disable()
+                if chunk is None:
+                    return
+                yield chunk
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+    
+    def stop(self, profiler: cProfile.Profile):
+        profiler.disable()
+        self.active.release()
+        with self.lock:
+            if self.stats is None:
+                self.stats = pstats.Stats(profiler)
+            else:
+                self.stats.add(profiler)
+            self.sampled += 1
+    
+    SORT_KEYS = frozenset(key.value for key in pstats.SortKey)
+    
+    def report(self, limit: int = 50, sort: str = 'cumulative') -> str:
+        if sort not in self.SORT_KEYS:
+            raise ValueError(f"Orden desconocido: {sort} (opciones: {', '.join(sorted(self.SORT_KEYS))})")
+        with self.lock:
+            if self.stats is None:
+                return 'Sin muestras (PROFILE_SAMPLE_RATE=%s)\n' % self.sample_rate
+            output = io.StringIO()
+            self.stats.stream = output
+            output.write(f'Solicitudes muestreadas: {self.sampled}\n')
+            self.stats.sort_stats(sort).print_stats(limit)
+            return output.getvalue()
+    
+    def reset(self):
+        with self.lock:
+            self.stats = None
+            self.sampled = 0
+
+class TokenBuckets:
+    # Cubetas de tokens en memoria: dos números por clave (tokens, última recarga) y un
+    # límite LRU de claves, así la memoria no crece con la cantidad de clientes vistos.
+    def __init__(self, max_keys: int = 100000):
+        self.max_keys = max_keys
+        self.buckets = OrderedDict()  # clave -> (tokens, actualizada)
+        self.lock = threading.Lock()
+        self.evicted = 0
+
+    @staticmethod
+    def refill(state, rate: float, burst: float, now: float) -> float:
+        if state is None:
+            return burst
+        return min(burst, state[0] + max(0.0, now - state[1]) * rate)
+
+    def take(self, requests: List[Tuple[str, str, float, float]], cost: float, now: float) -> Tuple[str, float]:
+        # requests: (motivo, clave, tokens por segundo, ráfaga). Se descuenta de todas
+        # las cubetas o de ninguna; devuelve el motivo del rechazo y la espera sugerida.
+        # Un costo mayor que la ráfaga exige la cubeta llena y la deja en negativo, con una
+        # deuda de a lo sumo una ráfaga: un lote grande no bloquea la sesión por minutos.
+        with self.lock:
+            updates = []
+            for reason, key, rate, burst in requests:
+                needed = min(cost, burst)
+                tokens = self.refill(self.buckets.get(key), rate, burst, now)
+                if tokens < needed:
+                    return reason, (needed - tokens) / rate
+                updates.append((key, max(tokens - cost, -burst)))
+            self.store(updates, now)
+            return None, 0.0
+
+    def refund(self, requests: List[Tuple[str, str, float, float]], cost: float, now: float):
+        # Devuelve lo cobrado por take cuando la solicitud se rechaza más adelante
+        with self.lock:
+            self.store([
+                (key, min(burst, self.refill(self.buckets.get(key), rate, burst, now) + cost))
+                for _, key, rate, burst in requests
+            ], now)
+
+    def store(self, updates: List[Tuple[str, float]], now: float):
+        for key, tokens in updates:
+            self.buckets[key] = (tokens, now)
+            self.buckets.move_to_end(key)
+        while len(self.buckets) > self.max_keys:
+            self.buckets.popitem(last=False)
+            self.evicted += 1
+
+    def stats(self) -> Dict:
+        with self.lock:
+            return {'keys': len(self.buckets), 'evicted': self.evicted}
+
+class SqliteTokenBuckets(TokenBuckets):
+    # Las mismas cubetas en un archivo SQLite local, compartidas por todos los workers.
+    # Cada toma es una transacción inmediata; las filas inactivas se purgan periódicamente.
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS rate_buckets (
+            key TEXT PRIMARY KEY,
+            tokens REAL NOT NULL,
+            updated REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS rate_buckets_updated ON rate_buckets (updated);
+    """
+
+    def __init__(self, path: str, idle_seconds: float = 3600, prune_every: int = 1000):
+        super().__init__(max_keys=0)
+        self.path = path
+        self.idle_seconds = idle_seconds
+        self.prune_every = prune_every
+        self.local = threading.local()
+        self.takes = 0
+        self.errors = 0
+        connection = self.connect()
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.executescript(self.SCHEMA)
+
+    def connect(self) -> sqlite3.Connection:
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            # Transacciones manuales (BEGIN IMMEDIATE) para leer y descontar de forma atómica
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self.local.connection = connection
+        return connection
+
+    def take(self, requests: List[Tuple[str, str, float, float]], cost: float, now: float) -> Tuple[str, float]:
+        connection = self.connect()
+        try:
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                updates = []
+                for reason, key, rate, burst in requests:
+                    needed = min(cost, burst)
+                    state = connection.execute(
+                        'SELECT tokens, updated FROM rate_buckets WHERE key = ?', (key,)
+                    ).fetchone()
+                    tokens = self.refill(state, rate, burst, now)
+                    if tokens < needed:
+                        connection.execute('ROLLBACK')
+                        return reason, (needed - tokens) / rate
+                    updates.append((key, max(tokens - cost, -burst), now))
+                connection.executemany(
+                    'INSERT INTO rate_buckets (key, tokens, updated) VALUES (?, ?, ?) '
+                    'ON CONFLICT(key) DO UPDATE SET tokens = excluded.tokens, updated = excluded.updated',
+                    updates
+                )
+                with self.lock:
+                    self.takes += 1
+                    prune = self.takes % self.prune_every == 0
+                if prune:
+                    connection.execute('DELETE FROM rate_buckets WHERE updated < ?', (now - self.idle_seconds,))
+                connection.execute('COMMIT')
+            except BaseException:
+                if connection.in_transaction:
+                    connection.execute('ROLLBACK')
+                raise
+        except sqlite3.Error as e:
+            # Si el archivo compartido falla se deja pasar la solicitud en lugar de cortar el servicio
+            with self.lock:
+                self.errors += 1
+            app.logger.warning(f"Rate limit store unavailable: {e}")
+        return None, 0.0
+
+    def refund(self, requests: List[Tuple[str, str, float, float]], cost: float, now: float):
+        connection = self.connect()
+        try:
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                for _, key, rate, burst in requests:
+                    state = connection.execute(
+                        'SELECT tokens, updated FROM rate_buckets WHERE key = ?', (key,)
+                    ).fetchone()
+                    if state is not None:
+                        connection.execute(
+                            'UPDATE rate_buckets SET tokens = ?, updated = ? WHERE key = ?',
+                            (min(burst, self.refill(state, rate, burst, now) + cost), now, key)
+                        )
+                connection.execute('COMMIT')
+            except BaseException:
+                if connection.in_transaction:
+                    connection.execute('ROLLBACK')
+                raise
+        except sqlite3.Error as e:
+            with self.lock:
+                self.errors += 1
+            app.logger.warning(f"Rate limit store unavailable: {e}")
+
+    def stats(self) -> Dict:
+        try:
+            keys = self.connect().execute('SELECT COUNT(*) FROM rate_buckets').fetchone()[0]
+        except sqlite3.Error:
+            keys = -1
+        return {'keys': keys, 'errors': self.errors}
+
+class ConcurrencyLimiter:
+    # Límite global de preguntas en curso con una cola de espera acotada: al llenarse la
+    # cola, o si la espera supera wait_timeout, se rechaza de inmediato.
+    def __init__(self, max_active: int, max_waiting: int, wait_timeout: float):
+        self.max_active = max_active
+        self.max_waiting = max_waiting
+        self.wait_timeout = wait_timeout
+        self.condition = threading.Condition()
+        self.active = 0
+        self.waiting = 0
+
+    def acquire(self) -> bool:
+        with self.condition:
+            if self.max_active <= 0 or (self.active < self.max_active and not self.waiting):
+                self.active += 1
+                return True
+            if self.waiting >= self.max_waiting:
+                return False
+            self.waiting += 1
+            try:
+                deadline = time.monotonic() + self.wait_timeout
+                while self.active >= self.max_active:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                    self.condition.wait(remaining)
+                self.active += 1
+                return True
+            finally:
+                self.waiting -= 1
+
+    def release(self):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify()
+
+    def stats(self) -> Dict:
+        with self.condition:
+            return {'active': self.active, 'waiting': self.waiting, 'max_active': self.max_active}
+
+class AdmissionController:
+    # Control de admisión delante de las preguntas: cubetas por sesión y por IP y luego
+    # el límite global de concurrencia. Una tasa <= 0 desactiva la cubeta correspondiente.
+    def __init__(self, buckets: TokenBuckets, limiter: ConcurrencyLimiter,
+                 session_rate: float, session_burst: float, ip_rate: float, ip_burst: float):
+        self.buckets = buckets
+        self.limiter = limiter
+        self.session_rate = session_rate
+        self.session_burst = session_burst
+        self.ip_rate = ip_rate
+        self.ip_burst = ip_burst
+
+    def acquire(self, session_id: str, client_ip: str, cost: float = 1) -> Tuple[str, float]:
+        # (None, 0) si se admite (hay que llamar a release); si no, (motivo, segundos de espera)
+        requests = []
+        if session_id and self.session_rate > 0:
+            requests.append(('session', f'session:{session_id}', self.session_rate, self.session_burst))
+        if client_ip and self.ip_rate > 0:
+            requests.append(('ip', f'ip:{client_ip}', self.ip_rate, self.ip_burst))
+        if requests:
+            reason, retry_after = self.buckets.take(requests, cost, time.time())
+            if reason:
+                return reason, retry_after
+        if not self.limiter.acquire():
+            # Rechazada por saturación: no se cobran los tokens de una pregunta no atendida
+            if requests:
+                self.buckets.refund(requests, cost, time.time())
+            return 'concurrency', 1.0
+        return None, 0.0
+
+    def release(self):
+        self.limiter.release()
+
+    def stats(self) -> Dict:
+        stats = self.limiter.stats()
+        for name, value in self.buckets.stats().items():
+            stats[f'bucket_{name}'] = value
+        return stats
 
 # Inicializar componentes
 nlp_processor = SimpleNLPProcessor()
 knowledge_base = SimpleKnowledgeBase()
+# Las palabras que aparecen en el corpus son válidas y no se corrigen
+nlp_processor.vocabulary_source = lambda: knowledge_base.index.vocabulary()
 response_generator = SimpleResponseGenerator()
 analytics = SimpleAnalytics()
+answer_cache = AnswerCache(
+    knowledge_base,
+    max_entries=int(os.getenv('ANSWER_CACHE_SIZE', '1024')),
+    ttl_seconds=float(os.getenv('ANSWER_CACHE_TTL', '300'))
+)
+
+render_cache = RenderCache()
+DASHBOARD_CACHE_SECONDS = float(os.getenv('DASHBOARD_CACHE_SECONDS', '5'))
+
+if knowledge_base.source is not None:
+    knowledge_reload_interval = float(os.getenv('KNOWLEDGE_RELOAD_INTERVAL', '5'))
+    if knowledge_reload_interval > 0:
+        KnowledgeReloader(knowledge_base, knowledge_reload_interval).start()
+
+# Almacenamiento en memoria (acotado y con expiración)
+session_store = SessionStore(SESSION_IDLE_TIMEOUT, SESSION_MAX_ENTRIES, SESSION_MAX_BYTES)
+SessionJanitor([session_store, analytics.session_stats], SESSION_CLEANUP_INTERVAL).start()
+
+# Métricas y perfilado
+metrics = MetricsRegistry()
+metrics.describe('http_requests_total', 'Solicitudes HTTP por endpoint y código de estado')
+metrics.describe('http_request_duration_seconds', 'Latencia de las solicitudes HTTP')
+metrics.describe('stage_duration_seconds', 'Latencia de cada etapa del pipeline de preguntas')
+metrics.describe('ask_errors_total', 'Preguntas rechazadas o fallidas por motivo')
+metrics.describe('admission_rejected_total', 'Solicitudes rechazadas con 429 por endpoint y motivo')
+request_profiler = RequestProfiler(float(os.getenv('PROFILE_SAMPLE_RATE', '0')))
+
+# Control de admisión de preguntas (RATE_LIMIT_DB comparte las cubetas entre workers)
+if os.getenv('RATE_LIMIT_DB'):
+    rate_buckets = SqliteTokenBuckets(os.getenv('RATE_LIMIT_DB'))
+else:
+    rate_buckets = TokenBuckets(int(os.getenv('RATE_LIMIT_MAX_KEYS', '100000')))
+admission = AdmissionController(
+    rate_buckets,
+    ConcurrencyLimiter(
+        int(os.getenv('ADMISSION_MAX_CONCURRENT', '32')),
+        int(os.getenv('ADMISSION_MAX_QUEUE', '64')),
+        float(os.getenv('ADMISSION_QUEUE_TIMEOUT', '2'))
+    ),
+    session_rate=float(os.getenv('RATE_LIMIT_SESSION_RATE', '1')),
+    session_burst=float(os.getenv('RATE_LIMIT_SESSION_BURST', '10')),
+    ip_rate=float(os.getenv('RATE_LIMIT_IP_RATE', '50')),
+    ip_burst=float(os.getenv('RATE_LIMIT_IP_BURST', '200'))
+)
+
+# Persistencia opcional compartida entre workers
+persistent_store = None
+if os.getenv('PERSISTENCE_DB'):
+    persistent_store = PersistentStore(
+        os.getenv('PERSISTENCE_DB'),
+        flush_interval=float(os.getenv('PERSISTENCE_FLUSH_INTERVAL', '0.5')),
+        batch_size=int(os.getenv('PERSISTENCE_BATCH_SIZE', '500')),
+        id_block_size=int(os.getenv('PERSISTENCE_ID_BLOCK', '1000'))
+    )
+    atexit.register(persistent_store.flush, 5)
+
+# Protege las sesiones y analytics entre hilos del servidor
+store_lock = threading.RLock()
+
+def record_conversations(session_id: str, answered: List[Tuple[str, Dict]]) -> List[ConversationRecord]:
+    # Registra varias respuestas de una sesión en una sola operación
+    if not answered:
+        # Sin respuestas no hay nada que guardar: ni sesión nueva ni cambio de revisión
+        return []
+    first_id = None
+    if persistent_store is not None:
+        # Con varios workers los ids salen de los bloques que cada uno reservó en la base compartida
+        first_id = persistent_store.allocate_conversation_ids(len(answered))
+    now = time.time()
+    with metrics.timer('bookkeeping'), store_lock:
+        # Si la sesión expiró o fue desalojada, se empieza una nueva con el mismo id
+        record = session_store.get_or_create(session_id)
+        if first_id is None:
+            first_id = record.next_conversation_id
+        # Con ids por bloques hay huecos (ids de otras sesiones u otros workers)
+        record.next_conversation_id = max(record.next_conversation_id, first_id + len(answered))
+        entries = []
+        added_bytes = 0
+        for conversation_id, (question, response_data) in enumerate(answered, first_id):
+            conversation_entry = ConversationRecord(
+                conversation_id,
+                question,
+                response_data['response'],
+                response_data.get('subject'),
+                response_data.get('confidence', 0.0),
+                now
+            )
+            record.conversations[conversation_entry.id] = conversation_entry
+            entries.append(conversation_entry)
+            added_bytes += conversation_entry.size
+        
+        subjects = [response_data.get('subject') for _, response_data in answered]
+        record.questions_count += len(answered)
+        record.revision += 1
+        for subject in subjects:
+            record.add_subject(subject or 'general')
+        session_store.resize(session_id, added_bytes)
+        
+        analytics.update_session_stats_bulk(
+            session_id, subjects,
+            [response_data.get('confidence', 0.0) for _, response_data in answered]
+        )
+    
+    if persistent_store is not None:
+        persistent_store.enqueue_conversations(session_id, entries, now)
+    return entries
+
+def validate_question(question) -> str:
+    if not isinstance(question, str) or not question.strip():
+        return 'Pregunta vacía'
+    if len(question.strip()) > 500:
+        return 'Pregunta muy larga'
+    return None
+
+def run_pipeline(questions: List[str]) -> List[Dict]:
+    # Procesa un bloque de preguntas ya validadas: NLP -> búsqueda por lotes -> respuesta.
+    # Puede correr en otro proceso (BATCH_EXECUTOR=process), así que no registra métricas:
+    # cada resultado lleva sus tiempos por etapa y quien llama los observa.
+    results = []
+    processed_questions = []
+    for question in questions:
+        start = time.perf_counter()
+        processed_questions.append(nlp_processor.process_question(question))
+        results.append({'timings': {'process_question': time.perf_counter() - start}})
+    
+    start = time.perf_counter()
+    relevant_contents = answer_cache.search_batch(processed_questions)
+    # La búsqueda es por lotes: a cada pregunta le corresponde su parte del tiempo
+    search_seconds = (time.perf_counter() - start) / max(len(questions), 1)
+    
+    for question, processed_question, relevant_content, result in zip(
+            questions, processed_questions, relevant_contents, results):
+        result['timings']['search'] = search_seconds
+        start = time.perf_counter()
+        try:
+            result['response_data'] = response_generator.generate_response(question, processed_question, relevant_content)
+            result['timings']['generate_response'] = time.perf_counter() - start
+        except Exception as e:
+            app.logger.error(f"Error processing question: {str(e)}")
+            result['error'] = 'Error interno del servidor'
+    return results
+
+BATCH_MAX_QUESTIONS = int(os.getenv('BATCH_MAX_QUESTIONS', '200'))
+BATCH_CHUNK_SIZE = int(os.getenv('BATCH_CHUNK_SIZE', '25'))
+batch_executor = None
+batch_executor_version = None
+batch_executor_lock = threading.Lock()
+
+def get_batch_executor():
+    # 'thread' (por defecto) o 'process'. Los procesos se crean con una copia del índice,
+    # así que el pool se recrea cuando la base de conocimiento cambia de versión.
+    global batch_executor, batch_executor_version
+    with batch_executor_lock:
+        mode = os.getenv('BATCH_EXECUTOR', 'thread')
+        if batch_executor is not None and mode == 'process' and batch_executor_version != knowledge_base.version:
+            batch_executor.shutdown(wait=False)
+            batch_executor = None
+        if batch_executor is None:
+            workers = int(os.getenv('BATCH_WORKERS', str(min(8, os.cpu_count() or 1))))
+            if mode == 'process':
+                batch_executor = ProcessPoolExecutor(max_workers=workers)
+            else:
+                batch_executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='batch')
+            batch_executor_version = knowledge_base.version
+        return batch_executor
+
+@app.before_request
+def start_request_metrics():
+    g.request_start = time.perf_counter()
+    g.profiler = request_profiler.start()
+
+@app.after_request
+def record_request_metrics(response):
+    profiler = g.pop('profiler', None)
+    start = g.pop('request_start', None)
+    endpoint = request.endpoint or 'unknown'
+    
+    def finish():
+        if profiler is not None:
+            request_profiler.stop(profiler)
+        if start is not None:
+            metrics.observe('http_request_duration_seconds', time.perf_counter() - start, endpoint=endpoint)
+            metrics.inc('http_requests_total', endpoint=endpoint, status=response.status_code)
+    
+    if response.is_streamed:
+        # El cuerpo (p. ej. /api/ask/stream) se genera después de after_request: el perfil y
+        # la duración se cierran cuando el servidor cierra la respuesta, como en asgi.py
+        if profiler is not None:
+            response.response = request_profiler.profile_chunks(response.response, profiler)
+        response.call_on_close(finish)
+    else:
+        finish()
+    return response
+
+@app.teardown_request
+def release_request_profiler(exc):
+    # Si la vista falló antes de after_request, la muestra se cierra igual y libera el perfilador
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        request_profiler.stop(profiler)
+
+def collect_gauges() -> Dict[Tuple[str, Tuple], float]:
+    gauges = {}
+    for name, value in answer_cache.stats().items():
+        if isinstance(value, (int, float)):
+            gauges[(f'answer_cache_{name}', ())] = value
+    for store_name, store in (('conversations', session_store), ('analytics', analytics.session_stats)):
+        store_stats = store.stats()
+        gauges[('session_store_sessions', (('store', store_name),))] = store_stats['sessions']
+        gauges[('session_store_bytes', (('store', store_name),))] = store_stats['bytes']
+        gauges[('session_store_expired', (('store', store_name),))] = store_stats['expired']
+        gauges[('session_store_evicted', (('store', store_name),))] = store_stats['evicted']
+    for name, value in render_cache.stats().items():
+        gauges[(f'render_cache_{name}', ())] = value
+    index = knowledge_base.index
+    gauges[('knowledge_entries', ())] = sum(len(entries) for entries in index.knowledge_data.values())
+    gauges[('knowledge_version', ())] = index.version
+    if persistent_store is not None:
+        for name, value in persistent_store.stats().items():
+            gauges[(f'persistence_{name}', ())] = value
+    for name, value in admission.stats().items():
+        gauges[(f'admission_{name}', ())] = value
+    gauges[('profiler_sampled_requests', ())] = request_profiler.sampled
+    return gauges
+
+# Con METRICS_PUBLIC=1 /metrics no pide ADMIN_TOKEN (scraper en una red de confianza)
+METRICS_PUBLIC = os.getenv('METRICS_PUBLIC', '').lower() in ('1', 'true', 'yes')
+
+@app.route('/metrics')
+def metrics_endpoint():
+    denied = None if METRICS_PUBLIC else admin_denied()
+    if denied:
+        return denied
+    return Response(metrics.render(collect_gauges()), mimetype='text/plain; version=0.0.4')
+
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN')
+
+def admin_denied():
+    # Guardia de las rutas de administración (métricas, perfil, exportación): deshabilitadas salvo que
+    # se defina ADMIN_TOKEN; el token llega como 'Authorization: Bearer' o ?token=
+    if not ADMIN_TOKEN:
+        return jsonify({'error': 'Ruta de administración deshabilitada (defina ADMIN_TOKEN)'}), 403
+    token = request.headers.get('Authorization', '').removeprefix('Bearer ').strip() or request.args.get('token', '')
+    if not hmac.compare_digest(token.encode('utf-8'), ADMIN_TOKEN.encode('utf-8')):
+        return jsonify({'error': 'Token de administración inválido'}), 403
+    return None
+
+@app.route('/metrics/profile')
+def profile_report():
+    denied = admin_denied()
+    if denied:
+        return denied
+    try:
+        report = request_profiler.report(
+            limit=request.args.get('limit', 50, type=int),
+            sort=request.args.get('sort', 'cumulative')
+        )
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return Response(report, mimetype='text/plain')
 
-# Almacenamiento en memoria
-conversations = {}
-user_sessions = {}
+@app.route('/metrics/profile/reset', methods=['POST'])
+def profile_reset():
+    denied = admin_denied()
+    if denied:
+        return denied
+    request_profiler.reset()
+    return jsonify({'success': True})
 
 @app.route('/')
 def index():
@@ -417,125 +3444,521 @@ def chat():
     if 'session_id' not in session:
         session['session_id'] = str(uuid.uuid4())
         session['start_time'] = datetime.now().isoformat()
-        conversations[session['session_id']] = []
-        user_sessions[session['session_id']] = {
-            'questions_count': 0,
-            'subjects_covered': set(),
-            'start_time': datetime.now(),
-            'last_activity': datetime.now()
-        }
+    session_store.get_or_create(session['session_id'])
     
     return render_template('chat.html')
 
-@app.route('/api/ask', methods=['POST'])
-def ask_question():
+RATE_LIMIT_MESSAGE = 'Demasiadas preguntas seguidas, espera unos segundos'
+
+def admit_question(endpoint: str, session_id: str, client_ip: str, cost: float = 1) -> int:
+    # None si se admite (liberar luego con admission.release); si no, segundos para Retry-After
+    reason, retry_after = admission.acquire(session_id, client_ip, cost)
+    if reason is None:
+        return None
+    metrics.inc('admission_rejected_total', endpoint=endpoint, reason=reason)
+    return max(1, math.ceil(retry_after))
+
+def too_many_requests(retry_after: int):
+    response = jsonify({'error': RATE_LIMIT_MESSAGE, 'retry_after': retry_after})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+def answer_question(data, session_id: str) -> Dict:
+    # Cuerpo de /api/ask, compartido con el servidor asíncrono (asgi.py)
     try:
-        data = request.get_json()
-        question = data.get('question', '').strip()
+        # Un cuerpo JSON que no es un objeto ([1], "x") o una pregunta que no es texto cuenta como vacía
+        question = data.get('question') if isinstance(data, dict) else None
+        question = question.strip() if isinstance(question, str) else ''
         
         if not question:
-            return jsonify({'error': 'Pregunta vacía'})
+            metrics.inc('ask_errors_total', endpoint='ask', reason='empty')
+            return {'error': 'Pregunta vacía'}
         
         if len(question) > 500:
-            return jsonify({'error': 'Pregunta muy larga'})
+            metrics.inc('ask_errors_total', endpoint='ask', reason='too_long')
+            return {'error': 'Pregunta muy larga'}
         
-        session_id = session.get('session_id')
         if not session_id:
-            return jsonify({'error': 'Sesión no válida'})
+            metrics.inc('ask_errors_total', endpoint='ask', reason='session')
+            return {'error': 'Sesión no válida'}
         
         # Procesar pregunta
-        processed_question = nlp_processor.process_question(question)
+        with metrics.timer('process_question'):
+            processed_question = nlp_processor.process_question(question)
         
-        # Buscar contenido relevante
-        relevant_content = knowledge_base.search(processed_question)
+        # Buscar contenido relevante (con caché)
+        with metrics.timer('search'):
+            relevant_content = answer_cache.search(processed_question)
         
         # Generar respuesta
-        response_data = response_generator.generate_response(
-            question, processed_question, relevant_content
-        )
+        with metrics.timer('generate_response'):
+            response_data = response_generator.generate_response(
+                question, processed_question, relevant_content
+            )
         
-        # Guardar conversación
-        conversation_entry = {
-            'id': len(conversations[session_id]) + 1,
-            'question': question,
+        # Guardar conversación y actualizar estadísticas
+        conversation_entry = record_conversations(session_id, [(question, response_data)])[0]
+        
+        return {
             'response': response_data['response'],
             'subject': response_data.get('subject'),
             'confidence': response_data.get('confidence', 0.0),
-            'timestamp': datetime.now().isoformat(),
-            'feedback_rating': None
+            'suggestions': response_data.get('suggestions', []),
+            'conversation_id': conversation_entry.id
         }
         
-        conversations[session_id].append(conversation_entry)
+    except Exception as e:
+        app.logger.error(f"Error processing question: {str(e)}")
+        metrics.inc('ask_errors_total', endpoint='ask', reason='internal')
+        return {'error': 'Error interno del servidor'}
+
+@app.route('/api/ask', methods=['POST'])
+def ask_question():
+    session_id = session.get('session_id')
+    retry_after = admit_question('ask', session_id, request.remote_addr)
+    if retry_after is not None:
+        return too_many_requests(retry_after)
+    try:
+        return jsonify(answer_question(request.get_json(silent=True), session_id))
+    finally:
+        admission.release()
+
+@app.route('/api/ask/batch', methods=['POST'])
+def ask_batch():
+    # Cada pregunta del lote consume un token de las cubetas de sesión e IP; un lote mayor
+    # que la ráfaga deja la cubeta en negativo (hasta una ráfaga de deuda)
+    data = request.get_json(silent=True)
+    questions = data.get('questions') if isinstance(data, dict) else None
+    cost = len(questions) if isinstance(questions, list) and questions else 1
+    session_id = session.get('session_id')
+    retry_after = admit_question('batch', session_id, request.remote_addr, min(cost, BATCH_MAX_QUESTIONS))
+    if retry_after is not None:
+        return too_many_requests(retry_after)
+    try:
+        return jsonify(answer_batch(data, session_id))
+    finally:
+        admission.release()
+
+def answer_batch(data, session_id: str) -> Dict:
+    # Cuerpo de /api/ask/batch, una vez admitido el lote
+    try:
+        questions = data.get('questions') if isinstance(data, dict) else None
+        
+        if not isinstance(questions, list) or not questions:
+            return {'error': 'Lista de preguntas vacía'}
         
-        # Actualizar estadísticas
-        user_sessions[session_id]['questions_count'] += 1
-        user_sessions[session_id]['subjects_covered'].add(response_data.get('subject', 'general'))
-        user_sessions[session_id]['last_activity'] = datetime.now()
+        if len(questions) > BATCH_MAX_QUESTIONS:
+            return {'error': f'Máximo {BATCH_MAX_QUESTIONS} preguntas por lote'}
+        
+        if not session_id:
+            return {'error': 'Sesión no válida'}
         
-        analytics.update_session_stats(session_id, response_data.get('subject'))
+        results = [None] * len(questions)
+        valid = []
+        for i, question in enumerate(questions):
+            error = validate_question(question)
+            if error:
+                results[i] = {'index': i, 'error': error}
+            else:
+                valid.append((i, question.strip()))
+        
+        # Repartir las preguntas válidas en bloques entre los workers
+        chunks = [valid[start:start + BATCH_CHUNK_SIZE] for start in range(0, len(valid), BATCH_CHUNK_SIZE)]
+        answered = []
+        if len(chunks) == 1:
+            outputs = [run_pipeline([question for _, question in chunks[0]])]
+        else:
+            executor = get_batch_executor()
+            outputs = executor.map(run_pipeline, [[question for _, question in chunk] for chunk in chunks])
+        for chunk, chunk_results in zip(chunks, outputs):
+            for (i, question), result in zip(chunk, chunk_results):
+                for stage, seconds in result['timings'].items():
+                    metrics.observe('stage_duration_seconds', seconds, stage=stage)
+                if 'error' in result:
+                    metrics.inc('ask_errors_total', endpoint='batch', reason='internal')
+                    results[i] = {'index': i, 'error': result['error']}
+                else:
+                    answered.append((i, question, result['response_data']))
+        
+        # Guardar todas las conversaciones de una vez
+        entries = record_conversations(session_id, [(question, response_data) for _, question, response_data in answered])
+        for (i, _, response_data), conversation_entry in zip(answered, entries):
+            results[i] = {
+                'index': i,
+                'response': response_data['response'],
+                'subject': response_data.get('subject'),
+                'confidence': response_data.get('confidence', 0.0),
+                'suggestions': response_data.get('suggestions', []),
+                'conversation_id': conversation_entry.id
+            }
         
-        return jsonify({
+        return {'results': results}
+        
+    except Exception as e:
+        app.logger.error(f"Error processing batch: {str(e)}")
+        metrics.inc('ask_errors_total', endpoint='batch', reason='internal')
+        return {'error': 'Error interno del servidor'}
+
+def sse_event(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def split_sentences(text: str) -> List[str]:
+    # Trozos que conservan el espacio original, así su concatenación es el texto completo
+    return [chunk for chunk in re.split(r'(?<=[.!?:])(?=\s)', text) if chunk]
+
+def stream_answer_events(data, session_id: str):
+    # Eventos SSE de /api/ask/stream, compartidos con el servidor asíncrono (asgi.py).
+    # Un cuerpo que no es un objeto JSON recibe el mismo evento de error que una pregunta vacía
+    question = data.get('question') if isinstance(data, dict) else None
+    error = validate_question(question)
+    if not error and not session_id:
+        error = 'Sesión no válida'
+    
+    # Comentario inicial: el cliente recibe el primer byte antes de procesar la pregunta
+    yield ': ok\n\n'
+    if error:
+        metrics.inc('ask_errors_total', endpoint='stream', reason='invalid')
+        yield sse_event('error', {'error': error})
+        return
+    
+    try:
+        clean_question = question.strip()
+        with metrics.timer('process_question'):
+            processed_question = nlp_processor.process_question(clean_question)
+        with metrics.timer('search'):
+            relevant_content = answer_cache.search(processed_question)
+        
+        response_data = {}
+        texts = []
+        for part, payload in response_generator.generate_response_parts(
+            clean_question, processed_question, relevant_content
+        ):
+            if part == 'meta':
+                response_data.update(payload)
+                yield sse_event('meta', payload)
+            elif part == 'suggestions':
+                response_data['suggestions'] = payload
+                yield sse_event('suggestions', payload)
+            else:
+                if texts:
+                    yield sse_event('delta', {'part': part, 'text': '\n\n'})
+                texts.append(payload)
+                for chunk in split_sentences(payload):
+                    yield sse_event('delta', {'part': part, 'text': chunk})
+        
+        response_data['response'] = '\n\n'.join(texts)
+        # La conversación se registra una sola vez, al completar el stream
+        conversation_entry = record_conversations(session_id, [(clean_question, response_data)])[0]
+        
+        yield sse_event('done', {
             'response': response_data['response'],
             'subject': response_data.get('subject'),
             'confidence': response_data.get('confidence', 0.0),
             'suggestions': response_data.get('suggestions', []),
-            'conversation_id': conversation_entry['id']
+            'conversation_id': conversation_entry.id
         })
-        
     except Exception as e:
         app.logger.error(f"Error processing question: {str(e)}")
-        return jsonify({'error': 'Error interno del servidor'})
+        metrics.inc('ask_errors_total', endpoint='stream', reason='internal')
+        yield sse_event('error', {'error': 'Error interno del servidor'})
+
+SSE_HEADERS = {
+    'Cache-Control': 'no-cache',
+    'X-Accel-Buffering': 'no'
+}
+
+@app.route('/api/ask/stream', methods=['POST'])
+def ask_question_stream():
+    session_id = session.get('session_id')
+    retry_after = admit_question('stream', session_id, request.remote_addr)
+    if retry_after is not None:
+        return too_many_requests(retry_after)
+    data = request.get_json(silent=True)
+    # El cupo se libera cuando el servidor cierra la respuesta, aunque el cliente se vaya antes
+    events = ClosingIterator(stream_answer_events(data, session_id), admission.release)
+    return Response(events, mimetype='text/event-stream', headers=SSE_HEADERS)
+
+FEEDBACK_MIN_RATING = 1
+FEEDBACK_MAX_RATING = 5
+
+def is_int(value) -> bool:
+    # bool es subclase de int, pero true/false no son ids ni calificaciones válidas
+    return isinstance(value, int) and not isinstance(value, bool)
 
 @app.route('/api/feedback', methods=['POST'])
 def submit_feedback():
+    data = request.get_json(silent=True)
+    conversation_id = data.get('conversation_id') if isinstance(data, dict) else None
+    rating = data.get('rating') if isinstance(data, dict) else None
+    # Validar antes de modificar nada: ids y calificaciones enteras (1 a 5)
+    if not is_int(conversation_id) or not is_int(rating) or not FEEDBACK_MIN_RATING <= rating <= FEEDBACK_MAX_RATING:
+        return jsonify({'success': False, 'error': 'Evaluación inválida'}), 400
+    
     try:
-        data = request.get_json()
-        conversation_id = data.get('conversation_id')
-        rating = data.get('rating')
-        
         session_id = session.get('session_id')
-        if session_id and session_id in conversations:
-            for conv in conversations[session_id]:
-                if conv['id'] == conversation_id:
-                    conv['feedback_rating'] = rating
-                    analytics.record_feedback(session_id, rating)
-                    return jsonify({'success': True})
+        record = session_store.get(session_id) if session_id else None
+        conv = record.conversations.get(conversation_id) if record is not None else None
+        if conv is not None:
+            conv.feedback_rating = rating
+            record.revision += 1
+            analytics.record_feedback(session_id, rating)
+            if persistent_store is not None:
+                persistent_store.enqueue_feedback(session_id, conversation_id, rating, time.time())
+            return jsonify({'success': True})
+        
+        # La conversación pudo registrarse en otro worker
+        if session_id and persistent_store is not None and persistent_store.conversation_exists(session_id, conversation_id):
+            analytics.record_feedback(session_id, rating)
+            persistent_store.enqueue_feedback(session_id, conversation_id, rating, time.time())
+            return jsonify({'success': True})
         
         return jsonify({'success': False, 'error': 'Conversación no encontrada'})
         
     except Exception as e:
-        return jsonify({'success': False, 'error': str(e)})
+        app.logger.error(f"Error submitting feedback: {str(e)}")
+        return jsonify({'success': False, 'error': 'Error interno del servidor'})
+
+HISTORY_MAX_LIMIT = int(os.getenv('HISTORY_MAX_LIMIT', '200'))
+# Distingue los ETag de este proceso: sin persistencia cada worker tiene su propio historial
+HISTORY_ETAG_SEED = uuid.uuid4().hex
+
+def history_etag(source: str, session_id: str, revision: int, cursor: int, limit: int, summary: bool) -> str:
+    key = f'{source}:{session_id}:{revision}:{cursor}:{limit}:{int(summary)}'
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+def history_response(payload: Dict, etag: str):
+    response = jsonify(payload)
+    # Débil: session_duration cambia con el tiempo sin que cambie el historial
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+def history_not_modified(etag: str):
+    response = app.response_class(status=304)
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
 
 @app.route('/api/history')
 def get_conversation_history():
     session_id = session.get('session_id')
-    if session_id and session_id in conversations:
-        return jsonify({
-            'conversations': conversations[session_id],
+    cursor = max(request.args.get('cursor', 0, type=int), 0)
+    limit = min(max(request.args.get('limit', HISTORY_MAX_LIMIT, type=int), 1), HISTORY_MAX_LIMIT)
+    summary = request.args.get('summary', '').lower() in ('1', 'true', 'yes')
+    
+    if session_id and persistent_store is not None:
+        # Incluir las escrituras pendientes de este worker antes de leer
+        persistent_store.flush(timeout=1)
+        revision = persistent_store.get_revision(session_id)
+        if revision is not None:
+            etag = history_etag('db', session_id, revision, cursor, limit, summary)
+            if request.if_none_match.contains_weak(etag):
+                return history_not_modified(etag)
+            history = persistent_store.get_history(session_id, cursor, limit, summary)
+            if history is not None:
+                return history_response(history, etag)
+    
+    record = session_store.get(session_id) if session_id else None
+    if record is not None:
+        etag = history_etag(HISTORY_ETAG_SEED, session_id, record.revision, cursor, limit, summary)
+        if request.if_none_match.contains_weak(etag):
+            return history_not_modified(etag)
+        
+        page, next_cursor = record.history_page(cursor, limit)
+        return history_response({
+            'conversations': [conv.to_dict(summary) for conv in page],
+            'next_cursor': next_cursor,
             'session_stats': {
-                'questions_count': user_sessions[session_id]['questions_count'],
-                'subjects_covered': list(user_sessions[session_id]['subjects_covered']),
-                'session_duration': str(datetime.now() - user_sessions[session_id]['start_time'])
+                'questions_count': record.questions_count,
+                'subjects_covered': list(record.subjects_covered),
+                'session_duration': str(timedelta(seconds=time.time() - record.start_time))
             }
-        })
+        }, etag)
     
-    return jsonify({'conversations': [], 'session_stats': {}})
+    return jsonify({'conversations': [], 'next_cursor': None, 'session_stats': {}})
+
+EXPORT_PAGE_SIZE = int(os.getenv('EXPORT_PAGE_SIZE', '500'))
+EXPORT_COLUMNS = {
+    'conversations': ('cursor', 'session_id', 'conversation_id', 'timestamp', 'subject', 'confidence',
+                      'feedback_rating', 'question', 'response'),
+    'feedback': ('cursor', 'session_id', 'conversation_id', 'timestamp', 'rating', 'subject'),
+    'daily_usage': ('cursor', 'day', 'questions')
+}
+EXPORT_FORMATS = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+
+def parse_export_date(value: str, end: bool = False) -> datetime:
+    # Fechas ISO en hora local; un 'to' sin hora incluye el día completo (el fin es exclusivo)
+    try:
+        moment = datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f'Fecha inválida: {value}')
+    if moment.tzinfo is not None:
+        moment = moment.astimezone().replace(tzinfo=None)
+    if end and len(value) == 10:
+        moment += timedelta(days=1)
+    return moment
+
+def export_rows(dataset: str, date_from: str = None, date_to: str = None, subject: str = None, cursor: str = None):
+    # Filas de conversations, feedback o daily_usage. Con persistencia se lee la base compartida;
+    # sin ella, la memoria de este worker (solo las sesiones que aún no expiraron).
+    if dataset not in EXPORT_COLUMNS:
+        raise ValueError(f"Dataset desconocido: {dataset} (opciones: {', '.join(EXPORT_COLUMNS)})")
+    if subject and dataset == 'daily_usage':
+        raise ValueError('daily_usage no admite filtro por materia')
+    start = parse_export_date(date_from) if date_from else None
+    end = parse_export_date(date_to, end=True) if date_to else None
+    
+    if persistent_store is not None:
+        # Incluir las escrituras pendientes de este worker antes de leer
+        persistent_store.flush(timeout=1)
+        return persistent_store.export_rows(dataset, start, end, subject, cursor, EXPORT_PAGE_SIZE)
+    
+    if dataset == 'daily_usage':
+        return export_memory_usage(start, end, cursor)
+    after_session, _, after_id = (cursor or '').rpartition(':')
+    try:
+        after_id = int(after_id) if cursor else 0
+    except ValueError:
+        raise ValueError('Cursor inválido')
+    return export_memory_conversations(dataset, start, end, subject, after_session, after_id)
+
+def export_memory_usage(start: datetime, end: datetime, cursor: str):
+    with analytics.lock:
+        days = list(analytics.global_stats['daily_usage'].items())
+    first = start.date().isoformat() if start else ''
+    last = (end - timedelta(microseconds=1)).date().isoformat() if end else None
+    for day, questions in days:
+        if day > (cursor or '') and day >= first and (last is None or day <= last):
+            yield (day, day, questions)
+
+def export_memory_conversations(dataset: str, start: datetime, end: datetime, subject: str,
+                                after_session: str, after_id: int):
+    # Sesiones en orden de id (estable, a diferencia del orden LRU) y conversaciones en orden
+    # de creación; el cursor es 'sesión:conversación'. Solo se copia una sesión a la vez.
+    start_ts = start.timestamp() if start else None
+    end_ts = end.timestamp() if end else None
+    with session_store.lock:
+        session_ids = sorted(session_store.sessions)
+    for session_id in session_ids[bisect.bisect_left(session_ids, after_session):]:
+        with store_lock:
+            record = session_store.get(session_id, touch=False)
+            conversations = sorted(record.conversations.values(), key=lambda conv: conv.id) if record is not None else []
+        for conv in conversations:
+            if session_id == after_session and conv.id <= after_id:
+                continue
+            if dataset == 'feedback' and conv.feedback_rating is None:
+                continue
+            if (start_ts is not None and conv.timestamp < start_ts) or (end_ts is not None and conv.timestamp >= end_ts):
+                continue
+            if subject and conv.subject != subject:
+                continue
+            timestamp = datetime.fromtimestamp(conv.timestamp).isoformat()
+            if dataset == 'conversations':
+                yield (f'{session_id}:{conv.id}', session_id, conv.id, timestamp, conv.subject, conv.confidence,
+                       conv.feedback_rating, conv.question, conv.response)
+            else:
+                # En memoria no se guarda la hora de la evaluación: se usa la de la conversación
+                yield (f'{session_id}:{conv.id}', session_id, conv.id, timestamp, conv.feedback_rating, conv.subject)
+
+def export_chunks(rows, columns: Tuple[str, ...], export_format: str, batch_size: int = EXPORT_PAGE_SIZE):
+    # Serializa en bloques de batch_size filas: memoria constante y pocos fragmentos de respuesta.
+    # Cada fila lleva su cursor, para retomar una descarga interrumpida desde la última recibida.
+    buffer = io.StringIO()
+    writer = csv.writer(buffer) if export_format == 'csv' else None
+    if writer is not None:
+        writer.writerow(columns)
+    count = 0
+    for row in rows:
+        if writer is not None:
+            writer.writerow(row)
+        else:
+            buffer.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False) + '\n')
+        count += 1
+        if count % batch_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+@app.route('/api/export/<dataset>')
+def export_dataset(dataset):
+    # Exportación masiva para reportes, detrás de la guardia de administración
+    denied = admin_denied()
+    if denied:
+        return denied
+    
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({'error': f"Formato desconocido: {export_format} (opciones: {', '.join(EXPORT_FORMATS)})"}), 400
+    try:
+        rows = export_rows(
+            dataset,
+            request.args.get('from'),
+            request.args.get('to'),
+            request.args.get('subject'),
+            request.args.get('cursor')
+        )
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    return Response(
+        export_chunks(rows, EXPORT_COLUMNS[dataset], export_format),
+        mimetype=EXPORT_FORMATS[export_format],
+        headers={
+            'Cache-Control': 'no-store',
+            'Content-Disposition': f'attachment; filename={dataset}.{export_format}'
+        }
+    )
+
+@app.route('/api/cache/stats')
+def cache_stats():
+    return jsonify(answer_cache.stats())
+
+@app.route('/api/sessions/stats')
+def session_store_stats():
+    return jsonify({
+        'conversations': session_store.stats(),
+        'analytics': analytics.session_stats.stats(),
+        'persistence': persistent_store.stats() if persistent_store is not None else None
+    })
+
+def cached_page(name: str, key, render, cache_control: str, max_age: float = None):
+    body, etag, modified = render_cache.get(name, key, render, max_age)
+    response = app.response_class(body, mimetype='text/html')
+    response.set_etag(etag)
+    response.last_modified = modified
+    response.headers['Cache-Control'] = cache_control
+    # Responde 304 si coincide If-None-Match o If-Modified-Since
+    return response.make_conditional(request)
 
 @app.route('/dashboard')
 def dashboard():
-    stats = analytics.get_general_stats()
-    return render_template('dashboard.html', stats=stats)
+    def render():
+        stats = persistent_store.get_general_stats() if persistent_store is not None else analytics.get_general_stats()
+        return render_template('dashboard.html', stats=stats)
+    
+    # Las estadísticas pueden tener unos segundos de antigüedad
+    max_age = max(int(DASHBOARD_CACHE_SECONDS), 0)
+    return cached_page('dashboard', None, render, f'public, max-age={max_age}', DASHBOARD_CACHE_SECONDS)
 
 @app.route('/knowledge')
 def knowledge_view():
-    subjects = {}
-    for subject, entries in knowledge_base.knowledge_data.items():
-        subjects[subject] = {
-            'name': subject.title(),
-            'topics_count': len(entries),
-            'topics': [entry['topic'] for entry in entries]
-        }
-    return render_template('knowledge.html', subjects=subjects)
+    index = knowledge_base.index
+    
+    def render():
+        subjects = {}
+        for subject, entries in index.knowledge_data.items():
+            subjects[subject] = {
+                'name': subject.title(),
+                'topics_count': len(entries),
+                'topics': [entry['topic'] for entry in entries]
+            }
+        return render_template('knowledge.html', subjects=subjects)
+    
+    # Válida mientras no cambie la versión de la base; el navegador siempre revalida
+    return cached_page('knowledge', index.version, render, 'public, no-cache')
 
 @app.route('/help')
 def help_page():
@@ -549,5 +3972,65 @@ def not_found(error):
 def internal_error(error):
     return render_template('500.html'), 500
 
+@app.cli.command('dump-knowledge')
+@click.argument('directory')
+def dump_knowledge(directory):
+    """Exporta la base de conocimiento actual como un archivo JSONL por materia."""
+    os.makedirs(directory, exist_ok=True)
+    for subject, entries in knowledge_base.knowledge_data.items():
+        path = os.path.join(directory, f'{subject}.jsonl')
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            for entry in entries:
+                f.write(json.dumps(dict(entry), ensure_ascii=False) + '\n')
+        os.replace(path + '.tmp', path)
+        click.echo(f'{path}: {len(entries)} entradas')
+
+@app.cli.command('build-snapshot')
+@click.argument('path', required=False)
+def build_snapshot(path):
+    """Compila la base de conocimiento y sus índices en un snapshot binario."""
+    path = path or knowledge_base.snapshot_path
+    if not path:
+        raise click.UsageError('Indique la ruta del snapshot o defina KNOWLEDGE_SNAPSHOT')
+    signatures = None
+    if knowledge_base.source is not None:
+        # Firmas de los archivos con los que se construyó el índice actual
+        signatures = knowledge_base.snapshot_signatures or {
+            segment.path: segment.signature for segment in knowledge_base.source.segments.values()
+        }
+    index = knowledge_base.index
+    if not isinstance(index, KnowledgeIndex):
+        # El snapshot guarda el índice único aunque la app corra particionada por materia
+        index = KnowledgeIndex(
+            index.knowledge_data, knowledge_base.ranking_backend, index.version, vocabulary=index.vocabulary()
+        )
+    header = write_knowledge_snapshot(path, index, knowledge_base.fingerprint(signatures))
+    click.echo(f"{path}: {header['entry_count']} entradas, ranking {header['ranker'] or 'keyword'}, "
+               f"{os.path.getsize(path)} bytes")
+
+@app.cli.command('export')
+@click.argument('dataset', type=click.Choice(list(EXPORT_COLUMNS)))
+@click.option('--format', 'export_format', type=click.Choice(list(EXPORT_FORMATS)), default='ndjson')
+@click.option('--from', 'date_from', help='Fecha o fecha-hora ISO inicial (incluida)')
+@click.option('--to', 'date_to', help='Fecha o fecha-hora ISO final (un día sin hora se incluye completo)')
+@click.option('--subject', help='Solo esta materia')
+@click.option('--cursor', help='Continuar después de este cursor (columna cursor de la última fila)')
+@click.option('--output', '-o', type=click.Path(dir_okay=False), help='Archivo de salida (por defecto stdout)')
+def export_command(dataset, export_format, date_from, date_to, subject, cursor, output):
+    """Exporta conversaciones, evaluaciones o uso diario desde la base persistente."""
+    if persistent_store is None:
+        raise click.UsageError('La exportación por CLI lee la base compartida: defina PERSISTENCE_DB')
+    try:
+        rows = export_rows(dataset, date_from, date_to, subject, cursor)
+    except ValueError as e:
+        raise click.UsageError(str(e))
+    stream = open(output, 'w', encoding='utf-8', newline='') if output else click.get_text_stream('stdout')
+    try:
+        for chunk in export_chunks(rows, EXPORT_COLUMNS[dataset], export_format):
+            stream.write(chunk)
+    finally:
+        if output:
+            stream.close()
+
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
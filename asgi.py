@@ -0,0 +1,285 @@
+"""Punto de entrada asíncrono (ASGI) para producción.
+
+    uvicorn asgi:application --workers 4
+    python asgi.py                      # requiere uvicorn (opcional)
+
+Las rutas calientes (/api/ask, /api/ask/batch y /api/ask/stream) se atienden de forma
+nativa: la conexión queda en el event loop y solo la búsqueda y la generación de la
+respuesta pasan a un pool de hilos, así miles de conexiones ociosas o en streaming no
+ocupan un hilo cada una. La espera en la cola de admisión usa un pool aparte, para que las
+solicitudes encoladas no dejen sin hilos a las ya admitidas. El
+resto de las rutas (páginas, historial, métricas...) se delegan a la app Flask a través de
+un adaptador WSGI que también corre en el pool. Plantillas y formatos JSON no cambian.
+"""
+import asyncio
+import io
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from itsdangerous import BadSignature
+from werkzeug.http import parse_cookie
+
+from app import (
+    app, answer_question, answer_batch, stream_answer_events, metrics, SSE_HEADERS,
+    admission, admit_question, forwarded_client, RATE_LIMIT_MESSAGE, BATCH_MAX_QUESTIONS
+)
+
+ASGI_THREADS = int(os.getenv('ASGI_THREADS', '32'))
+
+executor = ThreadPoolExecutor(max_workers=ASGI_THREADS, thread_name_prefix='asgi')
+# Como mucho max_waiting hilos quedan bloqueados en la cola de admisión; los demás
+# resuelven al instante (admitir o rechazar) y nunca esperan detrás de la búsqueda
+admission_executor = ThreadPoolExecutor(
+    max_workers=admission.limiter.max_waiting + 4, thread_name_prefix='asgi-admission'
+)
+# Misma firma y vencimiento que la sesión de Flask (SecureCookieSessionInterface)
+session_serializer = app.session_interface.get_signing_serializer(app)
+
+
+def header_value(scope, name: bytes) -> str:
+    values = [value.decode('latin-1') for key, value in scope['headers'] if key == name]
+    return ', '.join(values) if values else ''
+
+
+def read_session_id(scope) -> str:
+    cookie = parse_cookie(header_value(scope, b'cookie')).get(app.config['SESSION_COOKIE_NAME'])
+    if not cookie or session_serializer is None:
+        return None
+    try:
+        data = session_serializer.loads(cookie, max_age=int(app.permanent_session_lifetime.total_seconds()))
+    except BadSignature:
+        return None
+    return data.get('session_id')
+
+
+def parse_json(scope, body: bytes):
+    # Igual que request.get_json(silent=True): None si no es JSON o no se puede leer
+    mimetype = header_value(scope, b'content-type').split(';')[0].strip().lower()
+    if mimetype != 'application/json' and not (mimetype.startswith('application/') and mimetype.endswith('+json')):
+        return None
+    try:
+        return app.json.loads(body)
+    except ValueError:
+        return None
+
+
+async def read_body(receive) -> bytes:
+    chunks = []
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            break
+    return b''.join(chunks)
+
+
+def record_request(endpoint: str, status: int, start: float):
+    # Las rutas nativas no pasan por before_request/after_request de Flask
+    metrics.observe('http_request_duration_seconds', time.perf_counter() - start, endpoint=endpoint)
+    metrics.inc('http_requests_total', endpoint=endpoint, status=status)
+
+
+async def send_json(send, status: int, payload, headers=()):
+    body = (app.json.dumps(payload) + '\n').encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())] + list(headers)
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def admit(scope, send, endpoint: str, session_id: str, cost: float = 1) -> bool:
+    # Mismo control de admisión que en Flask; la espera en la cola ocurre en su propio pool.
+    # Detrás de proxies de confianza la IP sale de X-Forwarded-For, como con ProxyFix
+    client = scope.get('client') or ('', 0)
+    client_ip = forwarded_client(client[0], header_value(scope, b'x-forwarded-for'))
+    loop = asyncio.get_running_loop()
+    retry_after = await loop.run_in_executor(
+        admission_executor, admit_question, endpoint, session_id, client_ip, cost
+    )
+    if retry_after is None:
+        return True
+    await send_json(
+        send, 429, {'error': RATE_LIMIT_MESSAGE, 'retry_after': retry_after},
+        [(b'retry-after', str(retry_after).encode())]
+    )
+    return False
+
+
+async def ask(scope, receive, send):
+    start = time.perf_counter()
+    data = parse_json(scope, await read_body(receive))
+    session_id = read_session_id(scope)
+    if not await admit(scope, send, 'ask', session_id):
+        record_request('ask_question', 429, start)
+        return
+    loop = asyncio.get_running_loop()
+    try:
+        payload = await loop.run_in_executor(executor, answer_question, data, session_id)
+    finally:
+        admission.release()
+    await send_json(send, 200, payload)
+    record_request('ask_question', 200, start)
+
+
+async def ask_batch(scope, receive, send):
+    start = time.perf_counter()
+    data = parse_json(scope, await read_body(receive))
+    questions = data.get('questions') if isinstance(data, dict) else None
+    cost = len(questions) if isinstance(questions, list) and questions else 1
+    session_id = read_session_id(scope)
+    if not await admit(scope, send, 'batch', session_id, min(cost, BATCH_MAX_QUESTIONS)):
+        record_request('ask_batch', 429, start)
+        return
+    loop = asyncio.get_running_loop()
+    try:
+        payload = await loop.run_in_executor(executor, answer_batch, data, session_id)
+    finally:
+        admission.release()
+    await send_json(send, 200, payload)
+    record_request('ask_batch', 200, start)
+
+
+async def ask_stream(scope, receive, send):
+    start = time.perf_counter()
+    data = parse_json(scope, await read_body(receive))
+    session_id = read_session_id(scope)
+    if not await admit(scope, send, 'stream', session_id):
+        record_request('ask_question_stream', 429, start)
+        return
+    events = stream_answer_events(data, session_id)
+    loop = asyncio.get_running_loop()
+
+    disconnected = asyncio.Event()
+
+    async def watch_disconnect():
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+        disconnected.set()
+
+    watcher = asyncio.create_task(watch_disconnect())
+    headers = [(b'content-type', b'text/event-stream; charset=utf-8')]
+    headers += [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in SSE_HEADERS.items()]
+    try:
+        await send({'type': 'http.response.start', 'status': 200, 'headers': headers})
+        while not disconnected.is_set():
+            # Cada evento se genera en el pool; el loop sigue atendiendo otras conexiones
+            chunk = await loop.run_in_executor(executor, next, events, None)
+            if chunk is None:
+                break
+            await send({'type': 'http.response.body', 'body': chunk.encode('utf-8'), 'more_body': True})
+        if not disconnected.is_set():
+            await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        watcher.cancel()
+        # Si el cliente se fue antes del final, la conversación no se registra (igual que en Flask)
+        await loop.run_in_executor(executor, events.close)
+        admission.release()
+        record_request('ask_question_stream', 200, start)
+
+
+NATIVE_ROUTES = {
+    ('POST', '/api/ask'): ask,
+    ('POST', '/api/ask/batch'): ask_batch,
+    ('POST', '/api/ask/stream'): ask_stream
+}
+
+
+def wsgi_environ(scope, body: bytes) -> dict:
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        if name == 'CONTENT_LENGTH':
+            continue
+        key = name if name == 'CONTENT_TYPE' else f'HTTP_{name}'
+        value = value.decode('latin-1')
+        environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+
+async def call_flask(scope, receive, send):
+    # Adaptador WSGI: la app Flask corre en el pool y su cuerpo se envía por partes
+    body = await read_body(receive)
+    loop = asyncio.get_running_loop()
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started['status'] = int(status.split(' ', 1)[0])
+        started['headers'] = [
+            (name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers
+        ]
+        return lambda data: None
+
+    result = await loop.run_in_executor(executor, app.wsgi_app, wsgi_environ(scope, body), start_response)
+    chunks = iter(result)
+    try:
+        chunk = await loop.run_in_executor(executor, next, chunks, None)
+        await send({'type': 'http.response.start', 'status': started['status'], 'headers': started['headers']})
+        while chunk is not None:
+            if chunk:
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            chunk = await loop.run_in_executor(executor, next, chunks, None)
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        if hasattr(result, 'close'):
+            await loop.run_in_executor(executor, result.close)
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            executor.shutdown(wait=False)
+            admission_executor.shutdown(wait=False)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+    handler = NATIVE_ROUTES.get((scope['method'], scope['path']), call_flask)
+    await handler(scope, receive, send)
+
+
+if __name__ == '__main__':
+    try:
+        import uvicorn
+    except ImportError:
+        sys.exit('El modo asíncrono requiere uvicorn: pip install uvicorn')
+    uvicorn.run(
+        'asgi:application',
+        host=os.getenv('HOST', '0.0.0.0'),
+        port=int(os.getenv('PORT', '8000')),
+        workers=int(os.getenv('WEB_CONCURRENCY', '1'))
+    )
@@ -0,0 +1,299 @@
+"""Microbenchmarks del pipeline de preguntas.
+
+Genera corpus sintéticos (JSONL con distribución Zipf de palabras clave en
+español) y conjuntos de preguntas, y mide latencia y throughput de cada etapa:
+SimpleNLPProcessor, SimpleKnowledgeBase (por backend de ranking),
+SimpleResponseGenerator y /api/ask de punta a punta con el cliente de pruebas
+de Flask. Los resultados se escriben en JSON para comparar entre commits.
+
+Uso:
+    python benchmarks/bench_pipeline.py --sizes 1000,10000,100000 --output bench.json
+    python benchmarks/bench_pipeline.py --sizes 1000 --compare bench.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import app as app_module  # noqa: E402
+
+SYLLABLES = [
+    'ca', 'lo', 'ra', 'te', 'ma', 'ti', 'co', 'de', 'ri', 'va', 'ción', 'sis', 'tro', 'gen',
+    'fo', 'to', 'qui', 'mi', 'ló', 'gi', 'cá', 'nes', 'pa', 'ro', 'no', 'sa', 'li', 'za'
+]
+FILLER_WORDS = [
+    'el', 'la', 'los', 'las', 'de', 'del', 'en', 'un', 'una', 'que', 'se', 'por', 'para',
+    'con', 'es', 'son', 'como', 'sobre', 'entre', 'cada', 'cuando', 'donde', 'también'
+]
+QUESTION_TEMPLATES = [
+    '¿Qué es {0}?',
+    '¿Qué es la {0} y la {1}?',
+    '¿Cómo se calcula {0}?',
+    'Explica la diferencia entre {0} y {1}',
+    '¿Por qué {0} depende de {1}?',
+    'Dame un ejemplo de {0} con {1} y {2}',
+    'Resuelve un problema de {0}'
+]
+
+
+class ZipfVocabulary:
+    # Vocabulario por materia: las palabras clave reales primero (más frecuentes)
+    # y luego términos sintéticos con pesos 1/rango^s.
+    def __init__(self, rng: random.Random, seed_words, size: int, exponent: float = 1.1):
+        words = list(dict.fromkeys(seed_words))
+        seen = set(words)
+        while len(words) < size:
+            word = ''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4)))
+            if word not in seen:
+                seen.add(word)
+                words.append(word)
+        self.words = words
+        weights = [1 / (rank ** exponent) for rank in range(1, len(words) + 1)]
+        total = 0.0
+        self.cum_weights = []
+        for weight in weights:
+            total += weight
+            self.cum_weights.append(total)
+
+    def sample(self, rng: random.Random, k: int):
+        return rng.choices(self.words, cum_weights=self.cum_weights, k=k)
+
+
+def build_vocabularies(rng: random.Random, corpus_size: int):
+    subject_keywords = app_module.SimpleNLPProcessor().subject_keywords
+    # El vocabulario crece con el corpus, como en un currículo real
+    size = max(200, min(50000, corpus_size // 10))
+    return {
+        subject: ZipfVocabulary(rng, keywords, size)
+        for subject, keywords in subject_keywords.items()
+    }
+
+
+def write_corpus(directory: str, corpus_size: int, vocabularies, rng: random.Random):
+    subjects = list(vocabularies)
+    files = {subject: open(os.path.join(directory, f'{subject}.jsonl'), 'w', encoding='utf-8') for subject in subjects}
+    try:
+        for entry_id in range(1, corpus_size + 1):
+            subject = subjects[entry_id % len(subjects)]
+            vocabulary = vocabularies[subject]
+            keywords = list(dict.fromkeys(vocabulary.sample(rng, 6)))[:5]
+            content_words = vocabulary.sample(rng, 40) + rng.choices(FILLER_WORDS, k=30)
+            rng.shuffle(content_words)
+            entry = {
+                'id': entry_id,
+                'topic': ' '.join(word.capitalize() for word in keywords[:2]),
+                'content': ' '.join(content_words) + '.',
+                'keywords': keywords,
+                'difficulty_level': rng.choice(['basic', 'intermediate', 'advanced'])
+            }
+            files[subject].write(json.dumps(entry, ensure_ascii=False) + '\n')
+    finally:
+        for f in files.values():
+            f.close()
+
+
+def generate_questions(count: int, vocabularies, rng: random.Random):
+    subjects = list(vocabularies)
+    questions = []
+    for _ in range(count):
+        vocabulary = vocabularies[rng.choice(subjects)]
+        template = rng.choice(QUESTION_TEMPLATES)
+        questions.append(template.format(*vocabulary.sample(rng, 3)))
+    return questions
+
+
+def summarize(stage: str, latencies_ns, extra=None):
+    latencies_ms = sorted(value / 1e6 for value in latencies_ns)
+    total_seconds = sum(latencies_ns) / 1e9
+
+    def percentile(p):
+        index = min(len(latencies_ms) - 1, max(0, round(p / 100 * len(latencies_ms)) - 1))
+        return latencies_ms[index]
+
+    result = {
+        'stage': stage,
+        'ops': len(latencies_ms),
+        'throughput_ops_per_s': len(latencies_ms) / total_seconds if total_seconds else None,
+        'mean_ms': statistics.fmean(latencies_ms),
+        'p50_ms': percentile(50),
+        'p90_ms': percentile(90),
+        'p99_ms': percentile(99),
+        'max_ms': latencies_ms[-1]
+    }
+    result.update(extra or {})
+    return result
+
+
+def measure(function, items):
+    latencies = []
+    for item in items:
+        start = time.perf_counter_ns()
+        function(item)
+        latencies.append(time.perf_counter_ns() - start)
+    return latencies
+
+
+def bench_corpus(corpus_size: int, backends, question_count: int, batch_size: int, seed: int, end_to_end: bool):
+    rng = random.Random(seed)
+    vocabularies = build_vocabularies(rng, corpus_size)
+    questions = generate_questions(question_count, vocabularies, rng)
+    results = []
+
+    nlp = app_module.SimpleNLPProcessor()
+    processed = [nlp.process_question(question) for question in questions]
+    results.append(summarize('process_question', measure(nlp.process_question, questions),
+                             {'corpus_size': corpus_size, 'backend': None}))
+
+    with tempfile.TemporaryDirectory(prefix='kb-bench-') as directory:
+        start = time.perf_counter()
+        write_corpus(directory, corpus_size, vocabularies, rng)
+        generation_seconds = time.perf_counter() - start
+
+        for backend in backends:
+            labels = {'corpus_size': corpus_size, 'backend': backend}
+            start = time.perf_counter()
+            knowledge_base = app_module.SimpleKnowledgeBase(ranking_backend=backend, source_path=directory)
+            build_seconds = time.perf_counter() - start
+            results.append({
+                'stage': 'build_index', 'ops': 1, 'seconds': build_seconds,
+                'corpus_generation_seconds': generation_seconds, **labels
+            })
+
+            results.append(summarize('search', measure(knowledge_base.search, processed), labels))
+
+            batches = [processed[i:i + batch_size] for i in range(0, len(processed), batch_size)]
+            batch_latencies = measure(knowledge_base.search_batch, batches)
+            results.append(summarize('search_batch', batch_latencies, {
+                **labels, 'batch_size': batch_size,
+                'questions_per_s': len(processed) / (sum(batch_latencies) / 1e9)
+            }))
+
+            generator = app_module.SimpleResponseGenerator()
+            relevant = [knowledge_base.search(processed_question) for processed_question in processed]
+            results.append(summarize('generate_response', measure(
+                lambda item: generator.generate_response(item[0], item[1], item[2]),
+                list(zip(questions, processed, relevant))
+            ), labels))
+
+            if end_to_end:
+                results.append(summarize('api_ask', bench_api_ask(knowledge_base, questions), labels))
+    return results
+
+
+def bench_api_ask(knowledge_base, questions):
+    # Sustituye la base de conocimiento de la app y desactiva la caché y el control de
+    # admisión (todas las preguntas salen de una sola sesión) para medir el pipeline completo
+    original = (app_module.knowledge_base, app_module.answer_cache, app_module.admission)
+    app_module.knowledge_base = knowledge_base
+    app_module.answer_cache = app_module.AnswerCache(knowledge_base, max_entries=0)
+    app_module.admission = app_module.AdmissionController(
+        app_module.TokenBuckets(), app_module.ConcurrencyLimiter(0, 0, 0),
+        session_rate=0, session_burst=0, ip_rate=0, ip_burst=0
+    )
+    try:
+        client = app_module.app.test_client()
+        client.get('/chat')
+
+        def ask(question):
+            response = client.post('/api/ask', json={'question': question})
+            if response.status_code != 200:
+                raise RuntimeError(f'/api/ask devolvió {response.status_code}')
+
+        return measure(ask, questions)
+    finally:
+        app_module.knowledge_base, app_module.answer_cache, app_module.admission = original
+
+
+def environment_metadata():
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'numpy': getattr(app_module.np, '__version__', None)
+    }
+
+
+def result_key(result):
+    return (result['stage'], result.get('corpus_size'), result.get('backend'))
+
+
+def compare(current, baseline_path: str, threshold: float):
+    # Compara p50 (o duración total) contra un resultado anterior; devuelve las regresiones
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = {result_key(result): result for result in json.load(f)['results']}
+    regressions = []
+    print(f"\n{'etapa':<18} {'corpus':>9} {'backend':<8} {'antes':>10} {'ahora':>10} {'cambio':>8}")
+    for result in current:
+        previous = baseline.get(result_key(result))
+        metric = 'p50_ms' if 'p50_ms' in result else 'seconds'
+        if previous is None or metric not in previous:
+            continue
+        before, after = previous[metric], result[metric]
+        change = (after - before) / before if before else 0.0
+        flag = ' !' if change > threshold else ''
+        print(f"{result['stage']:<18} {result.get('corpus_size') or '':>9} {result.get('backend') or '':<8} "
+              f"{before:>10.4f} {after:>10.4f} {change:>+7.1%}{flag}")
+        if change > threshold:
+            regressions.append(result_key(result))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='1000,10000,100000',
+                        help='tamaños de corpus separados por coma (hasta 1000000)')
+    parser.add_argument('--backends', default='keyword,bm25,dense', help='backends de ranking a medir')
+    parser.add_argument('--questions', type=int, default=500, help='preguntas por corpus')
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--seed', type=int, default=1234)
+    parser.add_argument('--no-end-to-end', action='store_true', help='omitir /api/ask con el cliente de Flask')
+    parser.add_argument('--output', help='archivo JSON de resultados')
+    parser.add_argument('--compare', help='JSON de una corrida anterior para detectar regresiones')
+    parser.add_argument('--threshold', type=float, default=0.10, help='regresión tolerada (fracción)')
+    args = parser.parse_args()
+
+    results = []
+    for size in [int(value) for value in args.sizes.split(',') if value]:
+        print(f'corpus de {size} entradas...', file=sys.stderr)
+        results.extend(bench_corpus(
+            size, [backend for backend in args.backends.split(',') if backend],
+            args.questions, args.batch_size, args.seed, not args.no_end_to_end
+        ))
+
+    for result in results:
+        if 'p50_ms' in result:
+            print(f"{result['stage']:<18} {result['corpus_size'] or '':>9} {result['backend'] or '':<8} "
+                  f"p50={result['p50_ms']:.3f}ms p99={result['p99_ms']:.3f}ms "
+                  f"{result['throughput_ops_per_s']:.0f} ops/s")
+        else:
+            print(f"{result['stage']:<18} {result['corpus_size']:>9} {result['backend']:<8} {result['seconds']:.2f}s")
+
+    report = {'meta': environment_metadata(), 'results': results}
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        regressions = compare(results, args.compare, args.threshold)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
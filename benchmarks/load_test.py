@@ -0,0 +1,352 @@
+"""Prueba de carga: reproduce un registro de preguntas contra la app.
+
+Lanza una instancia local (o usa --url), crea muchas sesiones simuladas con su
+propia cookie (/chat) e intercala /api/ask, /api/feedback, /api/history y
+/dashboard a un QPS objetivo en lazo abierto. La latencia se mide desde el
+instante programado, así las demoras de cola no quedan ocultas. Informa
+p50/p95/p99 por endpoint, tasa de errores, throughput y el crecimiento de la
+memoria del proceso servidor a lo largo del tiempo.
+
+Uso:
+    python benchmarks/load_test.py --qps 50 --duration 60 --sessions 200
+    python benchmarks/load_test.py --log preguntas.txt --url http://localhost:5000 --pid 1234
+"""
+import argparse
+import http.cookiejar
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_MIX = 'ask=70,feedback=15,history=8,dashboard=5,stream=2'
+# Sin cubetas ni límite de concurrencia: se mide el servidor, no el control de admisión
+RATE_LIMIT_OFF = {
+    'RATE_LIMIT_SESSION_RATE': '0',
+    'RATE_LIMIT_IP_RATE': '0',
+    'ADMISSION_MAX_CONCURRENT': '0'
+}
+
+
+class SimulatedSession:
+    def __init__(self, base_url: str):
+        self.base_url = base_url
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+        self.lock = threading.Lock()
+        self.conversation_ids = []
+        self.history_etag = None
+
+    def request(self, path: str, payload=None, headers=None, timeout: float = 30):
+        data = json.dumps(payload).encode('utf-8') if payload is not None else None
+        request = urllib.request.Request(self.base_url + path, data=data, headers=headers or {})
+        if data is not None:
+            request.add_header('Content-Type', 'application/json')
+        try:
+            with self.opener.open(request, timeout=timeout) as response:
+                return response.status, response.headers, response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.headers, e.read()
+
+
+def load_questions(path: str, count: int, seed: int):
+    if path:
+        questions = []
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                if line.startswith('{'):
+                    line = json.loads(line).get('question', '')
+                questions.append(line)
+        return questions
+
+    # Registro sintético con las mismas distribuciones que los microbenchmarks
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from bench_pipeline import build_vocabularies, generate_questions
+    rng = random.Random(seed)
+    return generate_questions(count, build_vocabularies(rng, 1000), rng)
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def launch_server(port: int, rate_limit: bool = False):
+    env = dict(os.environ) if rate_limit else {**os.environ, **RATE_LIMIT_OFF}
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'flask', '--app', 'app', 'run', '--port', str(port), '--with-threads'],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return process
+        except OSError:
+            if process.poll() is not None:
+                raise RuntimeError('El servidor terminó al iniciar')
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError('El servidor no respondió a tiempo')
+
+
+def read_rss_kb(pid: int):
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+    return None
+
+
+class LoadTest:
+    def __init__(self, base_url: str, questions, sessions: int, mix, seed: int):
+        self.rng = random.Random(seed)
+        self.rng_lock = threading.Lock()
+        self.questions = questions
+        self.sessions = [SimulatedSession(base_url) for _ in range(sessions)]
+        self.actions = [action for action, _ in mix]
+        self.weights = [weight for _, weight in mix]
+        self.samples = []  # (fin, acción, latencia, servicio, error)
+        self.samples_lock = threading.Lock()
+
+    def start_sessions(self):
+        for simulated in self.sessions:
+            simulated.request('/chat')
+
+    def choose(self):
+        with self.rng_lock:
+            return (
+                self.rng.choices(self.actions, weights=self.weights)[0],
+                self.rng.choice(self.sessions),
+                self.rng.choice(self.questions)
+            )
+
+    def run_action(self, scheduled: float):
+        action, simulated, question = self.choose()
+        if action == 'feedback' and not simulated.conversation_ids:
+            action = 'ask'
+        started = time.perf_counter()
+        error = None
+        try:
+            error = getattr(self, f'do_{action}')(simulated, question)
+        except Exception as e:
+            error = type(e).__name__
+        finished = time.perf_counter()
+        with self.samples_lock:
+            self.samples.append((finished, action, finished - scheduled, finished - started, error))
+
+    def do_ask(self, simulated, question):
+        status, _, body = simulated.request('/api/ask', {'question': question})
+        if status != 200:
+            return f'http_{status}'
+        data = json.loads(body)
+        if 'error' in data:
+            return 'api_error'
+        with simulated.lock:
+            simulated.conversation_ids.append(data['conversation_id'])
+        return None
+
+    def do_stream(self, simulated, question):
+        status, _, body = simulated.request('/api/ask/stream', {'question': question})
+        if status != 200:
+            return f'http_{status}'
+        return 'api_error' if b'event: done' not in body else None
+
+    def do_feedback(self, simulated, question):
+        with simulated.lock, self.rng_lock:
+            conversation_id = self.rng.choice(simulated.conversation_ids)
+            rating = self.rng.choice([2, 5])
+        status, _, body = simulated.request('/api/feedback', {
+            'conversation_id': conversation_id, 'rating': rating
+        })
+        if status != 200:
+            return f'http_{status}'
+        return None if json.loads(body).get('success') else 'api_error'
+
+    def do_history(self, simulated, question):
+        headers = {'If-None-Match': simulated.history_etag} if simulated.history_etag else {}
+        status, response_headers, _ = simulated.request('/api/history?summary=1&limit=50', headers=headers)
+        if status not in (200, 304):
+            return f'http_{status}'
+        simulated.history_etag = response_headers.get('ETag')
+        return None
+
+    def do_dashboard(self, simulated, question):
+        status, _, _ = simulated.request('/dashboard')
+        return None if status in (200, 304) else f'http_{status}'
+
+    def run(self, qps: float, duration: float, workers: int, pid: int, sample_interval: float):
+        memory = []
+        stop = threading.Event()
+
+        def sample_memory():
+            start = time.perf_counter()
+            while not stop.is_set():
+                rss = read_rss_kb(pid) if pid else None
+                if rss is not None:
+                    memory.append((time.perf_counter() - start, rss))
+                stop.wait(sample_interval)
+
+        sampler = threading.Thread(target=sample_memory, daemon=True)
+        sampler.start()
+
+        # Lazo abierto: las solicitudes se programan a intervalos fijos sin esperar respuestas
+        interval = 1.0 / qps
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            sent = 0
+            while True:
+                scheduled = start + sent * interval
+                if scheduled - start >= duration:
+                    break
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                executor.submit(self.run_action, scheduled)
+                sent += 1
+        elapsed = time.perf_counter() - start
+        stop.set()
+        sampler.join()
+        return self.report(start, elapsed, sent, qps, memory, sample_interval)
+
+    def report(self, start: float, elapsed: float, sent: int, qps: float, memory, window: float):
+        def percentiles(values):
+            values = sorted(values)
+            if not values:
+                return {}
+            pick = lambda p: values[min(len(values) - 1, max(0, round(p / 100 * len(values)) - 1))] * 1000
+            return {'p50_ms': pick(50), 'p95_ms': pick(95), 'p99_ms': pick(99), 'max_ms': values[-1] * 1000}
+
+        by_action = {}
+        for _, action, latency, service, error in self.samples:
+            stats = by_action.setdefault(action, {'latencies': [], 'service': [], 'errors': 0})
+            stats['latencies'].append(latency)
+            stats['service'].append(service)
+            stats['errors'] += error is not None
+
+        errors = sum(1 for sample in self.samples if sample[4] is not None)
+        timeline = []
+        window = max(window, 1.0)
+        buckets = {}
+        for finished, _, latency, _, error in self.samples:
+            buckets.setdefault(int((finished - start) // window), []).append((latency, error))
+        memory_by_window = {}
+        for offset, rss in memory:
+            memory_by_window[int(offset // window)] = rss
+        for index in sorted(buckets):
+            items = buckets[index]
+            timeline.append({
+                't_s': index * window,
+                'throughput_rps': len(items) / window,
+                'error_rate': sum(1 for _, error in items if error) / len(items),
+                'p95_ms': percentiles([latency for latency, _ in items]).get('p95_ms'),
+                'rss_kb': memory_by_window.get(index)
+            })
+
+        return {
+            'target_qps': qps,
+            'scheduled': sent,
+            'completed': len(self.samples),
+            'duration_s': elapsed,
+            'throughput_rps': len(self.samples) / elapsed if elapsed else None,
+            'error_rate': errors / len(self.samples) if self.samples else None,
+            'latency': percentiles([sample[2] for sample in self.samples]),
+            'endpoints': {
+                action: {
+                    'requests': len(stats['latencies']),
+                    'error_rate': stats['errors'] / len(stats['latencies']),
+                    'latency': percentiles(stats['latencies']),
+                    'service_time': percentiles(stats['service'])
+                }
+                for action, stats in sorted(by_action.items())
+            },
+            'memory': {
+                'start_rss_kb': memory[0][1] if memory else None,
+                'end_rss_kb': memory[-1][1] if memory else None,
+                'max_rss_kb': max(rss for _, rss in memory) if memory else None,
+                'growth_kb': memory[-1][1] - memory[0][1] if memory else None
+            },
+            'timeline': timeline
+        }
+
+
+def parse_mix(text: str):
+    mix = []
+    for part in text.split(','):
+        action, weight = part.split('=')
+        if action not in ('ask', 'stream', 'feedback', 'history', 'dashboard'):
+            raise argparse.ArgumentTypeError(f'acción desconocida: {action}')
+        mix.append((action, float(weight)))
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', help='instancia ya iniciada (por defecto se lanza una local)')
+    parser.add_argument('--pid', type=int, help='pid del servidor para medir memoria cuando se usa --url')
+    parser.add_argument('--log', help='registro de preguntas (una por línea o JSONL con "question")')
+    parser.add_argument('--qps', type=float, default=20)
+    parser.add_argument('--duration', type=float, default=30, help='segundos')
+    parser.add_argument('--sessions', type=int, default=100)
+    parser.add_argument('--workers', type=int, default=64, help='solicitudes concurrentes máximas del cliente')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX))
+    parser.add_argument('--interval', type=float, default=5, help='ventana de la serie temporal (segundos)')
+    parser.add_argument('--seed', type=int, default=1234)
+    parser.add_argument('--output', help='archivo JSON con el informe')
+    parser.add_argument('--rate-limit', action='store_true',
+                        help='mantener el control de admisión de la instancia local (desactivado por defecto)')
+    args = parser.parse_args()
+
+    process = None
+    base_url, pid = args.url, args.pid
+    if base_url is None:
+        port = free_port()
+        process = launch_server(port, args.rate_limit)
+        base_url, pid = f'http://127.0.0.1:{port}', process.pid
+    base_url = base_url.rstrip('/')
+
+    try:
+        questions = load_questions(args.log, 2000, args.seed)
+        test = LoadTest(base_url, questions, args.sessions, args.mix, args.seed)
+        test.start_sessions()
+        report = test.run(args.qps, args.duration, args.workers, pid, args.interval)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=10)
+
+    report['config'] = {
+        'url': base_url, 'sessions': args.sessions, 'mix': dict(args.mix), 'log': args.log,
+        'rate_limit': args.rate_limit if process is not None else None
+    }
+    print(f"throughput {report['throughput_rps']:.1f} req/s de {args.qps} objetivo, "
+          f"errores {report['error_rate']:.2%}")
+    for action, stats in report['endpoints'].items():
+        latency = stats['latency']
+        print(f"  {action:<10} n={stats['requests']:<6} p50={latency['p50_ms']:.1f}ms "
+              f"p95={latency['p95_ms']:.1f}ms p99={latency['p99_ms']:.1f}ms errores={stats['error_rate']:.2%}")
+    if report['memory']['start_rss_kb'] is not None:
+        print(f"  RSS {report['memory']['start_rss_kb']} -> {report['memory']['end_rss_kb']} kB "
+              f"(máx {report['memory']['max_rss_kb']} kB)")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+"""Equivalencia de las búsquedas optimizadas con las implementaciones originales.
+
+El índice invertido, el autómata Aho-Corasick y el índice particionado por materia
+deben devolver lo mismo que el recorrido lineal con Jaccard y la búsqueda de
+subcadenas a los que reemplazaron. La detección de materia solo difiere de la
+original en los casos documentados de palabras clave dentro de otras palabras.
+"""
+import random
+
+import pytest
+
+from app import KeywordAutomaton, KnowledgeIndex, ShardedKnowledgeIndex, SimpleNLPProcessor
+
+SUBJECTS = ['matematicas', 'fisica', 'quimica', 'biologia']
+VOCABULARY = [f'palabra{i}' for i in range(40)]
+
+
+@pytest.fixture(scope='module')
+def corpus():
+    rng = random.Random(1234)
+    knowledge_data = {subject: [] for subject in SUBJECTS}
+    entry_id = 0
+    for subject in SUBJECTS:
+        for _ in range(25):
+            entry_id += 1
+            knowledge_data[subject].append({
+                'id': entry_id,
+                'topic': f'tema {entry_id}',
+                'content': f'contenido {entry_id}',
+                'keywords': rng.sample(VOCABULARY, rng.randint(1, 6))
+            })
+    return knowledge_data
+
+
+@pytest.fixture(scope='module')
+def questions():
+    rng = random.Random(99)
+    return [
+        {'subject': rng.choice(SUBJECTS + ['general']), 'keywords': rng.choices(VOCABULARY, k=rng.randint(0, 8))}
+        for _ in range(500)
+    ]
+
+
+def jaccard(keywords1, keywords2) -> float:
+    if not keywords1 or not keywords2:
+        return 0.0
+    common = set(keywords1) & set(keywords2)
+    total = set(keywords1) | set(keywords2)
+    return len(common) / len(total) if total else 0.0
+
+
+def linear_search(knowledge_data, processed_question, top_k):
+    # Búsqueda original: recorre todas las entradas, primero las de la materia detectada
+    subject = processed_question.get('subject', 'general')
+    keywords = processed_question.get('keywords', [])
+    results = []
+    for entry in knowledge_data.get(subject, []):
+        score = jaccard(keywords, entry['keywords'])
+        if score > 0:
+            results.append((entry['id'], subject, score))
+    if len(results) < top_k:
+        for other_subject, entries in knowledge_data.items():
+            if other_subject != subject:
+                for entry in entries:
+                    score = jaccard(keywords, entry['keywords'])
+                    if score > 0:
+                        results.append((entry['id'], other_subject, score * 0.7))
+    results.sort(key=lambda result: result[2], reverse=True)
+    return results[:top_k]
+
+
+def summarize(results):
+    return [(result['id'], result['subject'], pytest.approx(result['similarity'])) for result in results]
+
+
+@pytest.mark.parametrize('top_k', [1, 3, 5])
+def test_inverted_index_matches_linear_scan(corpus, questions, top_k):
+    index = KnowledgeIndex(corpus, 'keyword', 1, spelling=False)
+    for question in questions:
+        expected = linear_search(corpus, question, top_k)
+        assert summarize(index.search(question, top_k)) == expected, question
+
+
+@pytest.mark.parametrize('top_k', [1, 3, 5])
+def test_sharded_index_matches_single_index(corpus, questions, top_k):
+    single = KnowledgeIndex(corpus, 'keyword', 1)
+    sharded = ShardedKnowledgeIndex(corpus, 'keyword', 1, fanout=2)
+    expected = [summarize(results) for results in single.search_batch(questions, top_k)]
+    assert [summarize(results) for results in sharded.search_batch(questions, top_k)] == expected
+    for question in questions[:50]:
+        assert summarize(sharded.search(question, top_k)) == summarize(single.search(question, top_k))
+
+
+def test_automaton_matches_substring_search():
+    patterns = ['que es', 'como', 'por que', 'calcula', 'ejemplo', 'diferencia', 'celula', 'cel', 'ula']
+    automaton = KeywordAutomaton({'pattern': patterns})
+    rng = random.Random(7)
+    words = patterns + ['hola', 'el', 'la', 'x', 'celulas', 'porque']
+    for _ in range(2000):
+        text = ' '.join(rng.choices(words, k=rng.randint(0, 6)))
+        if rng.random() < 0.3:
+            text = text.replace(' ', '')
+        assert automaton.find(text) == {pattern for pattern in patterns if pattern in text}, text
+
+
+@pytest.mark.parametrize('pattern, text, found', [
+    ('ion', 'que son los iones', True),
+    ('ion', 'el ion sodio', True),
+    ('ion', 'una reaccion quimica', False),
+    ('evolucion', 'teoria de la evolucion', True),
+    ('evolucion', 'las evoluciones', True),
+    ('evolucion', 'la revolucion francesa', False),
+])
+def test_automaton_whole_word_patterns(pattern, text, found):
+    automaton = KeywordAutomaton()
+    automaton.add(pattern, 'materia', whole_word=True)
+    automaton.build()
+    assert automaton.find(text) == ({pattern} if found else set())
+
+
+def substring_subject(subject_keywords, text: str) -> str:
+    # Detección de materia original: cuenta las palabras clave contenidas en el texto
+    subject_scores = {
+        subject: sum(1 for keyword in keywords if keyword in text)
+        for subject, keywords in subject_keywords.items()
+    }
+    best_subject = max(subject_scores, key=subject_scores.get)
+    return best_subject if subject_scores[best_subject] > 0 else 'general'
+
+
+@pytest.fixture(scope='module')
+def nlp_processor():
+    return SimpleNLPProcessor()
+
+
+@pytest.mark.parametrize('text', [
+    'que es una ecuacion lineal',
+    'como se resuelve una ecuacion de segundo grado',
+    'cual es la derivada de x al cuadrado',
+    'explica el teorema de pitagoras',
+    'que es un numero primo',
+    'que es la fuerza de gravedad',
+    'explica las leyes de newton',
+    'que es la presion atmosferica',
+    'como funciona la tabla periodica',
+    'que es un enlace covalente',
+    'que son los acidos y las bases',
+    'que es el ion sodio',
+    'que son las sales minerales',
+    'que es la celula',
+    'explica la fotosintesis',
+    'como funciona la evolucion de las especies',
+    'que es un gen',
+    'cuando empezo la segunda guerra mundial',
+    'el imperio romano',
+    'cual es la capital de francia',
+    'que es un continente',
+    'cuantas casas hay',
+    'de que color es el cielo',
+    'hola como estas',
+])
+def test_detect_subject_matches_substring_scorer(nlp_processor, text):
+    assert nlp_processor.detect_subject(text) == substring_subject(nlp_processor.subject_keywords, text)
+
+
+@pytest.mark.parametrize('text, substring, whole_word', [
+    # Cambio intencional: las palabras clave cuentan solo como palabra completa (o su plural)
+    ('que fue la revolucion francesa', 'quimica', 'historia'),  # 'ion' y 'evolucion' dentro de 'revolucion'
+    ('la particion del arte', 'quimica', 'historia'),  # 'ion' dentro de 'particion'
+])
+def test_detect_subject_whole_word_divergences(nlp_processor, text, substring, whole_word):
+    assert substring_subject(nlp_processor.subject_keywords, text) == substring
+    assert nlp_processor.detect_subject(text) == whole_word